@@ -0,0 +1,102 @@
+"""
+Times the fundamentals comparison across many tickers against reading the latest report of every ticker one by one.
+
+--tickers tickers get --years annual and four times as many quarterly synthetic reports of both statements. The script
+reports how long ingesting them took, how long compare takes for the latest annual currentDebt, totalAssets and
+operatingCashflow of every ticker, and how long the same values take with a query per ticker and metric. A second
+refresh is run to check that no ticker is fetched again before a newer period can have been reported.
+
+Usage:
+    python benchmarks/fundamentals.py --tickers 500 --years 5
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+METRICS = ["currentDebt", "totalAssets", "operatingCashflow"]
+
+
+def reports(years, fields):
+    """ synthetic annual and quarterly reports ending in the last complete year, amounts as the strings the upstream sends """
+
+    last = date.today().year - 1
+    annual = [{"fiscalDateEnding": f"{last - year}-12-31", "reportedCurrency": "USD",
+               **{field: str(random.randint(10 ** 6, 10 ** 12)) for field in fields}} for year in range(years)]
+    quarterly = [{"fiscalDateEnding": f"{last - year}-{month:02d}-{day}", "reportedCurrency": "USD",
+                  **{field: random.choice(["None", str(random.randint(10 ** 6, 10 ** 12))]) for field in fields}}
+                 for year in range(years) for month, day in ((3, 31), (6, 30), (9, 30), (12, 31))]
+    return {"annualReports": annual, "quarterlyReports": quarterly}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tickers", type=int, default=500)
+    parser.add_argument("--years", type=int, default=5)
+    args = parser.parse_args()
+
+    from sqlalchemy import select
+
+    from website import create_app, db
+    from website.config import TestConfig
+    from website.stock import fundamentals
+    from website.stock.providers import ReplayProvider, set_provider
+
+    tickers = [f"T{index:04d}"[:5] for index in range(args.tickers)]
+
+    class ReportsProvider(ReplayProvider):
+        """ answers the synthetic reports and counts the calls """
+
+        calls = 0
+
+        def get_balance_sheet(self, stock_ticker):
+            ReportsProvider.calls += 1
+            return reports(args.years, ["totalAssets", "currentDebt", "totalLiabilities", "longTermDebt"])
+
+        def get_cash_flow(self, stock_ticker):
+            ReportsProvider.calls += 1
+            return reports(args.years, ["operatingCashflow", "capitalExpenditures", "netIncome"])
+
+    app = create_app(TestConfig)
+    provider = ReportsProvider()
+    app.extensions["market_data_provider"] = provider
+    set_provider(provider)
+
+    with app.app_context():
+        db.create_all()
+
+        started = time.perf_counter()
+        counts = fundamentals.refresh(tickers)
+        ingest_seconds = time.perf_counter() - started
+
+        calls = ReportsProvider.calls
+        again = fundamentals.refresh(tickers)
+        refetched = ReportsProvider.calls - calls
+
+        fundamentals.compare(METRICS, tickers[:1])  # imports pandas outside of the timing
+        started = time.perf_counter()
+        table = fundamentals.compare(METRICS, tickers)
+        compare_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for ticker in tickers:
+            for model, metric in ((fundamentals.BalanceSheet, "current_debt"), (fundamentals.BalanceSheet, "total_assets"),
+                                  (fundamentals.CashFlow, "operating_cashflow")):
+                db.session.execute(select(getattr(model, metric)).where(model.ticker == ticker, model.period == "annual")
+                                   .order_by(model.fiscal_date_ending.desc()).limit(1)).scalar()
+        loop_seconds = time.perf_counter() - started
+
+    print(f"ingested {counts['inserted']} reports of {args.tickers} tickers in {ingest_seconds:.2f}s")
+    print(f"second refresh: {again['skipped']} not due, {refetched} upstream calls")
+    print(f"compare {len(METRICS)} metrics x {len(table)} tickers: {compare_seconds * 1000:.1f}ms, "
+          f"one query per ticker and metric: {loop_seconds * 1000:.1f}ms")
+    return 0 if refetched == 0 and table.notna().all().all() else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,101 @@
+"""
+Compares the transfer size and request count of the home page with and without the static asset pipeline.
+
+The home page is rendered once with plain static files and once with fingerprinted ones. Every asset it references is
+then fetched the way a browser would: as brotli or gzip, with the best <picture> source for --viewport pixels. The
+report lists the bytes of a first view, the requests to this server and the CDNs, and how many requests a repeat view
+still makes. Plain static files are revalidated on every view, immutable fingerprinted files are not.
+
+Usage:
+    python benchmarks/home_page_weight.py --viewport 1440
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BROWSER_IMAGE_TYPES = ("image/avif", "image/webp", "image/jpeg")
+
+
+class AssetParser(HTMLParser):
+    """ collects the stylesheets, scripts and images a page loads, choosing one candidate for every <picture> """
+
+    def __init__(self, viewport):
+        super().__init__()
+        self.viewport = viewport
+        self.assets = []
+        self._sources = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "link" and attrs.get("rel") == "stylesheet":
+            self.assets.append(attrs["href"])
+        elif tag == "script" and attrs.get("src"):
+            self.assets.append(attrs["src"])
+        elif tag == "picture":
+            self._sources = []
+        elif tag == "source" and self._sources is not None:
+            self._sources.append((attrs.get("type"), attrs.get("srcset", "")))
+        elif tag == "img":
+            chosen = self._choose(self._sources or [])
+            self.assets.append(chosen or attrs["src"])
+
+    def handle_endtag(self, tag):
+        if tag == "picture":
+            self._sources = None
+
+    def _choose(self, sources):
+        for content_type in BROWSER_IMAGE_TYPES:
+            for source_type, srcset in sources:
+                if source_type != content_type:
+                    continue
+                candidates = sorted((int(width.rstrip("w")), url) for url, width in (item.split() for item in srcset.split(",")))
+                return next((url for width, url in candidates if width >= self.viewport), candidates[-1][1])
+        return None
+
+
+def measure(app, viewport):
+    client = app.test_client()
+    page = client.get("/", headers={"Accept-Encoding": "gzip, br"})
+    parser = AssetParser(viewport)
+    parser.feed(page.get_data(as_text=True))
+
+    local = [urljoin("http://localhost/", asset) for asset in parser.assets if not urlparse(asset).netloc]
+    external = [asset for asset in parser.assets if urlparse(asset).netloc]
+
+    transferred, revalidated = len(page.data), 0
+    for url in dict.fromkeys(local):
+        response = client.get(urlparse(url).path, headers={"Accept-Encoding": "gzip, br"})
+        transferred += len(response.data)
+        if "immutable" not in response.headers.get("Cache-Control", ""):
+            revalidated += 1
+        response.close()
+    return {"bytes": transferred, "local": len(set(local)), "external": len(external), "repeat": revalidated}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--viewport", type=int, default=1440, help="the width in device pixels the background image is chosen for")
+    args = parser.parse_args()
+
+    from website import create_app
+    from website.config import TestConfig
+
+    output_dir = tempfile.mkdtemp()
+    results = {
+        "plain static": measure(create_app(TestConfig, ASSETS_ENABLED=False), args.viewport),
+        "asset pipeline": measure(create_app(TestConfig, ASSETS_ENABLED=True, ASSETS_BUILD_ON_STARTUP=True, ASSETS_OUTPUT_DIR=output_dir), args.viewport),
+    }
+
+    print(f"{'':<16} {'first view KB':>14} {'local requests':>15} {'CDN requests':>13} {'repeat view requests':>21}")
+    for name, result in results.items():
+        print(f"{name:<16} {result['bytes'] / 1024:>14.1f} {result['local']:>15} {result['external']:>13} {result['repeat']:>21}")
+
+
+if __name__ == "__main__":
+    main()
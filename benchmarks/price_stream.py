@@ -0,0 +1,89 @@
+"""
+Checks that the price stream hub's upstream load follows the distinct tickers, not the connected clients.
+
+--clients streams subscribe to random tickers out of --tickers, the hub polls for --seconds and every stream is read by its
+own thread, with --slow of them reading ten times slower than the polls. The script reports the upstream calls made, the
+events delivered and how many updates the slow readers had conflated.
+
+Usage:
+    python benchmarks/price_stream.py --clients 200 --tickers 20 --seconds 5
+"""
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--tickers", type=int, default=20)
+    parser.add_argument("--per-client", type=int, default=5, help="tickers every client subscribes to")
+    parser.add_argument("--interval", type=float, default=0.2)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--slow", type=int, default=20, help="clients that read ten times slower than the polls")
+    args = parser.parse_args()
+
+    from website import create_app, db
+    from website.config import TestConfig
+    from website.stock.price_stream import get_hub
+    from website.stock.providers import ReplayProvider, set_provider
+    from website.stock.stock_models import price_cache
+
+    class MovingProvider(ReplayProvider):
+        """ every call answers a new price and is counted """
+
+        calls = 0
+        lock = threading.Lock()
+
+        def get_latest_price(self, stock_ticker):
+            with self.lock:
+                MovingProvider.calls += 1
+            return round(100 + random.random(), 2)
+
+    # the streams are read by the script's own threads, not by request threads
+    app = create_app(TestConfig, PRICE_STREAM_INTERVAL=args.interval, PRICE_STREAM_MAX_SUBSCRIBERS=args.clients, WEB_THREADS=0)
+    with app.app_context():
+        db.create_all()
+    provider = MovingProvider()
+    app.extensions["market_data_provider"] = provider
+    set_provider(provider)
+    price_cache.ttl = 0
+
+    hub = get_hub(app)
+    tickers = [f"T{index}" for index in range(args.tickers)]
+    subscriptions = [hub.subscribe(random.sample(tickers, min(args.per_client, len(tickers)))) for _ in range(args.clients)]
+    delivered = [0] * args.clients
+    deadline = time.monotonic() + args.seconds
+
+    def read(index):
+        pause = args.interval * 10 if index < args.slow else 0
+        while time.monotonic() < deadline:
+            delivered[index] += len(subscriptions[index].take(timeout=args.interval))
+            time.sleep(pause)
+
+    readers = [threading.Thread(target=read, args=(index,)) for index in range(args.clients)]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+
+    polls = hub.stats()["polls"]
+    for subscription in subscriptions:
+        hub.unsubscribe(subscription)
+
+    print(f"{args.clients} clients on {args.tickers} tickers for {args.seconds:.0f}s, {polls} polls")
+    print(f"upstream calls: {MovingProvider.calls} ({MovingProvider.calls / max(polls, 1):.1f} per poll, "
+          f"{args.tickers} distinct tickers, {args.clients * args.per_client} subscriptions)")
+    print(f"events delivered: {sum(delivered)}, conflated for the {args.slow} slow clients: "
+          f"{sum(subscription.conflated for subscription in subscriptions[:args.slow])}")
+    return 0 if MovingProvider.calls <= polls * args.tickers else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+"""
+Renders every page and API view with the query budgets enforced, so the budgets declared with @query_budget are checked.
+
+A user is registered and buys --holdings tickers, then the profile, stock, trades, chart, analytics, symbol and
+fundamentals views are requested, each once with cold caches and once warm. With TestConfig a view that runs more
+statements than its budget raises QueryBudgetExceeded, which fails the run. Every view of the views blueprint must also
+declare a budget. The report lists the statements of every request, including flask-login's user loader, which the
+budgets do not count.
+
+Usage:
+    python benchmarks/query_budgets.py --holdings 5
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PASSWORD = "budget-password"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--holdings", type=int, default=5)
+    args = parser.parse_args()
+
+    from website import create_app, db
+    from website.config import TestConfig
+    from website.query_budget import QueryBudgetExceeded, count_queries
+    from website.stock import bar_store
+    from website.stock.analytics import analytics_cache
+    from website.stock.stock_models import company_name_cache, intraday_cache, price_cache
+
+    database = os.path.join(tempfile.mkdtemp(), "budgets.db")
+    app = create_app(TestConfig, SQLALCHEMY_DATABASE_URI=f"sqlite:///{database}")
+    assert app.config["QUERY_BUDGET_ENFORCED"]
+    with app.app_context():
+        db.create_all()
+
+    failures = [f"{endpoint} declares no query budget" for endpoint, view in sorted(app.view_functions.items())
+                if endpoint.startswith("views.") and getattr(view, "query_budget", None) is None]
+
+    def cold():
+        for cache in (price_cache, intraday_cache, company_name_cache, analytics_cache):
+            cache.invalidate()
+        bar_store.clear_memory()
+
+    client = app.test_client()
+    adapter = app.url_map.bind("localhost")
+
+    def request(method, path, expected=(200,), **kwargs):
+        endpoint = adapter.match(path.split("?")[0], method=method)[0]
+        budget = getattr(app.view_functions[endpoint], "query_budget", None)
+        try:
+            with count_queries() as counter:
+                response = client.open(path, method=method, **kwargs)
+        except QueryBudgetExceeded as error:
+            failures.append(f"{method} {path}: {str(error).splitlines()[0]}")
+            print(f"{method:<5} {path:<60} {'budget exceeded':>15} {budget!s:>7}")
+            return None
+        if response.status_code not in expected:
+            failures.append(f"{method} {path} answered {response.status_code}, expected {expected}")
+        print(f"{method:<5} {path:<60} {response.status_code:>6} {counter.count:>8} {budget!s:>7}")
+        return response
+
+    tickers = [chr(65 + index // 26 % 26) + chr(65 + index % 26) + "Q" for index in range(args.holdings)] or ["AAQ"]
+    print(f"{'':<5} {'':<60} {'status':>6} {'queries':>8} {'budget':>7}")
+    request("POST", "/register", expected=(302,), data=dict(username="budget", phone_number="1", email_address="budget@example.com",
+                                                            password1=PASSWORD, password2=PASSWORD))
+    for ticker in tickers:
+        request("POST", f"/stock_page/{ticker}/1", expected=(302,), data=dict(shares=2, submit_buy="y"))
+    request("POST", f"/stock_page/{tickers[0]}/1", expected=(302,), data=dict(shares=1, submit_sell="y"))
+
+    for state in ("cold", "warm"):
+        if state == "cold":
+            cold()
+        request("GET", "/")
+        request("GET", "/profile")
+        request("POST", "/profile", expected=(302,), data={"search bar": tickers[0]})
+        request("GET", f"/stock_page/{tickers[0]}/1")
+        request("GET", "/trades")
+        request("GET", f"/trades?limit=1&ticker={tickers[0]}")
+        request("GET", f"/api/chart/{tickers[0]}?points=100")
+        # a ticker whose bars were never fetched, the chart fetches and stores them first
+        request("GET", f"/api/chart/{tickers[-1] if state == 'cold' else tickers[0]}?points=100")
+        request("GET", "/api/portfolio/analytics")
+        request("GET", "/api/symbols?q=A")
+        request("GET", f"/api/fundamentals?tickers={','.join(tickers)}&metrics=totalAssets,operatingCashflow")
+
+    if failures:
+        print("\n".join(["", "FAILED:"] + failures))
+        return 1
+    print("\nEvery view stayed within its query budget")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
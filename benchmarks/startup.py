@@ -0,0 +1,77 @@
+"""
+Measures how fast a worker boots: the time to import the app and create it, and the memory it holds afterwards.
+
+Every run happens in a fresh interpreter, like a newly spawned worker. The cost of the market data stack
+(numpy, pandas and the modules built on them), which is only imported on first use, is reported separately.
+
+Usage:
+    python benchmarks/startup.py --runs 5
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import json, resource, sys, time
+
+def rss_mb():
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+started = time.perf_counter()
+from website import create_app, preload_market_data
+from website.config import TestConfig
+imported = time.perf_counter()
+app = create_app(TestConfig, PRELOAD_MARKET_DATA={preload})
+created = time.perf_counter()
+boot_rss = rss_mb()
+heavy_modules = [name for name in ("numpy", "pandas", "requests", "alpha_vantage") if name in sys.modules]
+preload_market_data()
+loaded = time.perf_counter()
+
+print(json.dumps({{"import": imported - started, "create_app": created - imported, "boot_rss": boot_rss,
+                  "market_data_import": loaded - created, "full_rss": rss_mb(), "heavy_modules_at_boot": heavy_modules}}))
+"""
+
+
+def probe(preload: bool) -> dict:
+    output = subprocess.run([sys.executable, "-c", PROBE.format(preload=preload)], cwd=ROOT, check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--preload", action="store_true", help="boot with PRELOAD_MARKET_DATA, like a gunicorn --preload master")
+    args = parser.parse_args()
+
+    results = [probe(args.preload) for _ in range(args.runs)]
+
+    def median(key):
+        return statistics.median(result[key] for result in results)
+
+    print(f"{args.runs} fresh workers, PRELOAD_MARKET_DATA={args.preload}")
+    print(f"  import website:         {median('import') * 1000:8.1f} ms")
+    print(f"  create_app:             {median('create_app') * 1000:8.1f} ms")
+    print(f"  RSS after boot:         {median('boot_rss'):8.1f} MB")
+    print(f"  market data import:     {median('market_data_import') * 1000:8.1f} ms (deferred to the first request that needs it)")
+    print(f"  RSS with market data:   {median('full_rss'):8.1f} MB")
+    print(f"  heavy modules at boot:  {', '.join(results[0]['heavy_modules_at_boot']) or 'none'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Measures the stock page latency against a local fake Alpha Vantage upstream that answers every call after a fixed delay.
+
+The page needs the latest quote, the company name and the intraday bars. The script times those three fetches awaited
+one after the other, the same fetches run concurrently, and the whole stock page. Every round uses a new ticker, so
+nothing is served from the caches. Concurrent fetches should take about one upstream delay, serial ones about three.
+
+Usage:
+    python benchmarks/stock_page_latency.py --latency 0.1 --rounds 20
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import string
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeAlphaVantage:
+    """ serves the query endpoint calls the async provider makes, from a background thread """
+
+    def __init__(self, latency: float, bars: int = 100):
+        self.latency = latency
+        self.bars = bars
+        self.calls = 0
+        self.connections = set()
+        self.url = None
+
+        self._ready = threading.Event()
+
+    def start(self):
+        threading.Thread(target=asyncio.run, args=(self._serve(),), daemon=True).start()
+        self._ready.wait()
+
+    async def _serve(self):
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_get("/query", self._query)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}/query"
+        self._ready.set()
+        await asyncio.Event().wait()
+
+    async def _query(self, request):
+        from aiohttp import web
+
+        self.calls += 1
+        self.connections.add(id(request.transport))
+        await asyncio.sleep(self.latency)
+
+        function, symbol = request.query["function"], request.query.get("symbol") or request.query.get("keywords")
+        anchor = datetime(2023, 1, 3, 20, 0)
+        if function == "TIME_SERIES_DAILY_ADJUSTED":
+            return web.json_response({"Time Series (Daily)": {anchor.date().isoformat(): {"4. close": "101.25"}}})
+        if function == "TIME_SERIES_INTRADAY":
+            rows = {(anchor - timedelta(hours=index)).isoformat(sep=" "): {"1. open": "100", "2. high": "102", "3. low": "99",
+                                                                           "4. close": str(100 + index % 7), "5. volume": "1000"}
+                    for index in range(self.bars)}
+            return web.json_response({f"Time Series ({request.query['interval']})": rows})
+        if function == "SYMBOL_SEARCH":
+            return web.json_response({"bestMatches": [{"1. symbol": symbol, "2. name": f"{symbol} Fake Inc"}]})
+        return web.json_response({"Error Message": f"Unknown function {function}"})
+
+
+def ticker_names():
+    for first in string.ascii_uppercase:
+        for second in string.ascii_uppercase:
+            for third in string.ascii_uppercase:
+                yield first + second + third
+
+
+def describe(name, samples):
+    samples = sorted(samples)
+    print(f"{name:<22} p50 {statistics.median(samples) * 1000:7.1f}ms   max {samples[-1] * 1000:7.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.1, help="seconds the fake upstream takes to answer a call")
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    upstream = FakeAlphaVantage(args.latency)
+    upstream.start()
+
+    from website import create_app, db
+    from website.config import TestConfig
+    from website.stock.ingestion import aread_stock_series
+    from website.stock.stock_models import aget_company_name, aget_latest_stock_price
+
+    app = create_app(TestConfig, MARKET_DATA_PROVIDER="alpha_vantage", ALPHA_VANTAGE_URL=upstream.url, ALPHA_VANTAGE_API_KEY="demo",
+                     QUERY_BUDGET_ENFORCED=False)
+    with app.app_context():
+        db.create_all()
+
+    tickers = ticker_names()
+    max_age = app.config["INTRADAY_MAX_AGE"]
+
+    async def serial(ticker):
+        await aget_latest_stock_price(ticker)
+        await aget_company_name(ticker)
+        await aread_stock_series(ticker, max_age)
+
+    async def concurrent(ticker):
+        await asyncio.gather(aget_latest_stock_price(ticker), aget_company_name(ticker), aread_stock_series(ticker, max_age))
+
+    timings = {"serial fetches": [], "concurrent fetches": [], "stock page": []}
+    for name, fetch in (("serial fetches", serial), ("concurrent fetches", concurrent)):
+        for _ in range(args.rounds):
+            with app.app_context():
+                started = time.perf_counter()
+                asyncio.run(fetch(next(tickers)))
+                timings[name].append(time.perf_counter() - started)
+
+    client = app.test_client()
+    client.post("/register", data=dict(username="latency", phone_number="1", email_address="latency@example.com",
+                                       password1="latency-password", password2="latency-password"))
+    for _ in range(args.rounds):
+        started = time.perf_counter()
+        response = client.get(f"/stock_page/{next(tickers)}/100")
+        timings["stock page"].append(time.perf_counter() - started)
+        assert response.status_code == 200, response.status_code
+
+    print(f"upstream latency {args.latency * 1000:.0f}ms, {args.rounds} rounds each")
+    for name, samples in timings.items():
+        describe(name, samples)
+    print(f"{upstream.calls} upstream calls over {len(upstream.connections)} connections")
+
+
+if __name__ == "__main__":
+    main()
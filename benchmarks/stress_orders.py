@@ -0,0 +1,126 @@
+"""
+Fires many simultaneous buy and sell orders at a single account and checks that no update was lost.
+
+Every order is submitted twice with the same idempotency key, from different threads, to mimic a double submit.
+
+Runs against a throwaway sqlite file by default, --database-url points it at another database (e.g. a local postgres),
+the pool utilization and checkout wait times are printed at the end to help size DB_POOL_SIZE.
+
+Usage:
+    python benchmarks/stress_orders.py --threads 16 --orders 500
+    python benchmarks/stress_orders.py --database-url postgresql://localhost/market_stress
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--orders", type=int, default=500)
+    parser.add_argument("--balance", type=Decimal, default=Decimal(20_000))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--database-url", help="defaults to a new sqlite file in a temporary directory")
+    args = parser.parse_args()
+
+    from website import create_app, database, db, orders
+    from website.config import TestConfig
+    from website.ledger import check_positions
+    from website.models import User, Stock, Trade
+
+    database_url = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'stress.db')}"
+    app = create_app(TestConfig, SQLALCHEMY_DATABASE_URI=database_url, QUERY_BUDGET_ENFORCED=False)
+
+    with app.app_context():
+        db.create_all()
+        # unique names, so the script can run again against a database that is kept around
+        name = f"stress-{orders.new_idempotency_key()[:12]}"
+        user = User(username=name, phone_number=name, email_address=f"{name}@example.com", password="stress-password",
+                    balance=args.balance)
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+
+    order_random = random.Random(args.seed)
+    submissions = []
+    for _ in range(args.orders):
+        order = (order_random.choice(["buy", "sell"]), order_random.choice(["AAA", "BBB", "CCC"]),
+                 order_random.choice([1, 2, 5, 0.5, 0.1]), order_random.choice([10, 25.5, 99.99]), orders.new_idempotency_key())
+        submissions += [order, order]
+    order_random.shuffle(submissions)
+
+    outcomes = defaultdict(int)
+    outcomes_lock = threading.Lock()
+
+    def submit(order):
+        side, ticker, shares, price, key = order
+        with app.app_context():
+            try:
+                getattr(orders, side)(user_id, ticker, shares, price, idempotency_key=key)
+                outcome = "executed"
+            except orders.OrderError as error:
+                outcome = type(error).__name__
+        with outcomes_lock:
+            outcomes[outcome] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        list(executor.map(submit, submissions))
+    elapsed = time.perf_counter() - started
+
+    with app.app_context():
+        pool = database.pool_stats(db.engine)
+        user = db.session.get(User, user_id)
+        trades = Trade.query.filter_by(user_id=user_id).all()
+        positions = Stock.query.filter_by(user_id=user_id).all()
+
+        expected_balance = args.balance
+        expected_shares = defaultdict(Decimal)
+        for trade in trades:
+            sign = 1 if trade.side == "buy" else -1
+            expected_balance -= sign * trade.total
+            expected_shares[trade.ticker] += sign * trade.shares
+
+        failures = []
+        if user.balance < 0:
+            failures.append(f"negative balance {user.balance}")
+        if user.balance != expected_balance:
+            failures.append(f"balance {user.balance} != {expected_balance} replayed from the trades")
+        if len({trade.idempotency_key for trade in trades}) != len(trades):
+            failures.append("an idempotency key was executed more than once")
+        if len({position.ticker for position in positions}) != len(positions):
+            failures.append("duplicate positions for one ticker")
+        for position in positions:
+            if position.shares <= 0:
+                failures.append(f"non positive position {position}")
+        for ticker, shares in expected_shares.items():
+            held = sum((position.shares for position in positions if position.ticker == ticker), Decimal(0))
+            if abs(held - shares) > orders.SHARE_STEP:
+                failures.append(f"{ticker}: holding {held} shares but the trades add up to {shares}")
+        failures += check_positions(user_id)
+
+    print(f"{len(submissions)} submissions ({args.orders} distinct orders) in {elapsed:.2f}s, {len(submissions) / elapsed:.0f} orders/s")
+    print(f"trades executed: {len(trades)}, outcomes: {dict(outcomes)}, final balance: {user.balance}")
+    if pool is not None:
+        waits = ", ".join(f"{key} {pool[key] * 1000:.2f}ms" for key in ("wait_p50", "wait_p99", "wait_max") if pool[key] is not None)
+        print(f"pool: size {pool['size']}, peak checked out {pool['peak_checked_out']}, {pool['checkouts']} checkouts, "
+              f"{pool['timeouts']} timeouts, {waits}")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    print("OK" if not failures else f"{len(failures)} invariant(s) violated")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
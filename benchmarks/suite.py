@@ -0,0 +1,276 @@
+"""
+End to end and micro benchmarks of the auth and trading flows, with stored baselines and regression checks.
+
+The flows go through the real auth and views blueprints with a test client: register, login, the profile page with
+--holdings positions, the stock page, buy and sell. Market data comes from the replay provider, which answers every
+upstream call after --latency (plus up to --jitter) seconds; --cold clears the market data caches before every request.
+The micro benchmarks time the hot helpers on their own. Before any timing, benchmarks/stress_orders.py fires
+--stress-orders concurrent, double submitted buy and sell orders at one account, a violated order invariant (a negative
+balance or position, an order executed twice, positions that differ from the ledger) fails the run whatever the timings.
+
+Every benchmark reports its throughput and p50/p99 latency. --save-baseline stores the results, later runs are compared
+against the stored baseline and a benchmark whose p50 got more than --threshold slower is flagged as a regression (the
+exit code is then 1). Baselines only compare well on the machine they were recorded on.
+
+Usage:
+    python benchmarks/suite.py --save-baseline
+    python benchmarks/suite.py --holdings 50 --latency 0.1 --concurrency 4
+    python benchmarks/suite.py --only micro
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from typing import Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+STRESS_ORDERS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stress_orders.py")
+PASSWORD = "benchmark-password"
+
+
+def summarize(samples: List[float], elapsed: float) -> Dict[str, float]:
+    samples = sorted(samples)
+    return {"ops": len(samples) / elapsed if elapsed else 0.0, "p50": statistics.median(samples),
+            "p99": samples[min(len(samples) - 1, int(0.99 * len(samples)))], "n": len(samples)}
+
+
+def measure(run: Callable[[int, int], None], iterations: int, concurrency: int) -> Dict[str, float]:
+    """ calls run(worker, iteration) iterations times spread over concurrency threads and summarizes the latencies """
+
+    samples, lock = [], threading.Lock()
+
+    def work(worker):
+        for iteration in range(worker, iterations, concurrency):
+            started = time.perf_counter()
+            run(worker, iteration)
+            elapsed = time.perf_counter() - started
+            with lock:
+                samples.append(elapsed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(work, range(concurrency)))
+    return summarize(samples, time.perf_counter() - started)
+
+
+def measure_micro(func: Callable[[], None], repeats: int, number: int) -> Dict[str, float]:
+    """ times repeats batches of number calls and summarizes the latency of a single call """
+
+    func()
+    samples = []
+    started = time.perf_counter()
+    for _ in range(repeats):
+        batch_started = time.perf_counter()
+        for _ in range(number):
+            func()
+        samples.append((time.perf_counter() - batch_started) / number)
+    elapsed = time.perf_counter() - started
+    result = summarize(samples, elapsed)
+    result["ops"] = repeats * number / elapsed
+    return result
+
+
+def expect(response, *statuses):
+    if response.status_code not in statuses:
+        raise AssertionError(f"{response.request.method} {response.request.path} answered {response.status_code}, expected {statuses}")
+
+
+def run_flows(args) -> Dict[str, Dict[str, float]]:
+    from website import create_app, db, orders
+    from website.config import TestConfig
+    from website.models import User
+    from website.stock import bar_store
+    from website.stock.stock_models import company_name_cache, intraday_cache, price_cache
+
+    database = os.path.join(tempfile.mkdtemp(), "benchmark.db")
+    app = create_app(TestConfig, SQLALCHEMY_DATABASE_URI=f"sqlite:///{database}",
+                     MARKET_DATA_LATENCY=args.latency, MARKET_DATA_JITTER=args.jitter, BCRYPT_LOG_ROUNDS=args.bcrypt_rounds,
+                     PASSWORD_HASH_WORKERS=args.hash_workers, USER_CACHE_TTL=30)
+    with app.app_context():
+        db.create_all()
+
+    tickers = [chr(65 + index // 26 % 26) + chr(65 + index % 26) + "X" for index in range(args.holdings)] or ["AAX"]
+
+    def cold():
+        if args.cold:
+            for cache in (price_cache, intraday_cache, company_name_cache):
+                cache.invalidate()
+            bar_store.clear_memory()
+
+    # one logged in client and account per worker, holding every ticker
+    clients = []
+    for worker in range(args.concurrency):
+        client = app.test_client()
+        name = f"bench{worker}"
+        expect(client.post("/register", data=dict(username=name, phone_number=name, email_address=f"{name}@example.com",
+                                                  password1=PASSWORD, password2=PASSWORD)), 302)
+        with app.app_context():
+            user_id = User.query.filter_by(username=name).one().id
+            for ticker in tickers:
+                orders.buy(user_id, ticker, 10, 10, idempotency_key=orders.new_idempotency_key())
+        clients.append(client)
+
+    def register(worker, iteration):
+        name = f"new{worker}x{iteration}"
+        expect(app.test_client().post("/register", data=dict(username=name, phone_number=name, email_address=f"{name}@example.com",
+                                                             password1=PASSWORD, password2=PASSWORD)), 302)
+
+    def login(worker, iteration):
+        expect(app.test_client().post("/login", data=dict(username=f"bench{worker}", password=PASSWORD)), 302)
+
+    def profile(worker, iteration):
+        cold()
+        expect(clients[worker].get("/profile"), 200)
+
+    def stock_page(worker, iteration):
+        cold()
+        expect(clients[worker].get(f"/stock_page/{tickers[iteration % len(tickers)]}/100"), 200)
+
+    def trade(side):
+        def run(worker, iteration):
+            cold()
+            data = {"shares": 1, f"submit_{side}": "y", "idempotency_key": orders.new_idempotency_key()}
+            expect(clients[worker].post(f"/stock_page/{tickers[iteration % len(tickers)]}/100", data=data), 302)
+        return run
+
+    flows = {"register": (register, args.auth_iterations), "login": (login, args.auth_iterations),
+             "profile": (profile, args.iterations), "stock_page": (stock_page, args.iterations),
+             "buy": (trade("buy"), args.iterations), "sell": (trade("sell"), args.iterations)}
+    return {f"flow.{name}": measure(run, iterations, args.concurrency) for name, (run, iterations) in flows.items()}
+
+
+def run_micro(args) -> Dict[str, Dict[str, float]]:
+    import numpy as np
+
+    from website.stock.analytics import compute_analytics
+    from website.stock.bar_store import BarSeries
+    from website.stock.downsample import lttb
+    from website.stock.portfolio import compute_unrealized_pnl
+    from website.stock.quote_cache import QuoteCache
+    from website.stock.stock_models import convert_timestamps_to_datetime
+
+    timestamps = [datetime(2023, 1, 3) - timedelta(hours=index) for index in range(1000)]
+    positions = [SimpleNamespace(ticker=f"T{index}", shares=10.5, cost_basis=1000.0) for index in range(args.holdings)]
+    prices = {position.ticker: 101.25 for position in positions}
+    x = np.arange(10_000, dtype=float)
+    y = np.sin(x / 50) + np.random.default_rng(0).normal(0, 0.1, len(x))
+    # 60 trading days of hourly bars per held ticker, the tickers starting on different days
+    hours = np.arange("2023-01-02T09", "2023-03-31T16", dtype="datetime64[h]")
+    hours = hours[(hours - hours.astype("datetime64[D]")).astype(int) >= 9].astype("datetime64[s]")
+    rng = np.random.default_rng(1)
+    series = {}
+    for position in positions:
+        start = int(rng.integers(0, 50))
+        close = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, len(hours) - start)))
+        series[position.ticker] = BarSeries(hours[start:], close, close, close, close, np.zeros(len(close)))
+    shares = {position.ticker: position.shares for position in positions}
+    cache = QuoteCache("benchmark", ttl=60)
+    cache.set("AAPL", 101.25)
+
+    micro = {"convert_timestamps_to_datetime[1000]": (lambda: convert_timestamps_to_datetime(timestamps), 5),
+             f"compute_unrealized_pnl[{args.holdings}]": (lambda: compute_unrealized_pnl(positions, prices), 50),
+             f"compute_analytics[{args.holdings}]": (lambda: compute_analytics(shares, series), 5),
+             "lttb[10000->500]": (lambda: lttb(x, y, 500), 5),
+             "quote_cache.get_or_fetch[hit]": (lambda: cache.get_or_fetch("AAPL", lambda: 0.0), 1000)}
+    return {f"micro.{name}": measure_micro(func, args.micro_repeats, number) for name, (func, number) in micro.items()}
+
+
+def check_order_invariants(args) -> List[str]:
+    """ runs stress_orders.py and returns the invariants it found violated, its exit code is 1 when there are any """
+
+    if args.stress_orders <= 0:
+        return []
+    completed = subprocess.run([sys.executable, STRESS_ORDERS, "--orders", str(args.stress_orders), "--threads", str(args.stress_threads)],
+                               capture_output=True, text=True)
+    print(completed.stdout, end="")
+    if completed.returncode == 0:
+        return []
+    failures = [line[len("FAIL: "):] for line in completed.stdout.splitlines() if line.startswith("FAIL: ")]
+    return failures or [f"stress_orders.py exited with {completed.returncode}: {completed.stderr.strip().splitlines()[-1:]}"]
+
+
+def compare(results, baseline, threshold) -> List[str]:
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get("results", {}).get(name)
+        if previous and result["p50"] > previous["p50"] * (1 + threshold):
+            regressions.append(f"{name}: p50 {result['p50'] * 1000:.3f}ms vs {previous['p50'] * 1000:.3f}ms in the baseline "
+                               f"(+{(result['p50'] / previous['p50'] - 1) * 100:.0f}%)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", choices=["flows", "micro"])
+    parser.add_argument("--iterations", type=int, default=100, help="requests per page and order flow")
+    parser.add_argument("--auth-iterations", type=int, default=20, help="requests per register and login flow, they hash passwords")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--holdings", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds every upstream call takes")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--cold", action="store_true", help="clear the market data caches before every request")
+    parser.add_argument("--bcrypt-rounds", type=int, default=12)
+    parser.add_argument("--hash-workers", type=int, default=2)
+    parser.add_argument("--micro-repeats", type=int, default=200)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="the slowdown of the p50 that counts as a regression")
+    parser.add_argument("--stress-orders", type=int, default=200, help="distinct orders of the invariant check, 0 skips it")
+    parser.add_argument("--stress-threads", type=int, default=8)
+    args = parser.parse_args()
+
+    violations = check_order_invariants(args)
+    for violation in violations:
+        print(f"INVARIANT {violation}")
+    if violations:
+        print(f"{len(violations)} order invariant(s) violated, no benchmarks run")
+        return 1
+
+    results = {}
+    if args.only in (None, "flows"):
+        results.update(run_flows(args))
+    if args.only in (None, "micro"):
+        results.update(run_micro(args))
+
+    print(f"{'benchmark':<42} {'ops/s':>10} {'p50 ms':>10} {'p99 ms':>10}")
+    for name, result in results.items():
+        print(f"{name:<42} {result['ops']:>10.1f} {result['p50'] * 1000:>10.3f} {result['p99'] * 1000:>10.3f}")
+
+    settings = {key: value for key, value in vars(args).items() if key not in ("baseline", "save_baseline", "threshold", "stress_orders", "stress_threads")}
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump({"recorded_at": datetime.now().isoformat(timespec="seconds"), "python": platform.python_version(),
+                       "machine": platform.node(), "settings": settings, "results": results}, file, indent=2)
+        print(f"baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("no baseline to compare against, store one with --save-baseline")
+        return 0
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    if baseline.get("settings") != settings:
+        print("warning: the baseline was recorded with other settings, the comparison may be meaningless")
+
+    regressions = compare(results, baseline, args.threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    print("no regressions" if not regressions else f"{len(regressions)} regression(s) beyond {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
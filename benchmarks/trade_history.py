@@ -0,0 +1,82 @@
+"""
+Times the keyset paginated trade history and the ledger replay on a large ledger.
+
+The ledger is filled with --trades trades spread over --users users, then the first, a middle and the last page of one
+user's history are timed (they should cost the same), followed by a full rebuild of every position from the ledger.
+
+Usage:
+    python benchmarks/trade_history.py --trades 1000000 --users 100
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trades", type=int, default=200_000)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--tickers", type=int, default=50)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--database-url", help="defaults to a temporary sqlite file")
+    args = parser.parse_args()
+
+    from sqlalchemy import insert, select
+
+    from website import create_app, db, ledger
+    from website.config import TestConfig
+    from website.models import Stock, Trade, User
+
+    database_url = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'ledger.db')}"
+    app = create_app(TestConfig, SQLALCHEMY_DATABASE_URI=database_url)
+    with app.app_context():
+        db.create_all()
+        run = int(time.time())
+        db.session.execute(insert(User), [{"username": f"ledger{run}x{index}", "phone_number": f"ledger{run}x{index}",
+                                           "email_address": f"ledger{run}x{index}@example.com", "password_hash": "-"}
+                                          for index in range(args.users)])
+        user_ids = db.session.execute(select(User.id).where(User.username.like(f"ledger{run}x%"))).scalars().all()
+
+        started = time.perf_counter()
+        rng = random.Random(0)
+        for start in range(0, args.trades, 10_000):
+            rows = []
+            for index in range(start, min(start + 10_000, args.trades)):
+                # mostly buys, so the positions stay open and the sells never oversell
+                side = "buy" if rng.random() < 0.7 else "sell"
+                shares = Decimal(rng.randint(1, 10)) if side == "buy" else Decimal("0.5")
+                price = Decimal(rng.randint(1000, 50000)) / 100
+                rows.append({"user_id": rng.choice(user_ids), "idempotency_key": f"{run}-{index}", "ticker": f"T{rng.randrange(args.tickers)}",
+                             "side": side, "shares": shares, "price": price, "total": shares * price})
+            db.session.execute(insert(Trade), rows)
+        db.session.commit()
+        print(f"inserted {args.trades} trades in {time.perf_counter() - started:.1f}s")
+
+        user_id = user_ids[0]
+        total = db.session.query(Trade).filter_by(user_id=user_id).count()
+        cursors = {"first": None}
+        middle = db.session.execute(select(Trade.id).where(Trade.user_id == user_id).order_by(Trade.id.desc()).offset(total // 2).limit(1)).scalar()
+        last = db.session.execute(select(Trade.id).where(Trade.user_id == user_id).order_by(Trade.id).offset(args.page_size).limit(1)).scalar()
+        cursors.update(middle=middle, last=last)
+
+        for name, before in cursors.items():
+            started = time.perf_counter()
+            for _ in range(20):
+                page = ledger.trade_history(user_id, before=before, limit=args.page_size)
+            print(f"{name} page of {total} trades: {len(page.trades)} trades in {(time.perf_counter() - started) / 20 * 1000:.2f}ms")
+
+        started = time.perf_counter()
+        positions = ledger.rebuild_positions()
+        print(f"rebuilt {positions} positions from {args.trades} trades in {time.perf_counter() - started:.1f}s")
+        print(f"{db.session.query(Stock).count()} positions stored, {len(ledger.check_positions())} differ from the ledger")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Checks that the shared upstream quota holds across worker processes.
+
+Several processes call a fake upstream as fast as the quota lets them, half of them as user facing calls and half as
+background calls, all drawing from one token bucket file. The total number of calls must stay within the bucket's
+capacity plus what it refills during the run, and the background calls must leave their reserve to the users.
+
+Usage:
+    python benchmarks/upstream_quota.py --processes 8 --per-minute 120 --seconds 10
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def hammer(path, per_minute, reserve, seconds, priority_class, results):
+    from website.stock import upstream
+
+    client = upstream.UpstreamClient(store=upstream.QuotaStore(path, {"minute": (per_minute, 60.0)}), max_wait=0.5,
+                                     background_reserve=reserve)
+    calls = throttled = 0
+    deadline = time.time() + seconds
+    with upstream.priority(priority_class):
+        while time.time() < deadline:
+            try:
+                client.call(lambda: None)
+                calls += 1
+            except upstream.UpstreamThrottledError as error:
+                throttled += 1
+                time.sleep(min(error.retry_after or 0.05, 0.05))
+    results.put((priority_class, calls, throttled))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--per-minute", type=float, default=120)
+    parser.add_argument("--reserve", type=float, default=0.4)
+    parser.add_argument("--seconds", type=float, default=10)
+    args = parser.parse_args()
+
+    from website.stock import upstream
+
+    path = os.path.join(tempfile.mkdtemp(), "quota.sqlite")
+    results = multiprocessing.Queue()
+    classes = [upstream.USER if index % 2 == 0 else upstream.BACKGROUND for index in range(args.processes)]
+    started = time.time()
+    workers = [multiprocessing.Process(target=hammer, args=(path, args.per_minute, args.reserve, args.seconds, priority_class, results))
+               for priority_class in classes]
+    for worker in workers:
+        worker.start()
+    outcomes = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - started
+
+    calls = {priority_class: sum(outcome[1] for outcome in outcomes if outcome[0] == priority_class) for priority_class in set(classes)}
+    throttled = sum(outcome[2] for outcome in outcomes)
+    allowed = args.per_minute + args.per_minute / 60 * elapsed
+
+    print(f"{args.processes} processes for {elapsed:.1f}s against {args.per_minute:.0f} calls per minute")
+    print(f"calls: {calls}, throttled attempts: {throttled}, the quota allows at most {allowed:.0f}")
+
+    failures = []
+    if sum(calls.values()) > allowed:
+        failures.append(f"{sum(calls.values())} calls went through, more than the {allowed:.0f} the quota allows")
+    if upstream.BACKGROUND in calls and calls[upstream.BACKGROUND] > (1 - args.reserve) * args.per_minute + args.per_minute / 60 * elapsed:
+        failures.append("background calls spent the users' reserve")
+    if upstream.USER in calls and calls[upstream.USER] == 0:
+        failures.append("no user facing call got through")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    print("OK" if not failures else f"{len(failures)} check(s) failed")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
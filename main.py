@@ -1,4 +1,6 @@
-from website import app
+from website import create_app
+
+app = create_app()
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", debug=True, port=(8080))
\ No newline at end of file
@@ -1,37 +1,96 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask import Flask
-from flask_bcrypt import Bcrypt
 from flask_login import LoginManager
-from dotenv import load_dotenv
-import os
+from website.config import Config
 
 
+db = SQLAlchemy()
 
-load_dotenv()
-secret_key = os.getenv("secret_key")
+login_manager = LoginManager()
+login_manager.login_view = "auth.login_page"
+login_manager.login_message_category = "info"
 
-app = Flask(__name__, template_folder="/Users/sindri/Desktop/flask-website/website/templates")
-app.config["SECRET_KEY"] = secret_key
-app.config["SQLALCHEMY_DATABASE_URI"] = 'sqlite:///market.db'
 
-db = SQLAlchemy(app)
-bcrypt = Bcrypt(app)
+def create_app(config=None, **overrides) -> Flask:
+    """
+    Builds a new application.
 
-login_manager = LoginManager(app)
-login_manager.login_view = "auth.login_page"
-login_manager.login_message_category = "info"
+    Parameters:
+        config: A config class or object (like website.config.TestConfig), or a mapping of values
+            that override the defaults in website.config.Config.
+        overrides: Single config values applied last, e.g. SQLALCHEMY_DATABASE_URI="sqlite:///other.db".
+
+    Returns:
+        Flask: The application, with the auth and views blueprints registered.
+    """
+
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    if isinstance(config, dict):
+        app.config.update(config)
+    elif config is not None:
+        app.config.from_object(config)
+    app.config.update(overrides)
+
+    from website import database
+    database.configure(app)
+    db.init_app(app)
+    database.init_app(app)
+    login_manager.init_app(app)
+
+    from website.stock import providers
+    providers.init_app(app)
+
+    from website.stock import symbols
+    symbols.init_app(app)
+
+    from website import passwords
+    passwords.init_app(app)
+
+    from website import user_cache
+    user_cache.init_app(app)
+
+    from website import migrations
+    migrations.init_app(app)
+
+    from website import ledger
+    ledger.init_app(app)
+
+    from website.stock import fundamentals
+    fundamentals.init_app(app)
+
+    from website.stock import price_stream
+    price_stream.init_app(app)
+
+    from website import metrics
+    metrics.init_app(app)
+
+    from website import assets
+    assets.init_app(app)
+
+    from .auth import auth
+    app.register_blueprint(auth, url_prefix="/")
+
+    from .views import views
+    app.register_blueprint(views, url_prefix="/")
+
+    if app.config["PRELOAD_MARKET_DATA"] or app.config["PRICE_INGESTION_ENABLED"]:
+        preload_market_data()
+
+    from website.stock import ingestion
+    ingestion.init_app(app)
 
+    return app
 
-app.app_context().push()
 
-from .auth import auth
-app.register_blueprint(auth, url_prefix="/")
+def preload_market_data():
+    """ imports the market data stack (numpy, pandas and the modules built on them), which is otherwise imported on first use """
 
-from .views import views
-app.register_blueprint(views, url_prefix="/")
+    import pandas  # noqa: F401 (alpha_vantage imports it on its first request)
+    from website.stock import bar_store, downsample, ingestion, portfolio  # noqa: F401
 
 
-from website.models import User
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
\ No newline at end of file
+    from website import user_cache
+    return user_cache.load_user(int(user_id))
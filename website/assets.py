@@ -0,0 +1,215 @@
+import gzip
+import hashlib
+import io
+import json
+import logging
+import mimetypes
+import os
+from typing import Dict, List, Tuple
+
+import click
+from flask import abort, current_app, request, send_from_directory, url_for
+
+logger = logging.getLogger(__name__)
+
+# assets that compress well get .gz and .br siblings, served to clients that accept them
+COMPRESSIBLE = {".css", ".js", ".svg", ".json", ".txt", ".html", ".map"}
+IMAGES = {".jpg", ".jpeg", ".png"}
+
+# the formats the large images are converted to, best first, each only if the installed Pillow can write it
+IMAGE_FORMATS = (("avif", "AVIF", {"quality": 55}), ("webp", "WEBP", {"quality": 80, "method": 6}), ("jpeg", "JPEG", {"quality": 82, "progressive": True, "optimize": True}))
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+def fingerprint(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+
+def _write(path: str, data: bytes):
+    # written next to the target and renamed over it, so a build running while the site serves never exposes a partial file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temporary, "wb") as file:
+            file.write(data)
+        os.replace(temporary, path)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+def _precompress(path: str, data: bytes):
+    variants = {".gz": lambda: gzip.compress(data, compresslevel=9, mtime=0)}
+    try:
+        import brotli
+        variants[".br"] = lambda: brotli.compress(data, quality=11)
+    except ImportError:
+        pass
+
+    for suffix, compress in variants.items():
+        if not os.path.exists(path + suffix):
+            compressed = compress()
+            if len(compressed) < len(data):
+                _write(path + suffix, compressed)
+
+
+def _image_variants(source: str, output_dir: str, logical: str, digest: str, widths: List[int]) -> List[Dict]:
+    """ writes resized copies of the image in every supported format and returns them, smallest first within each format """
+
+    try:
+        from PIL import Image
+    except ImportError:
+        logger.warning("Pillow is not installed, %s is served without resized variants", logical)
+        return []
+
+    Image.init()
+    stem, _ = os.path.splitext(logical)
+    variants, image = [], None
+    for name, pillow_format, options in IMAGE_FORMATS:
+        if pillow_format not in Image.SAVE:
+            continue
+        for width in widths:
+            path = f"{stem}.{digest}.w{width}.{name}"
+            if not os.path.exists(os.path.join(output_dir, path)):
+                if image is None:
+                    image = Image.open(source)
+                    image.load()
+                if width > image.width:
+                    continue
+                resized = image.convert("RGB").resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+                encoded = io.BytesIO()
+                resized.save(encoded, format=pillow_format, **options)
+                _write(os.path.join(output_dir, path), encoded.getvalue())
+            variants.append({"path": path, "width": width, "type": f"image/{name}"})
+    return variants
+
+
+def build(source_dir: str, output_dir: str, image_widths: List[int] = (640, 1280, 1920), image_min_bytes: int = 100_000) -> Dict:
+    """
+    Copies every static file to output_dir under a name that contains a hash of its content.
+
+    Text assets get gzip and brotli compressed siblings, images larger than image_min_bytes get resized variants in modern
+    formats. Files whose hashed name already exists are not written again, so a rebuild only costs hashing the sources.
+
+    Returns:
+        Dict: The manifest, mapping every logical path ("styles/base.css") to its hashed path and every large image to its variants.
+    """
+
+    manifest = {"files": {}, "images": {}}
+    output_dir = os.path.abspath(output_dir)
+    for directory, subdirectories, filenames in os.walk(source_dir):
+        subdirectories[:] = [name for name in subdirectories if os.path.abspath(os.path.join(directory, name)) != output_dir]
+        for filename in sorted(filenames):
+            source = os.path.join(directory, filename)
+            logical = os.path.relpath(source, source_dir).replace(os.sep, "/")
+            stem, extension = os.path.splitext(logical)
+            digest = fingerprint(source)
+            hashed = f"{stem}.{digest}{extension}"
+            target = os.path.join(output_dir, hashed)
+
+            data = None
+            if not os.path.exists(target):
+                with open(source, "rb") as file:
+                    data = file.read()
+                _write(target, data)
+            if extension.lower() in COMPRESSIBLE:
+                if data is None:
+                    with open(source, "rb") as file:
+                        data = file.read()
+                _precompress(target, data)
+            if extension.lower() in IMAGES and os.path.getsize(source) >= image_min_bytes:
+                manifest["images"][logical] = _image_variants(source, output_dir, logical, digest, list(image_widths))
+
+            manifest["files"][logical] = hashed
+
+    _write(os.path.join(output_dir, "manifest.json"), json.dumps(manifest, indent=2, sort_keys=True).encode())
+    return manifest
+
+
+def assets_dir(app) -> str:
+    return app.config["ASSETS_OUTPUT_DIR"] or os.path.join(app.instance_path, "assets")
+
+
+def load_manifest(output_dir: str) -> Dict:
+    try:
+        with open(os.path.join(output_dir, "manifest.json")) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {"files": {}, "images": {}}
+
+
+def asset_url(filename: str) -> str:
+    """ returns the fingerprinted url of a static file, or its plain static url if the pipeline does not know it """
+
+    hashed = current_app.extensions.get("assets", {}).get("files", {}).get(filename)
+    if hashed is None:
+        return url_for("static", filename=filename)
+    return url_for("assets", filename=hashed)
+
+
+def image_sources(filename: str) -> List[Tuple[str, str]]:
+    """ returns (type, srcset) of every format the image has resized variants in, for the <source> tags of a <picture> """
+
+    sources = {}
+    for variant in current_app.extensions.get("assets", {}).get("images", {}).get(filename, []):
+        sources.setdefault(variant["type"], []).append(f"{url_for('assets', filename=variant['path'])} {variant['width']}w")
+    return [(content_type, ", ".join(srcset)) for content_type, srcset in sources.items()]
+
+
+def serve_asset(filename: str):
+    """ serves a fingerprinted file, precompressed if the client accepts it, cached for a year since its name changes with its content """
+
+    if filename.endswith((".gz", ".br", ".tmp")) or filename == "manifest.json":
+        abort(404)
+
+    directory = assets_dir(current_app)
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    served, encoding = filename, None
+    for candidate, suffix in (("br", ".br"), ("gzip", ".gz")):
+        if candidate in request.accept_encodings and os.path.exists(os.path.join(directory, filename + suffix)):
+            served, encoding = filename + suffix, candidate
+            break
+
+    response = send_from_directory(directory, served, mimetype=mimetype, max_age=365 * 24 * 60 * 60)
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+    if os.path.splitext(filename)[1].lower() in COMPRESSIBLE:
+        response.vary.add("Accept-Encoding")
+    response.headers["Cache-Control"] = IMMUTABLE
+    return response
+
+
+@click.command("build-assets")
+def build_assets_command():
+    """ Fingerprint, precompress and resize the static files. """
+
+    manifest = build(current_app.static_folder, assets_dir(current_app), current_app.config["ASSET_IMAGE_WIDTHS"])
+    current_app.extensions["assets"] = manifest
+    click.echo(f"Built {len(manifest['files'])} assets and {sum(len(variants) for variants in manifest['images'].values())} image variants")
+
+
+def init_app(app):
+    """
+    Loads the manifest of the last `flask build-assets`, or builds the assets if ASSETS_BUILD_ON_STARTUP is set, and serves
+    them on ASSETS_URL_PATH, if ASSETS_ENABLED is set. Without a manifest the templates link the plain static files.
+    """
+
+    app.cli.add_command(build_assets_command)
+    app.jinja_env.globals.update(asset_url=asset_url, image_sources=image_sources)
+    if not app.config["ASSETS_ENABLED"]:
+        return
+
+    output_dir = assets_dir(app)
+    if app.config["ASSETS_BUILD_ON_STARTUP"]:
+        try:
+            app.extensions["assets"] = build(app.static_folder, output_dir, app.config["ASSET_IMAGE_WIDTHS"])
+        except OSError:
+            logger.exception("Could not build the static assets into %s, serving them unversioned", output_dir)
+    else:
+        app.extensions["assets"] = load_manifest(output_dir)
+    app.add_url_rule(f"{app.config['ASSETS_URL_PATH']}/<path:filename>", "assets", serve_asset)
@@ -2,7 +2,8 @@ from flask import render_template, Blueprint, url_for, redirect, flash
 from flask_login import login_required, login_user, logout_user
 from website.forms import LoginForm, RegisterForm
 from website.models import User
-from website import db
+from website import db, user_cache
+from website.passwords import PasswordHasherBusy
 
 auth = Blueprint("auth", __name__)
 
@@ -22,8 +23,16 @@ def login_page():
     form = LoginForm()
     if form.validate_on_submit():
         attempted_user = User.query.filter_by(username=form.username.data).first()
-        if attempted_user and attempted_user.check_password_correction(attempted_password=form.password.data):
-
+        try:
+            password_correct = attempted_user is not None and attempted_user.check_password_correction(attempted_password=form.password.data)
+        except PasswordHasherBusy as error:
+            flash(message=str(error), category="danger")
+            return render_template("login.html", form=form), 503
+
+        if password_correct:
+            # commits the new hash if the password was rehashed with a changed work factor
+            db.session.commit()
+            user_cache.invalidate(attempted_user.id)
             login_user(attempted_user)
             flash(message=f"You successfully logged in as: {attempted_user.username}", category="success")
 
@@ -49,11 +58,15 @@ def register_page():
     """
     form = RegisterForm()
     if form.validate_on_submit():
-        user_to_create = User(
-            username=form.username.data,
-            phone_number=form.phone_number.data,
-            email_address=form.email_address.data,
-            password=form.password1.data)
+        try:
+            user_to_create = User(
+                username=form.username.data,
+                phone_number=form.phone_number.data,
+                email_address=form.email_address.data,
+                password=form.password1.data)
+        except PasswordHasherBusy as error:
+            flash(message=str(error), category="danger")
+            return render_template("register.html", form=form), 503
         
         db.session.add(user_to_create)
         db.session.commit()
@@ -0,0 +1,139 @@
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+class Config:
+    """
+    The default configuration, every value can be overridden through an environment variable of the same name
+    (or through the mapping given to create_app).
+    """
+
+    SECRET_KEY = os.getenv("secret_key")
+    SQLALCHEMY_DATABASE_URI = os.getenv("DATABASE_URL", "sqlite:///market.db")
+
+    # connection pool, used for sqlite files and postgres alike (an in-memory sqlite database keeps a single connection)
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+    DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+    DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10))
+    DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 30 * 60))
+    DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
+    # WAL lets readers carry on while an order is written, busy_timeout makes writers wait for the lock instead of failing
+    SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+    SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+    SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000))
+
+    # market data
+    MARKET_DATA_PROVIDER = os.getenv("MARKET_DATA_PROVIDER", "alpha_vantage")
+    ALPHA_VANTAGE_API_KEY = os.getenv("API_KEY")
+    ALPHA_VANTAGE_URL = os.getenv("ALPHA_VANTAGE_URL", "https://www.alphavantage.co/query")
+    # the upstream quota is shared by every worker process of the host through a small sqlite file
+    # (UPSTREAM_QUOTA_PATH, the instance folder by default), the defaults match the free Alpha Vantage plan
+    UPSTREAM_QUOTA_ENABLED = os.getenv("UPSTREAM_QUOTA_ENABLED", "1") == "1"
+    UPSTREAM_QUOTA_PATH = os.getenv("UPSTREAM_QUOTA_PATH")
+    UPSTREAM_CALLS_PER_MINUTE = float(os.getenv("UPSTREAM_CALLS_PER_MINUTE", 5))
+    UPSTREAM_CALLS_PER_DAY = float(os.getenv("UPSTREAM_CALLS_PER_DAY", 25))
+    UPSTREAM_BACKGROUND_RESERVE = float(os.getenv("UPSTREAM_BACKGROUND_RESERVE", 0.4))
+    UPSTREAM_MAX_WAIT = float(os.getenv("UPSTREAM_MAX_WAIT", 2))
+    UPSTREAM_MAX_ATTEMPTS = int(os.getenv("UPSTREAM_MAX_ATTEMPTS", 3))
+    UPSTREAM_BACKOFF = float(os.getenv("UPSTREAM_BACKOFF", 0.5))
+    UPSTREAM_BREAKER_THRESHOLD = int(os.getenv("UPSTREAM_BREAKER_THRESHOLD", 5))
+    UPSTREAM_BREAKER_RESET = float(os.getenv("UPSTREAM_BREAKER_RESET", 30))
+    # the async market data calls share one keep-alive session per process
+    MARKET_DATA_HTTP_CONNECTIONS = int(os.getenv("MARKET_DATA_HTTP_CONNECTIONS", 16))
+    MARKET_DATA_HTTP_TIMEOUT = float(os.getenv("MARKET_DATA_HTTP_TIMEOUT", 10))
+    MARKET_DATA_REPLAY_DIR = os.getenv("MARKET_DATA_REPLAY_DIR")
+    MARKET_DATA_LATENCY = float(os.getenv("MARKET_DATA_LATENCY", 0))
+    MARKET_DATA_JITTER = float(os.getenv("MARKET_DATA_JITTER", 0))
+    MARKET_DATA_ERROR_RATE = float(os.getenv("MARKET_DATA_ERROR_RATE", 0))
+    # import pandas, numpy and the market data modules while the app is created instead of on first use,
+    # for servers that create the app once and fork the workers from it (gunicorn --preload)
+    PRELOAD_MARKET_DATA = os.getenv("PRELOAD_MARKET_DATA", "0") == "1"
+
+    QUOTE_FETCH_WORKERS = int(os.getenv("QUOTE_FETCH_WORKERS", 8))
+    QUOTE_FETCH_TIMEOUT = float(os.getenv("QUOTE_FETCH_TIMEOUT", 5))
+    QUOTE_MAX_AGE = float(os.getenv("QUOTE_MAX_AGE", 120))
+    INTRADAY_MAX_AGE = float(os.getenv("INTRADAY_MAX_AGE", 60 * 60))
+
+    PRICE_INGESTION_ENABLED = os.getenv("PRICE_INGESTION_ENABLED", "0") == "1"
+    PRICE_INGESTION_INTERVAL = float(os.getenv("PRICE_INGESTION_INTERVAL", 60))
+    PRICE_INGESTION_CALL_BUDGET = int(os.getenv("PRICE_INGESTION_CALL_BUDGET", 5))
+    PRICE_INGESTION_LOCK_PATH = os.getenv("PRICE_INGESTION_LOCK_PATH")  # defaults to price_ingestion.lock in the instance folder
+
+    CHART_DEFAULT_POINTS = 500
+    CHART_MAX_POINTS = 5000
+    CHART_MAX_AGE = 60
+
+    # the symbol index answers ticker search, validation and company names from a local listing file, which is reloaded when it changes
+    SYMBOL_INDEX_ENABLED = os.getenv("SYMBOL_INDEX_ENABLED", "1") == "1"
+    SYMBOL_LISTING_PATH = os.getenv("SYMBOL_LISTING_PATH")  # defaults to listing_status.csv in the instance folder
+    SYMBOL_RELOAD_INTERVAL = float(os.getenv("SYMBOL_RELOAD_INTERVAL", 5 * 60))
+    SYMBOL_SEARCH_LIMIT = 10
+
+    # live prices over server-sent events, every worker polls each subscribed ticker once per interval for all of its streams
+    PRICE_STREAM_INTERVAL = float(os.getenv("PRICE_STREAM_INTERVAL", 15))
+    PRICE_STREAM_HEARTBEAT = float(os.getenv("PRICE_STREAM_HEARTBEAT", 15))
+    PRICE_STREAM_MAX_SUBSCRIBERS = int(os.getenv("PRICE_STREAM_MAX_SUBSCRIBERS", 40))
+    # an open stream holds one of the WEB_THREADS request threads of its worker (gunicorn --threads), so the streams are capped
+    # at startup to leave PRICE_STREAM_RESERVED_THREADS of them to the pages. 0 is for gevent or eventlet workers, where a
+    # stream holds no thread and only PRICE_STREAM_MAX_SUBSCRIBERS applies
+    WEB_THREADS = int(os.getenv("WEB_THREADS", 50))
+    PRICE_STREAM_RESERVED_THREADS = int(os.getenv("PRICE_STREAM_RESERVED_THREADS", 10))
+    PRICE_STREAM_MAX_TICKERS = 50
+
+    # static files are copied under content hashed names, precompressed and served with a year long immutable Cache-Control
+    ASSETS_ENABLED = os.getenv("ASSETS_ENABLED", "1") == "1"
+    # `flask build-assets` is the deploy step, every worker only loads its manifest, building at startup is for development
+    ASSETS_BUILD_ON_STARTUP = os.getenv("ASSETS_BUILD_ON_STARTUP", "0") == "1"
+    ASSETS_OUTPUT_DIR = os.getenv("ASSETS_OUTPUT_DIR")  # defaults to the assets folder in the instance folder
+    ASSETS_URL_PATH = "/assets"
+    ASSET_IMAGE_WIDTHS = (640, 1280, 1920)
+
+    # balance sheets and cash flows are kept by (ticker, fiscal period), a ticker is only fetched again once a newer period
+    # can have been reported, and at most once per recheck interval while that report is late
+    FUNDAMENTALS_FILING_LAG_DAYS = int(os.getenv("FUNDAMENTALS_FILING_LAG_DAYS", 45))
+    FUNDAMENTALS_RECHECK_DAYS = int(os.getenv("FUNDAMENTALS_RECHECK_DAYS", 7))
+    FUNDAMENTALS_MAX_TICKERS = 100
+
+    TRADE_HISTORY_PAGE_SIZE = 50
+    TRADE_HISTORY_MAX_PAGE_SIZE = 500
+
+    # passwords
+    BCRYPT_LOG_ROUNDS = int(os.getenv("BCRYPT_LOG_ROUNDS", 12))
+    PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", 2))
+    PASSWORD_HASH_QUEUE_DEPTH = int(os.getenv("PASSWORD_HASH_QUEUE_DEPTH", 32))
+    PASSWORD_HASH_TIMEOUT = float(os.getenv("PASSWORD_HASH_TIMEOUT", 10))
+
+    USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 30))
+    USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 4096))
+
+    QUERY_BUDGET_ENFORCED = os.getenv("QUERY_BUDGET_ENFORCED", "0") == "1"
+
+    # per request timings (Server-Timing header) and the Prometheus metrics of the process, which are only served behind
+    # a bearer token, or without one when METRICS_PUBLIC is set for a server only reachable from the internal network
+    METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+    METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+    METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+    METRICS_PUBLIC = os.getenv("METRICS_PUBLIC", "0") == "1"
+
+
+class TestConfig(Config):
+    """ an isolated in-memory app with offline market data, fast password hashing and strict query budgets """
+
+    TESTING = True
+    SECRET_KEY = "test"
+    SQLALCHEMY_DATABASE_URI = "sqlite://"
+    WTF_CSRF_ENABLED = False
+    MARKET_DATA_PROVIDER = "replay"
+    UPSTREAM_QUOTA_ENABLED = False
+    MARKET_DATA_LATENCY = 0.0
+    MARKET_DATA_JITTER = 0.0
+    MARKET_DATA_ERROR_RATE = 0.0
+    PRICE_INGESTION_ENABLED = False
+    SYMBOL_INDEX_ENABLED = False
+    ASSETS_ENABLED = False
+    BCRYPT_LOG_ROUNDS = 4
+    PASSWORD_HASH_WORKERS = 0
+    USER_CACHE_TTL = 0
+    QUERY_BUDGET_ENFORCED = True
@@ -0,0 +1,131 @@
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+from website import db
+
+
+class InstrumentedQueuePool(QueuePool):
+    """ a QueuePool that records how long every checkout waited for a free connection """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self._waits = deque(maxlen=1024)
+        self._checkouts = 0
+        self._timeouts = 0
+        self._peak_checked_out = 0
+
+    def recreate(self):
+        # pre-ping and invalidation recreate the pool, the counters carry over
+        pool = super().recreate()
+        pool._waits, pool._checkouts, pool._timeouts = self._waits, self._checkouts, self._timeouts
+        pool._peak_checked_out = self._peak_checked_out
+        return pool
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except Exception:
+            with self._stats_lock:
+                self._timeouts += 1
+            raise
+
+        with self._stats_lock:
+            self._checkouts += 1
+            self._waits.append(time.perf_counter() - started)
+            self._peak_checked_out = max(self._peak_checked_out, self.checkedout())
+        return connection
+
+    def stats(self) -> Dict[str, Optional[float]]:
+        """ returns the pool size and utilization, and the p50, p99 and max checkout wait in seconds """
+
+        with self._stats_lock:
+            waits = sorted(self._waits)
+            stats = {"size": self.size(), "checked_out": self.checkedout(), "overflow": self.overflow(),
+                     "peak_checked_out": self._peak_checked_out, "checkouts": self._checkouts, "timeouts": self._timeouts}
+
+        def percentile(share):
+            return waits[min(len(waits) - 1, int(share * len(waits)))] if waits else None
+
+        stats.update(wait_p50=percentile(0.5), wait_p99=percentile(0.99), wait_max=waits[-1] if waits else None)
+        return stats
+
+
+def normalize_database_url(url: str) -> str:
+    """ accepts the postgres:// scheme many hosts hand out, sqlalchemy only knows postgresql:// """
+
+    if url.startswith("postgres://"):
+        return "postgresql://" + url[len("postgres://"):]
+    return url
+
+
+def _is_sqlite_memory(url) -> bool:
+    return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+
+
+def engine_options(config) -> dict:
+    """ builds SQLALCHEMY_ENGINE_OPTIONS from the DB_* config values """
+
+    url = make_url(config["SQLALCHEMY_DATABASE_URI"])
+    options = dict(config.get("SQLALCHEMY_ENGINE_OPTIONS") or {})
+
+    # an in-memory sqlite database lives in a single connection, flask-sqlalchemy gives it a StaticPool
+    if _is_sqlite_memory(url):
+        return options
+
+    options.setdefault("poolclass", InstrumentedQueuePool)
+    options.setdefault("pool_size", config["DB_POOL_SIZE"])
+    options.setdefault("max_overflow", config["DB_MAX_OVERFLOW"])
+    options.setdefault("pool_timeout", config["DB_POOL_TIMEOUT"])
+    options.setdefault("pool_recycle", config["DB_POOL_RECYCLE"])
+    options.setdefault("pool_pre_ping", config["DB_POOL_PRE_PING"])
+
+    if url.get_backend_name() == "sqlite":
+        # connections are handed between the request threads by the pool, never used by two at once
+        options.setdefault("connect_args", {}).setdefault("check_same_thread", False)
+    return options
+
+
+def _set_sqlite_pragmas(config):
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # WAL is stored in the database file, switching it again takes a lock while other connections are writing
+        cursor.execute("PRAGMA journal_mode")
+        if cursor.fetchone()[0].upper() != config["SQLITE_JOURNAL_MODE"].upper():
+            cursor.execute(f"PRAGMA journal_mode={config['SQLITE_JOURNAL_MODE']}")
+        cursor.execute(f"PRAGMA synchronous={config['SQLITE_SYNCHRONOUS']}")
+        cursor.execute(f"PRAGMA busy_timeout={int(config['SQLITE_BUSY_TIMEOUT_MS'])}")
+        cursor.close()
+
+    return on_connect
+
+
+def configure(app):
+    """ prepares the database url and engine options, call it before db.init_app """
+
+    app.config["SQLALCHEMY_DATABASE_URI"] = normalize_database_url(app.config["SQLALCHEMY_DATABASE_URI"])
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config)
+
+
+def init_app(app):
+    """ applies the sqlite pragmas (WAL, busy timeout, synchronous) to every new connection, call it after db.init_app """
+
+    with app.app_context():
+        engine = db.engine
+    if engine.url.get_backend_name() == "sqlite" and not _is_sqlite_memory(engine.url):
+        event.listen(engine, "connect", _set_sqlite_pragmas(app.config))
+
+
+def pool_stats(engine) -> Optional[Dict[str, Optional[float]]]:
+    """ returns the utilization and wait time stats of the engine's pool, or None if it is not instrumented """
+
+    if isinstance(engine.pool, InstrumentedQueuePool):
+        return engine.pool.stats()
+    return None
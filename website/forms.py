@@ -1,8 +1,9 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, SubmitField, FloatField
+from wtforms import StringField, PasswordField, SubmitField, FloatField, HiddenField
 from wtforms.validators import Length, EqualTo, Email, DataRequired, ValidationError
 from website.models import User
 from string import punctuation
+from uuid import uuid4
 
 class RegisterForm(FlaskForm):
     """
@@ -79,10 +80,12 @@ class PurchaseStockForm(FlaskForm):
 
     Attributes:
         shares (FloatField): The number of shares to purchase.
+        idempotency_key (HiddenField): A key unique to each rendered form, so a resubmitted order is only executed once.
         submit (SubmitField): The button to submit the form.
     """
 
     shares = FloatField(label="Shares: ", validators=[DataRequired()])
+    idempotency_key = HiddenField(default=lambda: uuid4().hex)
     submit_buy = SubmitField(label="Purchase stock!")
 
 
@@ -93,8 +96,10 @@ class SellStockForm(FlaskForm):
     Attributes:
         stock_ticker (StringField): The stock ticker to sell.
         shares (FloatField): The number of shares to sell.
+        idempotency_key (HiddenField): A key unique to each rendered form, so a resubmitted order is only executed once.
         submit (SubmitField): The button to submit the form.
     """
 
     shares = FloatField(label="Shares: ", validators=[DataRequired()])
+    idempotency_key = HiddenField(default=lambda: uuid4().hex)
     submit_sell = SubmitField(label="Sell stock!")
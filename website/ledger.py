@@ -0,0 +1,170 @@
+from collections import namedtuple
+from decimal import Decimal
+from itertools import groupby
+from typing import Iterable, Iterator, List, Optional
+
+import click
+from sqlalchemy import delete, exists, insert, select
+
+from website import db, user_cache
+from website.models import Stock, Trade
+from website.orders import SHARE_TOLERANCE, to_money, to_shares
+
+TradePage = namedtuple("TradePage", ["trades", "next_before"])
+
+Position = namedtuple("Position", ["user_id", "ticker", "shares", "cost_basis", "average_price", "date"])
+
+_LEDGER_COLUMNS = (Trade.user_id, Trade.ticker, Trade.side, Trade.shares, Trade.total, Trade.executed_at)
+
+
+class UnrecordedPositionsError(Exception):
+    """ raised when stored positions have no buy in the ledger, rebuilding would delete them """
+
+
+def trade_history(user_id: int, before: Optional[int] = None, limit: int = 50, stock_ticker: Optional[str] = None) -> TradePage:
+    """
+    Returns a page of the user's trades, newest first.
+
+    The page is found by seeking the (user_id, id) index to the before cursor instead of skipping rows with an OFFSET, so
+    every page costs the same no matter how deep into the history it is.
+
+    Parameters:
+        user_id (int): The ID of the user.
+        before (int): The next_before cursor of the previous page, None for the newest trades.
+        limit (int): The maximum number of trades on the page.
+        stock_ticker (str): Only return the trades of this ticker, if given.
+
+    Returns:
+        TradePage: The trades and the cursor of the next page, which is None on the last page.
+    """
+
+    query = select(Trade).where(Trade.user_id == user_id).order_by(Trade.id.desc()).limit(limit + 1)
+    if before is not None:
+        query = query.where(Trade.id < before)
+    if stock_ticker is not None:
+        query = query.where(Trade.ticker == stock_ticker.upper())
+
+    trades = db.session.execute(query).scalars().all()
+    if len(trades) > limit:
+        return TradePage(trades[:limit], trades[limit - 1].id)
+    return TradePage(trades, None)
+
+
+def replay(rows: Iterable) -> Iterator[Position]:
+    """
+    Replays ledger rows the way orders.buy and orders.sell apply them and yields the open positions.
+
+    Parameters:
+        rows (Iterable): (user_id, ticker, side, shares, total, executed_at) rows ordered by user, ticker and trade id.
+
+    Returns:
+        Iterator[Position]: Every position that still holds shares after its last trade.
+    """
+
+    for (user_id, ticker), trades in groupby(rows, key=lambda row: (row[0], row[1])):
+        shares, cost_basis, opened_at = Decimal(0), Decimal(0), None
+        for _, _, side, traded, total, executed_at in trades:
+            traded, total = Decimal(str(traded)), Decimal(str(total))
+            if side == "buy":
+                shares, cost_basis = shares + traded, cost_basis + total
+                opened_at = opened_at or executed_at
+            elif shares > 0:
+                cost_basis -= cost_basis / shares * min(traded, shares)
+                shares -= traded
+
+            if shares <= SHARE_TOLERANCE:
+                shares, cost_basis, opened_at = Decimal(0), Decimal(0), None
+
+        if shares > 0:
+            yield Position(user_id, ticker, to_shares(shares), to_money(cost_basis), to_money(cost_basis / shares), opened_at)
+
+
+def replay_positions(user_id: Optional[int] = None, batch_size: int = 10_000) -> List[Position]:
+    """ streams the ledger, of one user or of everyone, in batches and returns the positions it adds up to """
+
+    query = select(*_LEDGER_COLUMNS).order_by(Trade.user_id, Trade.ticker, Trade.id).execution_options(yield_per=batch_size)
+    if user_id is not None:
+        query = query.where(Trade.user_id == user_id)
+    return list(replay(db.session.execute(query)))
+
+
+def rebuild_positions(user_id: Optional[int] = None, batch_size: int = 10_000) -> int:
+    """
+    Replaces the stored positions, of one user or of everyone, with the ones replayed from the ledger.
+
+    The positions are deleted and inserted in bulk within one transaction. Orders placed while it runs are not part of the
+    replay, so run it while the site is not taking orders.
+
+    Returns:
+        int: The number of positions written.
+
+    Raises:
+        UnrecordedPositionsError: When a stored position has no buy in the ledger, e.g. one opened before the ledger
+        existed and the opening balance migration has not run. Nothing is changed.
+    """
+
+    bought = exists().where(Trade.user_id == Stock.user_id, Trade.ticker == Stock.ticker, Trade.side == "buy")
+    unrecorded = select(Stock.user_id, Stock.ticker).where(~bought)
+    if user_id is not None:
+        unrecorded = unrecorded.where(Stock.user_id == user_id)
+    unrecorded = db.session.execute(unrecorded.order_by(Stock.user_id, Stock.ticker)).all()
+    if unrecorded:
+        raise UnrecordedPositionsError(f"{len(unrecorded)} position(s) have no buy in the ledger, e.g. user {unrecorded[0][0]} "
+                                       f"{unrecorded[0][1]}. Run `flask upgrade-db` to record their opening balances first")
+
+    positions = replay_positions(user_id, batch_size)
+
+    delete_positions = delete(Stock) if user_id is None else delete(Stock).where(Stock.user_id == user_id)
+    db.session.execute(delete_positions.execution_options(synchronize_session=False))
+    for start in range(0, len(positions), batch_size):
+        db.session.execute(insert(Stock), [{"user_id": position.user_id, "ticker": position.ticker, "shares": position.shares,
+                                            "cost_basis": position.cost_basis, "average_price": position.average_price,
+                                            "date": position.date} for position in positions[start:start + batch_size]])
+    db.session.commit()
+
+    db.session.expire_all()
+    user_cache.invalidate(user_id)
+    return len(positions)
+
+
+def check_positions(user_id: Optional[int] = None, tolerance: Decimal = Decimal("0.05")) -> List[str]:
+    """ compares the stored positions with the replayed ledger and describes every position that differs """
+
+    replayed = {(position.user_id, position.ticker): position for position in replay_positions(user_id)}
+    query = select(Stock) if user_id is None else select(Stock).where(Stock.user_id == user_id)
+    stored = {(stock.user_id, stock.ticker): stock for stock in db.session.execute(query).scalars()}
+
+    differences = []
+    for key in sorted(replayed.keys() | stored.keys()):
+        position, stock = replayed.get(key), stored.get(key)
+        if position is None or stock is None:
+            differences.append(f"user {key[0]} {key[1]}: stored {stock.shares if stock else 0} shares, the ledger has {position.shares if position else 0}")
+        elif abs(Decimal(str(stock.shares)) - position.shares) > SHARE_TOLERANCE or abs(Decimal(str(stock.cost_basis)) - position.cost_basis) > tolerance:
+            differences.append(f"user {key[0]} {key[1]}: stored {stock.shares} shares for {stock.cost_basis}$, "
+                               f"the ledger has {position.shares} shares for {position.cost_basis}$")
+    return differences
+
+
+@click.command("rebuild-positions")
+@click.option("--user-id", type=int, default=None, help="Only rebuild the positions of this user.")
+@click.option("--check", is_flag=True, help="Only report the positions that differ from the ledger, change nothing.")
+@click.option("--batch-size", type=int, default=10_000, show_default=True)
+def rebuild_positions_command(user_id, check, batch_size):
+    """ Replay the trade ledger and rebuild the stored positions from it. """
+
+    if check:
+        differences = check_positions(user_id)
+        for difference in differences:
+            click.echo(difference)
+        click.echo(f"{len(differences)} position(s) differ from the ledger" if differences else "Every position matches the ledger")
+        raise SystemExit(1 if differences else 0)
+
+    try:
+        rebuilt = rebuild_positions(user_id, batch_size)
+    except UnrecordedPositionsError as error:
+        raise click.ClickException(str(error))
+    click.echo(f"Rebuilt {rebuilt} position(s) from the ledger")
+
+
+def init_app(app):
+    app.cli.add_command(rebuild_positions_command)
@@ -0,0 +1,277 @@
+import asyncio
+import hmac
+import sys
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from flask import Response, abort, before_render_template, current_app, g, request, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# where the time of a request goes, every phase is also a Server-Timing metric of the response
+PHASES = ("db", "upstream", "bcrypt", "render")
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RequestTimings:
+    """
+    The seconds a single request spent in every phase.
+
+    Phases running on several threads at once, like the concurrent quote fetches, add up and can exceed the request's duration.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.seconds: Dict[str, float] = dict.fromkeys(PHASES, 0.0)
+        self.counts: Dict[str, int] = dict.fromkeys(PHASES, 0)
+        self._lock = threading.Lock()
+
+    def add(self, phase: str, seconds: float):
+        with self._lock:
+            self.seconds[phase] += seconds
+            self.counts[phase] += 1
+
+
+# a context variable, so async views and the threads they are copied into record into the request's timings
+_timings: ContextVar[Optional[RequestTimings]] = ContextVar("request_timings", default=None)
+
+
+def record(phase: str, seconds: float):
+    """ adds seconds to a phase of the current request, outside of a request it does nothing """
+
+    timings = _timings.get()
+    if timings is not None:
+        timings.add(phase, seconds)
+
+
+@contextmanager
+def timer(phase: str):
+    """ records the time spent inside the with block to a phase of the current request """
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(phase, time.perf_counter() - started)
+
+
+def timed(phase: str):
+    """ decorator that records the time spent in a function, or a coroutine function, to a phase of the current request """
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with timer(phase):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(phase):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class Histogram:
+    """
+    A Prometheus histogram with labels.
+
+    Attributes:
+        name (str): The metric name.
+        documentation (str): The help text.
+        labelnames (Tuple[str]): The names of the labels every observation is made with.
+        buckets (Tuple[float]): The upper bounds of the buckets, in seconds.
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets: Iterable[float] = BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+
+        self._series: Dict[Tuple[str, ...], List] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: (list(counts), total) for key, (counts, total) in self._series.items()}
+
+        for key, (counts, total) in sorted(series.items()):
+            labels = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key)]
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket_labels = ",".join(labels + [f'le="{le}"'])
+                lines.append(f"{self.name}_bucket{{{bucket_labels}}} {cumulative}")
+            suffix = f"{{{','.join(labels)}}}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+REQUEST_DURATION = Histogram("http_request_duration_seconds", "Time spent serving a request.", ("method", "endpoint", "status"))
+PHASE_DURATION = Histogram("http_request_phase_seconds", "Time a request spent in a phase (db, upstream, bcrypt, render).", ("endpoint", "phase"))
+
+# functions called on every scrape that yield (name, help, type, {labels: value}) for the stats of the other modules
+_collectors: List[Callable[[], Iterable[Tuple[str, str, str, Dict[Tuple[Tuple[str, str], ...], float]]]]] = []
+
+
+def collector(func):
+    """ registers a function whose gauges and counters are rendered on every scrape """
+
+    _collectors.append(func)
+    return func
+
+
+@collector
+def _runtime_stats():
+    from website import db, database, passwords, user_cache
+    from website.stock import upstream
+    from website.stock.stock_models import get_cache_stats
+
+    pool = database.pool_stats(db.engine) or {}
+    yield "db_pool_connections", "Connections of the database pool by state.", "gauge", {
+        (("state", "checked_out"),): pool.get("checked_out", 0), (("state", "size"),): pool.get("size", 0)}
+
+    caches = get_cache_stats() + [user_cache.stats()]
+    # the bar arrays are only reported once the market data stack is loaded, the metrics never import numpy
+    bar_store = sys.modules.get("website.stock.bar_store")
+    if bar_store is not None:
+        caches.append(bar_store.cache_stats())
+    for counter in ("hits", "misses", "coalesced", "evictions"):
+        yield f"cache_{counter}_total", f"Cache {counter} since the process started.", "counter", {(("cache", cache["name"]),): cache[counter] for cache in caches}
+
+    hasher = passwords.hasher.stats()
+    yield "password_hashes_in_flight", "Password hashes waiting or running.", "gauge", {(): hasher["in_flight"]}
+    yield "password_hashes_rejected_total", "Password requests rejected because the queue was full.", "counter", {(): hasher["rejected"]}
+    yield "password_hashes_timed_out_total", "Password requests that gave up waiting for their hash.", "counter", {(): hasher["timed_out"]}
+
+    hub = current_app.extensions.get("price_hub")
+    if hub is not None:
+        streams = hub.stats()
+        yield "price_stream_subscribers", "Open server-sent price streams.", "gauge", {(): streams["subscribers"]}
+        yield "price_stream_tickers", "Distinct tickers polled for the price streams.", "gauge", {(): streams["tickers"]}
+
+    client = upstream.client.stats()
+    yield "upstream_calls_total", "Upstream calls by outcome since the process started.", "counter", {
+        (("outcome", outcome),): client[outcome] for outcome in ("calls", "retries", "throttled", "unavailable")}
+    yield "upstream_circuit_open", "1 while the upstream circuit breaker is open.", "gauge", {(): int(client["circuit"] != "closed")}
+
+
+def render_metrics() -> str:
+    lines = REQUEST_DURATION.render() + PHASE_DURATION.render()
+    for collect in _collectors:
+        for name, documentation, kind, values in collect():
+            lines += [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}"]
+            for labels, value in values.items():
+                suffix = "{" + ",".join(f'{label}="{_escape(str(text))}"' for label, text in labels) + "}" if labels else ""
+                lines.append(f"{name}{suffix} {float(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def server_timing(timings: RequestTimings, total: float) -> str:
+    """ formats the timings as a Server-Timing header value, in milliseconds """
+
+    parts = [f'{phase};dur={timings.seconds[phase] * 1000:.1f};desc="{timings.counts[phase]}x"' for phase in PHASES if timings.counts[phase]]
+    return ", ".join(parts + [f"total;dur={total * 1000:.1f}"])
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_statement(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.metrics_started = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _end_statement(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "metrics_started", None)
+    if started is not None:
+        record("db", time.perf_counter() - started)
+
+
+def _start_render(sender, template, context, **extra):
+    g._render_started = time.perf_counter()
+
+
+def _end_render(sender, template, context, **extra):
+    started = g.pop("_render_started", None)
+    if started is not None:
+        record("render", time.perf_counter() - started)
+
+
+def _before_request():
+    _timings.set(RequestTimings())
+
+
+def _after_request(response):
+    timings = _timings.get()
+    if timings is None or request.endpoint == "metrics":
+        return response
+
+    total = time.perf_counter() - timings.started
+    endpoint = request.endpoint or "unmatched"
+    REQUEST_DURATION.observe(total, method=request.method, endpoint=endpoint, status=response.status_code)
+    for phase in PHASES:
+        PHASE_DURATION.observe(timings.seconds[phase], endpoint=endpoint, phase=phase)
+
+    response.headers["Server-Timing"] = server_timing(timings, total)
+    return response
+
+
+def _teardown_request(error=None):
+    _timings.set(None)
+
+
+def metrics():
+    token = current_app.config["METRICS_TOKEN"]
+    if token and not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        abort(401)
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+def init_app(app):
+    """
+    Times every request if METRICS_ENABLED is set, and serves the Prometheus metrics of this process on METRICS_PATH if
+    METRICS_TOKEN is set too, or METRICS_PUBLIC for a server that is only reachable from the internal network.
+    """
+
+    if not app.config["METRICS_ENABLED"]:
+        return
+
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    before_render_template.connect(_start_render, app)
+    template_rendered.connect(_end_render, app)
+    if app.config["METRICS_TOKEN"] or app.config["METRICS_PUBLIC"]:
+        app.add_url_rule(app.config["METRICS_PATH"], "metrics", metrics)
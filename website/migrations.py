@@ -0,0 +1,113 @@
+from decimal import Decimal
+from typing import Callable, List, Tuple
+
+import click
+from sqlalchemy import insert, inspect, select, text
+
+from website import db
+from website.ledger import replay
+from website.models import Stock, Trade
+from website.orders import SHARE_TOLERANCE, to_money, to_shares
+
+MIGRATIONS: List[Tuple[str, Callable]] = []
+
+
+def migration(name: str):
+    """ registers a schema change, migrations run once each, in the order they are declared """
+
+    def decorator(func):
+        MIGRATIONS.append((name, func))
+        return func
+
+    return decorator
+
+
+@migration("0001_unique_stock_position")
+def unique_stock_position(connection):
+    """ merges duplicate (user_id, ticker) positions into one and adds the unique index on them """
+
+    if "stock" not in inspect(connection).get_table_names():
+        return
+
+    connection.execute(text("UPDATE stock SET ticker = UPPER(ticker)"))
+    duplicates = connection.execute(text(
+        "SELECT user_id, ticker, MIN(id), SUM(shares), SUM(cost_basis) FROM stock "
+        "GROUP BY user_id, ticker HAVING COUNT(*) > 1")).all()
+    for user_id, ticker, keep_id, shares, cost_basis in duplicates:
+        connection.execute(text("UPDATE stock SET shares = :shares, cost_basis = :cost_basis, average_price = :cost_basis / :shares WHERE id = :id"),
+                           {"shares": shares, "cost_basis": cost_basis, "id": keep_id})
+        connection.execute(text("DELETE FROM stock WHERE user_id = :user_id AND ticker = :ticker AND id != :id"),
+                           {"user_id": user_id, "ticker": ticker, "id": keep_id})
+
+    connection.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS uq_stock_user_ticker ON stock (user_id, ticker)"))
+
+
+@migration("0002_trade_history_index")
+def trade_history_index(connection):
+    """ adds the (user_id, id) index the keyset paginated trade history walks """
+
+    if "trade" not in inspect(connection).get_table_names():
+        return
+
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_trade_user_id ON trade (user_id, id)"))
+
+
+@migration("0003_opening_balance_trades")
+def opening_balance_trades(connection):
+    """
+    records an opening balance buy for the shares of every position that were bought before the trade ledger existed, so
+    replaying the ledger gives back the stored positions instead of dropping them
+    """
+
+    if "stock" not in inspect(connection).get_table_names():
+        return
+    Trade.__table__.create(connection, checkfirst=True)
+
+    ledger = connection.execute(select(Trade.user_id, Trade.ticker, Trade.side, Trade.shares, Trade.total, Trade.executed_at)
+                                .order_by(Trade.user_id, Trade.ticker, Trade.id))
+    replayed = {(position.user_id, position.ticker): position for position in replay(ledger)}
+
+    trades = []
+    for stock_id, user_id, ticker, shares, cost_basis, opened_at in connection.execute(
+            select(Stock.id, Stock.user_id, Stock.ticker, Stock.shares, Stock.cost_basis, Stock.date)):
+        position = replayed.get((user_id, ticker))
+        missing = Decimal(str(shares)) - (position.shares if position else Decimal(0))
+        if missing <= SHARE_TOLERANCE:
+            continue
+        total = max(Decimal(str(cost_basis)) - (position.cost_basis if position else Decimal(0)), Decimal(0))
+        trades.append({"user_id": user_id, "idempotency_key": f"opening-balance-{stock_id}", "ticker": ticker, "side": "buy",
+                       "shares": to_shares(missing), "price": to_money(total / missing), "total": to_money(total),
+                       "executed_at": opened_at})
+    if trades:
+        connection.execute(insert(Trade), trades)
+
+
+def upgrade() -> List[str]:
+    """ creates the missing tables, then applies every migration that has not run yet and returns their names """
+
+    with db.engine.begin() as connection:
+        connection.execute(text("CREATE TABLE IF NOT EXISTS schema_migration (name VARCHAR(100) PRIMARY KEY)"))
+        applied = {name for (name,) in connection.execute(text("SELECT name FROM schema_migration"))}
+
+        ran = []
+        for name, func in MIGRATIONS:
+            if name in applied:
+                continue
+            func(connection)
+            connection.execute(text("INSERT INTO schema_migration (name) VALUES (:name)"), {"name": name})
+            ran.append(name)
+
+    db.create_all()
+    return ran
+
+
+@click.command("upgrade-db")
+def upgrade_db_command():
+    """ Create missing tables and apply pending schema migrations. """
+
+    ran = upgrade()
+    click.echo(f"Applied {', '.join(ran)}" if ran else "The database is up to date")
+
+
+def init_app(app):
+    app.cli.add_command(upgrade_db_command)
@@ -1,6 +1,16 @@
+import logging
 from flask_login import UserMixin
-from website import db, bcrypt
+from website import db
+from website.passwords import PasswordHasherBusy, hasher
+from sqlalchemy import event
 from sqlalchemy.sql import func
+from decimal import Decimal
+
+logger = logging.getLogger(__name__)
+
+# money and share amounts are stored as exact decimals, with a fixed number of decimal places
+MONEY = db.Numeric(precision=16, scale=2)
+SHARES = db.Numeric(precision=18, scale=6)
 
 
 class User(db.Model, UserMixin):
@@ -14,12 +24,14 @@ class User(db.Model, UserMixin):
         email_address (str): The email address of the user (must be unique).
         password_hash (str): The hashed password of the user.
         accounts: (Account): The Account Model that the user owns. (limit 1)
+        balance (Decimal): The cash balance of the user.
         stocks (List[Stock]): A list of stocks owned by the user.
 
     Methods:
         password: The password property of the user.
         password.setter: The setter method for the password property.
-        check_password_correction: Checks if the provided password matches the user's hashed password.
+        check_password_correction: Checks if the provided password matches the user's hashed password, rehashing it when the work factor changed.
+        get_position: Returns the Stock the user holds for a specific ticker, or None.
         check_if_user_own_this_stock: Checks if the user owns a specific stock.
         can_sell: Checks if the user can sell a specific number of shares of a stock they own.
 
@@ -30,7 +42,7 @@ class User(db.Model, UserMixin):
     phone_number = db.Column(db.String(), nullable=False, unique=True)
     email_address = db.Column(db.String(length=50), nullable=False, unique=True)
     password_hash = db.Column(db.String(), nullable=False)
-    balance = db.Column(db.Float(), nullable=False, default=1_000_000)
+    balance = db.Column(MONEY, nullable=False, default=Decimal(1_000_000))
     stocks = db.relationship("Stock", backref="user", lazy=True)
 
 
@@ -40,29 +52,42 @@ class User(db.Model, UserMixin):
 
     @password.setter
     def password(self, text_password: str):
-        self.password_hash = bcrypt.generate_password_hash(password=text_password).decode("utf-8")
+        self.password_hash = hasher.hash(text_password)
     
     def check_password_correction(self, attempted_password: str) -> bool:
-        return bcrypt.check_password_hash(self.password_hash, attempted_password)
+        """ checks the password, and rehashes it with the configured work factor if the stored hash used another one """
+
+        if not hasher.check(self.password_hash, attempted_password):
+            return False
+
+        if hasher.needs_rehash(self.password_hash):
+            try:
+                self.password = attempted_password
+            except PasswordHasherBusy:
+                # the password was correct, the rehash is only an upgrade and is tried again on the next login
+                logger.warning("Password hasher busy, the hash of user %s keeps its old work factor for now", self.id)
+        return True
     
     def __repr__(self) -> str:
         return f"User {self.username}"
 
+    def get_position(self, stock_ticker: str):
+        """ returns the user's Stock for the ticker or None, with a single indexed query (the stocks relationship is not loaded) """
+
+        return Stock.query.filter_by(user_id=self.id, ticker=stock_ticker.upper()).first()
+
     def check_if_user_own_this_stock(self, stock_ticker: str) -> bool:
-        for stock in self.stocks:
-            if stock.ticker == stock_ticker:
-                return True
-        return False
+        return self.get_position(stock_ticker) is not None
 
-    def can_sell(self, stock_ticker: str, shares: float) -> bool:
-        stock = Stock.query.filter_by(user_id=self.id, ticker=stock_ticker).first()
-        return stock.shares >= shares
+    def can_sell(self, stock_ticker: str, shares: float, position=None) -> bool:
+        stock = position if position is not None else self.get_position(stock_ticker)
+        return stock is not None and stock.shares >= shares
 
     def can_buy(self, total_cost):
         return self.balance >= total_cost
     
     def formatted_balance(self):
-        formatted_balance = f"{self.balance:,.0f}" if self.balance.is_integer() else f"{self.balance:,.2f}"
+        formatted_balance = f"{self.balance:,.0f}" if self.balance % 1 == 0 else f"{self.balance:,.2f}"
         return formatted_balance
 
         
@@ -75,18 +100,21 @@ class Stock(db.Model):
     Attributes:
         id (int): The unique ID of the stock in the database.
         ticker (str): The ticker symbol of the stock.
-        average_price (float): The average price of the stock for the user.
-        shares (float): The number of shares the user owns for the stock.
-        cost_basis (float): The total cost the user spend on the stock.
+        average_price (Decimal): The average price of the stock for the user.
+        shares (Decimal): The number of shares the user owns for the stock.
+        cost_basis (Decimal): The total cost the user spend on the stock.
         date (datetime): The date and time the stock was added to the database.
         user_id (int): The ID of the user who owns the stock.
     """
 
+    # a user holds at most one position per ticker, the index also covers every position lookup
+    __table_args__ = (db.Index("uq_stock_user_ticker", "user_id", "ticker", unique=True),)
+
     id = db.Column(db.Integer(), primary_key=True)
     ticker = db.Column(db.String(length=5), nullable=False)
-    average_price = db.Column(db.Float(), nullable=False)
-    shares = db.Column(db.Float(), nullable=False)
-    cost_basis = db.Column(db.Float(), nullable=False)
+    average_price = db.Column(MONEY, nullable=False)
+    shares = db.Column(SHARES, nullable=False)
+    cost_basis = db.Column(MONEY, nullable=False)
     date = db.Column(db.DateTime(timezone=True), default=func.now())
     user_id = db.Column(db.Integer(), db.ForeignKey('user.id'))
 
@@ -94,7 +122,215 @@ class Stock(db.Model):
         return f"Stock: {self.ticker} at {self.average_price}$"
     
     def formatted_string(self, str_to_format):
-        formatted_string = f"{str_to_format:,.0f}" if str_to_format.is_integer() else f"{str_to_format:,.2f}"
+        formatted_string = f"{str_to_format:,.0f}" if str_to_format % 1 == 0 else f"{str_to_format:,.2f}"
         return formatted_string
 
-    
\ No newline at end of file
+    
+
+class Trade(db.Model):
+    """
+    A class representing an executed buy or sell order.
+
+    Trades form an append-only ledger: a row is never changed or deleted, the positions in Stock are derived from it.
+
+    Attributes:
+        id (int): The unique ID of the trade in the database.
+        user_id (int): The ID of the user who placed the order.
+        idempotency_key (str): The key the order was submitted with, a retried submission with the same key is only executed once.
+        ticker (str): The ticker symbol of the stock.
+        side (str): Either "buy" or "sell".
+        shares (Decimal): The number of shares traded.
+        price (Decimal): The price per share.
+        total (Decimal): The amount of money that changed hands.
+        executed_at (datetime): When the order was executed.
+    """
+
+    # the (user_id, id) index serves the keyset paginated trade history
+    __table_args__ = (db.UniqueConstraint("user_id", "idempotency_key", name="uq_trade_user_idempotency_key"),
+                      db.Index("ix_trade_user_id", "user_id", "id"))
+
+    id = db.Column(db.Integer(), primary_key=True)
+    user_id = db.Column(db.Integer(), db.ForeignKey('user.id'), nullable=False)
+    idempotency_key = db.Column(db.String(length=64), nullable=False)
+    ticker = db.Column(db.String(length=5), nullable=False)
+    side = db.Column(db.String(length=4), nullable=False)
+    shares = db.Column(SHARES, nullable=False)
+    price = db.Column(MONEY, nullable=False)
+    total = db.Column(MONEY, nullable=False)
+    executed_at = db.Column(db.DateTime(timezone=True), default=func.now())
+
+    def __repr__(self) -> str:
+        return f"Trade: {self.side} {self.shares} {self.ticker} at {self.price}$"
+
+
+@event.listens_for(Trade, "before_update")
+@event.listens_for(Trade, "before_delete")
+def _keep_ledger_append_only(mapper, connection, target):
+    raise ValueError(f"Trades are append-only, {target!r} can not be changed or deleted")
+
+
+class Quote(db.Model):
+    """
+    A class representing the locally stored market data of a ticker, kept fresh by the price ingestion scheduler.
+
+    Attributes:
+        ticker (str): The ticker symbol of the stock.
+        price (float): The latest price of the stock.
+        price_updated_at (datetime): When the price was last refreshed (UTC).
+        bars_updated_at (datetime): When the intraday bars were last refreshed (UTC).
+    """
+
+    ticker = db.Column(db.String(length=5), primary_key=True)
+    price = db.Column(db.Float())
+    price_updated_at = db.Column(db.DateTime())
+    bars_updated_at = db.Column(db.DateTime())
+
+    def __repr__(self) -> str:
+        return f"Quote: {self.ticker} at {self.price}$"
+
+
+class IntradayBar(db.Model):
+    """
+    A class representing a single intraday bar of a ticker.
+
+    Attributes:
+        id (int): The unique ID of the bar in the database.
+        ticker (str): The ticker symbol of the stock.
+        timestamp (datetime): The start of the bar.
+        open, high, low, close (float): The prices of the bar.
+        volume (float): The traded volume of the bar.
+    """
+
+    __table_args__ = (db.UniqueConstraint("ticker", "timestamp", name="uq_intraday_bar_ticker_timestamp"),)
+
+    id = db.Column(db.Integer(), primary_key=True)
+    ticker = db.Column(db.String(length=5), nullable=False)
+    timestamp = db.Column(db.DateTime(), nullable=False)
+    open = db.Column(db.Float(), nullable=False)
+    high = db.Column(db.Float(), nullable=False)
+    low = db.Column(db.Float(), nullable=False)
+    close = db.Column(db.Float(), nullable=False)
+    volume = db.Column(db.Float(), nullable=False)
+
+    def __repr__(self) -> str:
+        return f"IntradayBar: {self.ticker} {self.timestamp} {self.close}$"
+
+
+class FundamentalsReport:
+    """
+    The key columns every fundamentals table shares, one row per ticker and fiscal period.
+
+    Attributes:
+        ticker (str): The ticker symbol of the stock.
+        period (str): Either "annual" or "quarterly".
+        fiscal_date_ending (date): The last day of the fiscal period the report covers.
+        reported_currency (str): The currency the amounts are reported in.
+
+    The amounts are whole units of the reported currency, NULL where the upstream report has none. Every column is named
+    after the upstream field in snake case (currentDebt is current_debt).
+    """
+
+    ticker = db.Column(db.String(length=5), primary_key=True)
+    period = db.Column(db.String(length=9), primary_key=True)
+    fiscal_date_ending = db.Column(db.Date(), primary_key=True)
+    reported_currency = db.Column(db.String(length=3))
+
+
+class BalanceSheet(FundamentalsReport, db.Model):
+    """ A class representing a balance sheet report (Alpha Vantage's BALANCE_SHEET) of a ticker for one fiscal period. """
+
+    total_assets = db.Column(db.BigInteger())
+    total_current_assets = db.Column(db.BigInteger())
+    cash_and_cash_equivalents_at_carrying_value = db.Column(db.BigInteger())
+    cash_and_short_term_investments = db.Column(db.BigInteger())
+    inventory = db.Column(db.BigInteger())
+    current_net_receivables = db.Column(db.BigInteger())
+    total_non_current_assets = db.Column(db.BigInteger())
+    property_plant_equipment = db.Column(db.BigInteger())
+    accumulated_depreciation_amortization_ppe = db.Column(db.BigInteger())
+    intangible_assets = db.Column(db.BigInteger())
+    intangible_assets_excluding_goodwill = db.Column(db.BigInteger())
+    goodwill = db.Column(db.BigInteger())
+    investments = db.Column(db.BigInteger())
+    long_term_investments = db.Column(db.BigInteger())
+    short_term_investments = db.Column(db.BigInteger())
+    other_current_assets = db.Column(db.BigInteger())
+    other_non_current_assets = db.Column(db.BigInteger())
+    total_liabilities = db.Column(db.BigInteger())
+    total_current_liabilities = db.Column(db.BigInteger())
+    current_accounts_payable = db.Column(db.BigInteger())
+    deferred_revenue = db.Column(db.BigInteger())
+    current_debt = db.Column(db.BigInteger())
+    short_term_debt = db.Column(db.BigInteger())
+    total_non_current_liabilities = db.Column(db.BigInteger())
+    capital_lease_obligations = db.Column(db.BigInteger())
+    long_term_debt = db.Column(db.BigInteger())
+    current_long_term_debt = db.Column(db.BigInteger())
+    long_term_debt_noncurrent = db.Column(db.BigInteger())
+    short_long_term_debt_total = db.Column(db.BigInteger())
+    other_current_liabilities = db.Column(db.BigInteger())
+    other_non_current_liabilities = db.Column(db.BigInteger())
+    total_shareholder_equity = db.Column(db.BigInteger())
+    treasury_stock = db.Column(db.BigInteger())
+    retained_earnings = db.Column(db.BigInteger())
+    common_stock = db.Column(db.BigInteger())
+    common_stock_shares_outstanding = db.Column(db.BigInteger())
+
+    def __repr__(self) -> str:
+        return f"BalanceSheet: {self.ticker} {self.period} {self.fiscal_date_ending}"
+
+
+class CashFlow(FundamentalsReport, db.Model):
+    """ A class representing a cash flow report (Alpha Vantage's CASH_FLOW) of a ticker for one fiscal period. """
+
+    operating_cashflow = db.Column(db.BigInteger())
+    payments_for_operating_activities = db.Column(db.BigInteger())
+    proceeds_from_operating_activities = db.Column(db.BigInteger())
+    change_in_operating_liabilities = db.Column(db.BigInteger())
+    change_in_operating_assets = db.Column(db.BigInteger())
+    depreciation_depletion_and_amortization = db.Column(db.BigInteger())
+    capital_expenditures = db.Column(db.BigInteger())
+    change_in_receivables = db.Column(db.BigInteger())
+    change_in_inventory = db.Column(db.BigInteger())
+    profit_loss = db.Column(db.BigInteger())
+    cashflow_from_investment = db.Column(db.BigInteger())
+    cashflow_from_financing = db.Column(db.BigInteger())
+    proceeds_from_repayments_of_short_term_debt = db.Column(db.BigInteger())
+    payments_for_repurchase_of_common_stock = db.Column(db.BigInteger())
+    payments_for_repurchase_of_equity = db.Column(db.BigInteger())
+    payments_for_repurchase_of_preferred_stock = db.Column(db.BigInteger())
+    dividend_payout = db.Column(db.BigInteger())
+    dividend_payout_common_stock = db.Column(db.BigInteger())
+    dividend_payout_preferred_stock = db.Column(db.BigInteger())
+    proceeds_from_issuance_of_common_stock = db.Column(db.BigInteger())
+    proceeds_from_issuance_of_long_term_debt_and_capital_securities_net = db.Column(db.BigInteger())
+    proceeds_from_issuance_of_preferred_stock = db.Column(db.BigInteger())
+    proceeds_from_repurchase_of_equity = db.Column(db.BigInteger())
+    proceeds_from_sale_of_treasury_stock = db.Column(db.BigInteger())
+    change_in_cash_and_cash_equivalents = db.Column(db.BigInteger())
+    change_in_exchange_rate = db.Column(db.BigInteger())
+    net_income = db.Column(db.BigInteger())
+
+    def __repr__(self) -> str:
+        return f"CashFlow: {self.ticker} {self.period} {self.fiscal_date_ending}"
+
+
+class FundamentalsCheck(db.Model):
+    """
+    A class representing when the reports of a kind were last fetched for a ticker, so refreshes can be skipped until
+    a newer period can have been reported.
+
+    Attributes:
+        ticker (str): The ticker symbol of the stock.
+        statement (str): The table the reports are stored in, "balance_sheet" or "cash_flow".
+        latest_period (date): The newest fiscal period stored, of any period type.
+        checked_at (datetime): When the upstream was last asked (UTC).
+    """
+
+    ticker = db.Column(db.String(length=5), primary_key=True)
+    statement = db.Column(db.String(length=20), primary_key=True)
+    latest_period = db.Column(db.Date())
+    checked_at = db.Column(db.DateTime(), nullable=False)
+
+    def __repr__(self) -> str:
+        return f"FundamentalsCheck: {self.ticker} {self.statement} up to {self.latest_period}"
@@ -0,0 +1,183 @@
+import uuid
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Optional, Union
+
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+from website import db, user_cache
+from website.models import User, Stock, Trade
+
+CENT = Decimal("0.01")
+SHARE_STEP = Decimal("0.000001")
+# sqlite keeps numeric columns as floats, so share comparisons allow for half a share step of rounding noise
+SHARE_TOLERANCE = SHARE_STEP / 2
+
+MAX_ATTEMPTS = 3
+
+Number = Union[Decimal, float, int, str]
+
+
+class OrderError(Exception):
+    """ base class for an order that could not be executed, nothing was changed when it is raised """
+
+
+class InvalidOrderError(OrderError):
+    pass
+
+
+class InsufficientFundsError(OrderError):
+    pass
+
+
+class InsufficientSharesError(OrderError):
+    pass
+
+
+def to_money(value: Number) -> Decimal:
+    return Decimal(str(value)).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def to_shares(value: Number) -> Decimal:
+    return Decimal(str(value)).quantize(SHARE_STEP, rounding=ROUND_HALF_UP)
+
+
+def new_idempotency_key() -> str:
+    return uuid.uuid4().hex
+
+
+def buy(user_id: int, stock_ticker: str, shares: Number, price: Number, idempotency_key: Optional[str] = None) -> Trade:
+    """
+    Buys shares of a stock for a user as a single atomic transaction.
+
+    The balance is debited with a conditional UPDATE that only matches while the balance covers the cost, and the position
+    is increased in place by the database, so concurrent orders can neither overdraw the account nor lose an update.
+
+    Parameters:
+        user_id (int): The ID of the buying user.
+        stock_ticker (str): The ticker symbol of the stock.
+        shares (Number): The number of shares to buy.
+        price (Number): The price per share.
+        idempotency_key (str): The key of the submission, retrying with the same key returns the first trade without executing again.
+
+    Returns:
+        Trade: The executed trade.
+
+    Raises:
+        InvalidOrderError: If the number of shares or the price is not positive.
+        InsufficientFundsError: If the user can not afford the shares.
+    """
+
+    return _execute("buy", user_id, stock_ticker, shares, price, idempotency_key)
+
+
+def sell(user_id: int, stock_ticker: str, shares: Number, price: Number, idempotency_key: Optional[str] = None) -> Trade:
+    """
+    Sells shares of a stock for a user as a single atomic transaction.
+
+    The position is decreased with a conditional UPDATE that only matches while the user still owns enough shares,
+    so concurrent sells can not oversell. A position that reaches zero shares is deleted.
+
+    Parameters:
+        user_id (int): The ID of the selling user.
+        stock_ticker (str): The ticker symbol of the stock.
+        shares (Number): The number of shares to sell.
+        price (Number): The price per share.
+        idempotency_key (str): The key of the submission, retrying with the same key returns the first trade without executing again.
+
+    Returns:
+        Trade: The executed trade.
+
+    Raises:
+        InvalidOrderError: If the number of shares or the price is not positive.
+        InsufficientSharesError: If the user does not own this many shares of the stock.
+    """
+
+    return _execute("sell", user_id, stock_ticker, shares, price, idempotency_key)
+
+
+def _execute(side, user_id, stock_ticker, shares, price, idempotency_key):
+    stock_ticker = stock_ticker.upper()
+    shares = to_shares(shares)
+    price = to_money(price)
+    total = to_money(shares * price)
+    idempotency_key = idempotency_key or new_idempotency_key()
+
+    if shares <= 0 or price <= 0:
+        raise InvalidOrderError("The number of shares and the price must be positive!")
+
+    # anything the session has pending belongs to the caller's transaction, not to this order
+    db.session.rollback()
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            trade = Trade(user_id=user_id, idempotency_key=idempotency_key, ticker=stock_ticker, side=side, shares=shares, price=price, total=total)
+            db.session.add(trade)
+            db.session.flush()
+
+            if side == "buy":
+                _apply_buy(user_id, stock_ticker, shares, total)
+            else:
+                _apply_sell(user_id, stock_ticker, shares, total)
+
+            db.session.commit()
+            break
+        except IntegrityError:
+            db.session.rollback()
+            existing = _find_trade(user_id, idempotency_key)
+            if existing is not None:
+                return existing
+            # a concurrent first buy of the same ticker created the position, the retry increases it instead
+            if attempt == MAX_ATTEMPTS - 1:
+                raise
+        except BaseException:
+            db.session.rollback()
+            raise
+
+    # balances and positions were changed behind the identity map's back
+    db.session.expire_all()
+    user_cache.invalidate(user_id)
+    return trade
+
+
+def _apply_buy(user_id, stock_ticker, shares, total):
+    debited = db.session.execute(
+        update(User)
+        .where(User.id == user_id, User.balance >= total)
+        .values(balance=User.balance - total)
+        .execution_options(synchronize_session=False))
+    if debited.rowcount != 1:
+        raise InsufficientFundsError("You don't have enough money to buy this amount of shares!")
+
+    increased = db.session.execute(
+        update(Stock)
+        .where(Stock.user_id == user_id, Stock.ticker == stock_ticker)
+        .values(shares=Stock.shares + shares, cost_basis=Stock.cost_basis + total,
+                average_price=(Stock.cost_basis + total) / (Stock.shares + shares))
+        .execution_options(synchronize_session=False))
+    if increased.rowcount == 0:
+        db.session.execute(insert(Stock).values(user_id=user_id, ticker=stock_ticker, shares=shares, cost_basis=total,
+                                                average_price=to_money(total / shares)))
+
+
+def _apply_sell(user_id, stock_ticker, shares, total):
+    decreased = db.session.execute(
+        update(Stock)
+        .where(Stock.user_id == user_id, Stock.ticker == stock_ticker, Stock.shares >= shares - SHARE_TOLERANCE)
+        .values(shares=Stock.shares - shares, cost_basis=Stock.cost_basis - Stock.average_price * shares)
+        .execution_options(synchronize_session=False))
+    if decreased.rowcount != 1:
+        raise InsufficientSharesError(f"You don't own {shares.normalize():f} shares of {stock_ticker}!")
+
+    db.session.execute(
+        delete(Stock)
+        .where(Stock.user_id == user_id, Stock.ticker == stock_ticker, Stock.shares <= SHARE_TOLERANCE)
+        .execution_options(synchronize_session=False))
+    db.session.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(balance=User.balance + total)
+        .execution_options(synchronize_session=False))
+
+
+def _find_trade(user_id, idempotency_key) -> Optional[Trade]:
+    return db.session.execute(select(Trade).where(Trade.user_id == user_id, Trade.idempotency_key == idempotency_key)).scalar_one_or_none()
@@ -0,0 +1,157 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturesTimeoutError
+from typing import Dict, Optional
+
+import bcrypt
+
+from website import metrics
+
+# bcrypt only looks at the first 72 bytes, older bcrypt releases silently truncated longer passwords the same way
+MAX_PASSWORD_BYTES = 72
+
+
+class PasswordHasherBusy(Exception):
+    """ raised when more hashing requests are queued than the hasher accepts, or a hash timed out, the caller should answer 503 """
+
+
+def _encode(password: str) -> bytes:
+    return password.encode("utf-8")[:MAX_PASSWORD_BYTES]
+
+
+def _hash_password(password: bytes, rounds: int) -> str:
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds=rounds)).decode("utf-8")
+
+
+def _check_password(password: bytes, password_hash: str) -> bool:
+    try:
+        return bcrypt.checkpw(password, password_hash.encode("utf-8"))
+    except ValueError:
+        return False
+
+
+def get_rounds(password_hash: str) -> int:
+    """ returns the work factor a bcrypt hash was made with, it is stored in the hash as $2b$<rounds>$... """
+
+    return int(password_hash.split("$")[2])
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt in a bounded process pool, so the hashing CPU work and the GIL are off the worker process. The request
+    thread still blocks until its hash is done or timeout has passed.
+
+    At most queue_depth hashes can be waiting or running at once, any further request is rejected right away with
+    PasswordHasherBusy instead of piling up behind the others. A caller whose hash is not done within timeout gets
+    PasswordHasherBusy as well. A hash that is still queued is dropped then, one that is already running cannot be stopped,
+    it runs to completion and keeps its slot until it does. With workers set to 0 bcrypt runs inline.
+
+    Attributes:
+        rounds (int): The bcrypt work factor of new hashes.
+        workers (int): The number of hashing processes, the pool is only started on first use.
+        queue_depth (int): The maximum number of hashes waiting or running.
+        timeout (float): How many seconds a caller waits for its hash.
+    """
+
+    def __init__(self, rounds: int = 12, workers: int = 2, queue_depth: int = 32, timeout: float = 10.0):
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._latencies = deque(maxlen=1024)
+        self._in_flight = 0
+        self._completed = 0
+        self._rejected = 0
+        self._timed_out = 0
+
+        self.configure(rounds, workers, queue_depth, timeout)
+
+    def configure(self, rounds: int, workers: int, queue_depth: int, timeout: float):
+        self.shutdown()
+        self.rounds = rounds
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(queue_depth)
+
+    def hash(self, password: str) -> str:
+        return self._run(_hash_password, _encode(password), self.rounds)
+
+    def check(self, password_hash: str, password: str) -> bool:
+        return self._run(_check_password, _encode(password), password_hash)
+
+    def needs_rehash(self, password_hash: str) -> bool:
+        """ True if the hash was made with another work factor than the configured one """
+
+        try:
+            return get_rounds(password_hash) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def stats(self) -> Dict[str, Optional[float]]:
+        """ returns the request counters and the p50, p99 and max latency in seconds of the recent hashes """
+
+        with self._stats_lock:
+            latencies = sorted(self._latencies)
+            stats = {"in_flight": self._in_flight, "completed": self._completed, "rejected": self._rejected, "timed_out": self._timed_out}
+
+        def percentile(share):
+            return latencies[min(len(latencies) - 1, int(share * len(latencies)))] if latencies else None
+
+        stats.update(p50=percentile(0.5), p99=percentile(0.99), max=latencies[-1] if latencies else None)
+        return stats
+
+    def shutdown(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
+                self._pool = None
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._stats_lock:
+                self._rejected += 1
+            raise PasswordHasherBusy("Too many password requests are being processed, please try again in a moment!")
+
+        started = time.perf_counter()
+        with self._stats_lock:
+            self._in_flight += 1
+        future = None
+        try:
+            if self.workers <= 0:
+                return func(*args)
+            future = self._get_pool().submit(func, *args)
+            try:
+                return future.result(timeout=self.timeout)
+            except FuturesTimeoutError:
+                with self._stats_lock:
+                    self._timed_out += 1
+                raise PasswordHasherBusy("Password requests are taking too long right now, please try again in a moment!") from None
+        finally:
+            if future is not None and not future.done() and not future.cancel():
+                # the hash is already running in a pool process, its slot is freed once it finished, so the processes
+                # never hold more than queue_depth hashes
+                future.add_done_callback(lambda _: self._slots.release())
+            else:
+                self._slots.release()
+            elapsed = time.perf_counter() - started
+            metrics.record("bcrypt", elapsed)
+            with self._stats_lock:
+                self._in_flight -= 1
+                self._completed += 1
+                self._latencies.append(elapsed)
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        # created lazily, so forking web servers start the pool in each worker instead of sharing one from the master
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self._pool
+
+
+hasher = PasswordHasher()
+
+
+def init_app(app):
+    hasher.configure(rounds=app.config["BCRYPT_LOG_ROUNDS"], workers=app.config["PASSWORD_HASH_WORKERS"],
+                     queue_depth=app.config["PASSWORD_HASH_QUEUE_DEPTH"], timeout=app.config["PASSWORD_HASH_TIMEOUT"])
@@ -0,0 +1,90 @@
+import logging
+from contextvars import ContextVar
+from contextlib import contextmanager
+from functools import wraps
+from typing import List, Optional, Tuple
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# a context variable rather than a thread local, async views run in a copy of the request's context on another thread
+_counters: ContextVar[Tuple["QueryCounter", ...]] = ContextVar("query_counters", default=())
+
+
+class QueryBudgetExceeded(AssertionError):
+    """ raised when a block or a view runs more SQL statements than its budget allows """
+
+
+class QueryCounter:
+    """
+    Collects the SQL statements executed by the current context while it is active.
+
+    Attributes:
+        statements (List[str]): The executed statements, in order.
+    """
+
+    def __init__(self):
+        self.statements: List[str] = []
+
+    @property
+    def count(self) -> int:
+        return len(self.statements)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    for counter in _counters.get():
+        counter.statements.append(statement)
+
+
+@contextmanager
+def count_queries():
+    """ counts the statements executed by this context inside the with block, counters can be nested """
+
+    counter = QueryCounter()
+    token = _counters.set(_counters.get() + (counter,))
+    try:
+        yield counter
+    finally:
+        _counters.reset(token)
+
+
+@contextmanager
+def assert_max_queries(budget: int):
+    """ fails with QueryBudgetExceeded if the with block executes more than budget statements """
+
+    with count_queries() as counter:
+        yield counter
+
+    if counter.count > budget:
+        raise QueryBudgetExceeded(f"{counter.count} queries executed, the budget is {budget}:\n" + "\n".join(counter.statements))
+
+
+def query_budget(budget: int, name: Optional[str] = None):
+    """
+    Declares how many statements a view may execute.
+
+    Going over the budget raises QueryBudgetExceeded when the QUERY_BUDGET_ENFORCED config is set, as it should be in tests,
+    otherwise it only logs a warning. Statements run by flask-login's user loader before the view are not counted.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            with count_queries() as counter:
+                response = current_app.ensure_sync(view)(*args, **kwargs)
+
+            if counter.count > budget:
+                message = f"{name or view.__name__} executed {counter.count} queries, the budget is {budget}"
+                if current_app.config.get("QUERY_BUDGET_ENFORCED"):
+                    raise QueryBudgetExceeded(message + ":\n" + "\n".join(counter.statements))
+                logger.warning(message)
+            return response
+
+        wrapper.query_budget = budget
+        return wrapper
+
+    return decorator
@@ -0,0 +1,84 @@
+import os
+from collections import namedtuple
+from typing import Dict, List
+
+import numpy as np
+
+from website.stock import bar_store
+from website.stock.quote_cache import QuoteCache
+
+TRADING_DAYS_PER_YEAR = 252
+
+PortfolioAnalytics = namedtuple("PortfolioAnalytics", ["days", "values", "returns", "volatility", "drawdown", "max_drawdown",
+                                                       "contributions", "weights", "missing"])
+
+# keyed by the user and its positions, a trade changes the positions and so the key, in every worker process at once
+analytics_cache = QuoteCache("analytics", ttl=float(os.getenv("ANALYTICS_CACHE_TTL", 5 * 60)), max_entries=int(os.getenv("ANALYTICS_CACHE_SIZE", 1024)))
+
+
+def daily_closes(series: bar_store.BarSeries):
+    """ returns the days the ticker traded on and the last close of each of them """
+
+    days = series.timestamps.astype("datetime64[D]")
+    last_of_day = np.append(days[1:] != days[:-1], True)
+    return days[last_of_day], series.close[last_of_day]
+
+
+def align_closes(series_by_ticker: Dict[str, bar_store.BarSeries], tickers: List[str]):
+    """
+    Aligns the daily closes of the tickers into a single (days x tickers) matrix.
+
+    A ticker that did not trade on a day keeps its previous close, days before its first bar take its first close.
+    """
+
+    closes = [daily_closes(series_by_ticker[ticker]) for ticker in tickers]
+    days = np.unique(np.concatenate([ticker_days for ticker_days, _ in closes]))
+
+    matrix = np.empty((len(days), len(tickers)))
+    for column, (ticker_days, ticker_closes) in enumerate(closes):
+        matrix[:, column] = ticker_closes[np.maximum(np.searchsorted(ticker_days, days, side="right") - 1, 0)]
+    return days, matrix
+
+
+def compute_analytics(positions: Dict[str, float], series_by_ticker: Dict[str, bar_store.BarSeries]) -> PortfolioAnalytics:
+    """
+    Parameters:
+        positions (Dict[str, float]): The shares held by ticker.
+        series_by_ticker (Dict[str, BarSeries]): The stored bars of every held ticker.
+
+    Returns:
+        PortfolioAnalytics: The daily portfolio value, its daily returns, the annualized volatility of those returns, the
+        drawdown from the running peak and the largest one, and the contribution of every position to the return and its
+        weight on the last day. Tickers without any stored bars are left out and listed in missing.
+    """
+
+    tickers = [ticker for ticker in positions if len(series_by_ticker.get(ticker, bar_store.empty_series()).timestamps)]
+    missing = [ticker for ticker in positions if ticker not in tickers]
+    if not tickers:
+        empty = np.array([], dtype=float)
+        return PortfolioAnalytics(np.array([], dtype="datetime64[D]"), empty, empty, None, empty, None, {}, {}, missing)
+
+    days, closes = align_closes(series_by_ticker, tickers)
+    position_values = closes * np.array([float(positions[ticker]) for ticker in tickers])
+    values = position_values.sum(axis=1)
+
+    returns = values[1:] / values[:-1] - 1
+    volatility = float(returns.std(ddof=1) * np.sqrt(TRADING_DAYS_PER_YEAR)) if len(returns) > 1 else None
+    drawdown = values / np.maximum.accumulate(values) - 1
+
+    contributions = (position_values[-1] - position_values[0]) / values[0]
+    weights = position_values[-1] / values[-1]
+
+    return PortfolioAnalytics(days, values, returns, volatility, drawdown, float(drawdown.min()),
+                              dict(zip(tickers, contributions.tolist())), dict(zip(tickers, weights.tolist())), missing)
+
+
+def get_portfolio_analytics(user_id: int, stocks: List) -> PortfolioAnalytics:
+    """ returns the analytics of the user's positions from the stored bars, cached until the positions change or the ttl runs out """
+
+    positions = {}
+    for stock in stocks:
+        positions[stock.ticker.upper()] = positions.get(stock.ticker.upper(), 0.0) + float(stock.shares)
+
+    key = (user_id, tuple(sorted(positions.items())))
+    return analytics_cache.get_or_fetch(key, lambda: compute_analytics(positions, bar_store.read_bars_many(positions)))
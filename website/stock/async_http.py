@@ -0,0 +1,74 @@
+import asyncio
+import atexit
+import threading
+from typing import Optional
+
+
+class AsyncHttpClient:
+    """
+    A single aiohttp session shared by every request of the process, so upstream connections are kept alive and reused.
+
+    Flask runs every async view in its own short lived event loop, an aiohttp session can only live in one loop, so the
+    session runs in a background loop of its own and get_json can be awaited from any loop.
+
+    Attributes:
+        connections (int): The maximum number of open upstream connections.
+        timeout (float): Seconds a single call may take.
+    """
+
+    def __init__(self, connections: int = 16, timeout: float = 10.0):
+        self.connections = connections
+        self.timeout = timeout
+
+        self._loop = None
+        self._session = None
+        self._lock = threading.Lock()
+
+    def configure(self, connections: int, timeout: float):
+        self.close()
+        self.connections = connections
+        self.timeout = timeout
+
+    async def get_json(self, url: str, params: Optional[dict] = None):
+        """ fetches url and returns the decoded JSON body, raises aiohttp.ClientError or ValueError on failure """
+
+        future = asyncio.run_coroutine_threadsafe(self._get_json(url, params), self._get_loop())
+        return await asyncio.wrap_future(future)
+
+    def close(self):
+        with self._lock:
+            loop, session = self._loop, self._session
+            self._loop = self._session = None
+
+        if loop is None:
+            return
+        if session is not None:
+            asyncio.run_coroutine_threadsafe(session.close(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+
+    async def _get_json(self, url, params):
+        import aiohttp
+
+        if self._session is None:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.connections),
+                                                  timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+        async with self._session.get(url, params=params) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        # started on first use, so forking web servers start the loop in each worker instead of sharing one from the master
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="async-http", daemon=True).start()
+            return self._loop
+
+
+http_client = AsyncHttpClient()
+atexit.register(http_client.close)
+
+
+def init_app(app):
+    http_client.configure(connections=app.config["MARKET_DATA_HTTP_CONNECTIONS"], timeout=app.config["MARKET_DATA_HTTP_TIMEOUT"])
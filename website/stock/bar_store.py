@@ -0,0 +1,140 @@
+import os
+from collections import namedtuple
+from itertools import groupby
+from operator import itemgetter
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+from sqlalchemy import and_, func, insert, or_, select
+from sqlalchemy.exc import IntegrityError
+
+from website import db
+from website.metrics import timer
+from website.models import IntradayBar
+from website.stock.providers import Bar, get_provider
+from website.stock.quote_cache import QuoteCache
+
+BarSeries = namedtuple("BarSeries", ["timestamps", "open", "high", "low", "close", "volume"])
+
+_COLUMNS = (IntradayBar.timestamp, IntradayBar.open, IntradayBar.high, IntradayBar.low, IntradayBar.close, IntradayBar.volume)
+
+_UNKNOWN = object()
+
+# the arrays of the most recently read tickers, a ticker evicted from it is loaded whole again on its next read
+_series = QuoteCache("bar_series", ttl=float("inf"), max_entries=int(os.getenv("BAR_SERIES_CACHE_SIZE", 256)))
+
+
+def empty_series() -> BarSeries:
+    return BarSeries(np.array([], dtype="datetime64[s]"), *(np.array([], dtype=float) for _ in range(5)))
+
+
+def get_last_timestamp(stock_ticker: str):
+    """ returns the timestamp of the newest stored bar of the ticker, or None if nothing is stored yet """
+
+    return db.session.execute(select(func.max(IntradayBar.timestamp)).where(IntradayBar.ticker == stock_ticker.upper())).scalar()
+
+
+def append_bars(stock_ticker: str, bars: List[Bar], last_timestamp=_UNKNOWN) -> int:
+    """
+    Parameters:
+        stock_ticker (str): The ticker symbol the bars belong to.
+        bars (List[Bar]): The bars to store, oldest first.
+        last_timestamp (datetime): The newest stored timestamp, if the caller already looked it up (None if nothing is stored).
+
+    Returns:
+        int: The number of bars that were stored, bars that are not newer than the last stored one are skipped.
+    """
+
+    stock_ticker = stock_ticker.upper()
+    if last_timestamp is _UNKNOWN:
+        last_timestamp = get_last_timestamp(stock_ticker)
+    rows = [{"ticker": stock_ticker, **bar._asdict()} for bar in bars if last_timestamp is None or bar.timestamp > last_timestamp]
+    if not rows:
+        return 0
+
+    try:
+        db.session.execute(insert(IntradayBar), rows)
+        db.session.commit()
+    except IntegrityError:
+        # another worker appended the same bars first
+        db.session.rollback()
+        return 0
+    return len(rows)
+
+
+def update_ticker(stock_ticker: str, interval: str = "60min") -> int:
+    """ fetches only the bars newer than the last stored one and appends them, raises MarketDataError on failure """
+
+    stock_ticker = stock_ticker.upper()
+    last_timestamp = get_last_timestamp(stock_ticker)
+    with timer("upstream"):
+        bars = get_provider().get_intraday(stock_ticker, interval=interval, since=last_timestamp)
+    return append_bars(stock_ticker, bars, last_timestamp)
+
+
+async def aupdate_ticker(stock_ticker: str, interval: str = "60min") -> int:
+    """ the async variant of update_ticker, only the upstream call is awaited """
+
+    stock_ticker = stock_ticker.upper()
+    last_timestamp = get_last_timestamp(stock_ticker)
+    with timer("upstream"):
+        bars = await get_provider().aget_intraday(stock_ticker, interval=interval, since=last_timestamp)
+    return append_bars(stock_ticker, bars, last_timestamp)
+
+
+def read_bars(stock_ticker: str) -> BarSeries:
+    """
+    Returns the whole stored history of the ticker as numpy arrays, oldest first.
+
+    The arrays of the last BAR_SERIES_CACHE_SIZE tickers read are kept in memory per process, so a read of one of them
+    only loads the rows appended since its previous read.
+    """
+
+    stock_ticker = stock_ticker.upper()
+    series = _series.get(stock_ticker) or empty_series()
+
+    query = select(*_COLUMNS).where(IntradayBar.ticker == stock_ticker).order_by(IntradayBar.timestamp)
+    if len(series.timestamps):
+        query = query.where(IntradayBar.timestamp > series.timestamps[-1].astype(object))
+
+    return _append_rows(stock_ticker, series, db.session.execute(query).all())
+
+
+def read_bars_many(tickers: Iterable[str]) -> Dict[str, BarSeries]:
+    """ read_bars for several tickers at once, the rows appended since the previous read of any of them come from a single query """
+
+    tickers = list(dict.fromkeys(ticker.upper() for ticker in tickers))
+    if not tickers:
+        return {}
+
+    known = {ticker: _series.get(ticker) or empty_series() for ticker in tickers}
+
+    conditions = [IntradayBar.ticker.in_([ticker for ticker, series in known.items() if not len(series.timestamps)])]
+    conditions += [and_(IntradayBar.ticker == ticker, IntradayBar.timestamp > series.timestamps[-1].astype(object))
+                   for ticker, series in known.items() if len(series.timestamps)]
+    query = select(IntradayBar.ticker, *_COLUMNS).where(or_(*conditions)).order_by(IntradayBar.ticker, IntradayBar.timestamp)
+
+    rows_by_ticker = {ticker: [row[1:] for row in rows] for ticker, rows in groupby(db.session.execute(query).all(), key=itemgetter(0))}
+    return {ticker: _append_rows(ticker, series, rows_by_ticker.get(ticker, [])) for ticker, series in known.items()}
+
+
+def _append_rows(stock_ticker: str, series: BarSeries, rows) -> BarSeries:
+    if not rows:
+        return series
+
+    columns = list(zip(*rows))
+    new = BarSeries(np.array(columns[0], dtype="datetime64[s]"), *(np.array(column, dtype=float) for column in columns[1:]))
+    series = BarSeries(*(np.concatenate((old, added)) for old, added in zip(series, new)))
+
+    _series.set(stock_ticker, series)
+    return series
+
+
+def cache_stats() -> dict:
+    return _series.stats()
+
+
+def clear_memory(stock_ticker: Optional[str] = None):
+    """ drops the in-memory arrays of a single ticker, or of every ticker if no ticker is given """
+
+    _series.invalidate(None if stock_ticker is None else stock_ticker.upper())
@@ -0,0 +1,53 @@
+from typing import Tuple
+
+import numpy as np
+
+
+def lttb(x: np.ndarray, y: np.ndarray, threshold: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Downsamples a series with the Largest-Triangle-Three-Buckets algorithm, which keeps the peaks and dips of the line.
+
+    Parameters:
+        x (np.ndarray): The x values of the series, sorted ascending.
+        y (np.ndarray): The y values of the series.
+        threshold (int): The number of points to keep, at least 3.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The kept x and y values, the first and last point are always kept.
+
+    Raises:
+        ValueError: If threshold is below 3, which leaves no bucket between the first and last point.
+    """
+
+    if threshold < 3:
+        raise ValueError(f"LTTB keeps at least 3 points, got a threshold of {threshold}")
+    length = len(x)
+    if threshold >= length:
+        return x, y
+
+    x_float = x.astype(float)
+    # the first and last point are buckets of their own, the rest is split evenly over threshold - 2 buckets
+    edges = np.linspace(1, length - 1, threshold - 1).astype(int)
+
+    kept = np.empty(threshold, dtype=int)
+    kept[0] = 0
+    kept[-1] = length - 1
+
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+
+        if bucket + 2 < len(edges):
+            next_start, next_end = edges[bucket + 1], edges[bucket + 2]
+        else:
+            next_start, next_end = length - 1, length
+        average_x = x_float[next_start:next_end].mean()
+        average_y = y[next_start:next_end].mean()
+
+        # twice the area of the triangle between the previous kept point, every candidate and the next bucket's average
+        areas = np.abs((x_float[previous] - average_x) * (y[start:end] - y[previous])
+                       - (x_float[previous] - x_float[start:end]) * (average_y - y[previous]))
+        previous = start + int(np.argmax(areas))
+        kept[bucket + 1] = previous
+
+    return x[kept], y[kept]
@@ -0,0 +1,26 @@
+from typing import Optional
+
+
+class MarketDataError(Exception):
+    """ raised by a provider when the upstream call fails or the ticker is unknown """
+
+
+class UnknownTickerError(MarketDataError):
+    """ the upstream answered, but it does not know the ticker """
+
+
+class UpstreamThrottledError(MarketDataError):
+    """
+    the call was not made because the upstream quota is spent, or the upstream itself answered that it is
+
+    Attributes:
+        retry_after (float): Seconds until a call is expected to be allowed again, if known.
+    """
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class UpstreamUnavailableError(MarketDataError):
+    """ the upstream could not be reached or failed, or the circuit breaker is open after repeated failures """
@@ -0,0 +1,287 @@
+import logging
+import re
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional
+
+import click
+from sqlalchemy import and_, func, insert, select
+
+from website import db
+from website.models import BalanceSheet, CashFlow, FundamentalsCheck, Stock
+from website.stock import upstream
+from website.stock.errors import MarketDataError, UpstreamThrottledError, UpstreamUnavailableError
+
+logger = logging.getLogger(__name__)
+
+# the stored statements by table name, with the provider method that fetches their reports
+STATEMENTS = {"balance_sheet": (BalanceSheet, "get_balance_sheet"), "cash_flow": (CashFlow, "get_cash_flow")}
+
+# the report lists of an upstream answer, by the period type their rows are stored under
+PERIODS = {"annualReports": "annual", "quarterlyReports": "quarterly"}
+
+_KEY_COLUMNS = {"ticker", "period", "fiscal_date_ending", "reported_currency"}
+
+# the next fiscal quarter ends about this long after the latest stored period, its report follows after the filing lag
+QUARTER = timedelta(days=92)
+
+
+def _utcnow() -> datetime:
+    # naive like the rest of the stored datetimes, sqlite does not keep the timezone
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def column_name(metric: str) -> str:
+    """ returns the column a metric is stored in, metrics can be given as upstream field (currentDebt) or column name (current_debt) """
+
+    return re.sub(r"([a-z0-9])([A-Z])", r"\1_\2", metric.strip()).lower()
+
+
+def _metric_columns() -> Dict[str, str]:
+    return {column.name: table for table, (model, _) in STATEMENTS.items()
+            for column in model.__table__.columns if column.name not in _KEY_COLUMNS}
+
+
+def _amount(value) -> Optional[int]:
+    # the upstream reports amounts as strings and a missing one as "None"
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        try:
+            return round(float(value))
+        except (TypeError, ValueError, OverflowError):
+            return None
+
+
+def parse_reports(statement: str, stock_ticker: str, data: dict) -> List[dict]:
+    """
+    Parameters:
+        statement (str): The table the reports are for, "balance_sheet" or "cash_flow".
+        stock_ticker (str): The ticker symbol the reports belong to.
+        data (dict): The raw answer of the provider, with annualReports and quarterlyReports lists.
+
+    Returns:
+        List[dict]: A row for every report with a valid fiscalDateEnding, its amounts converted to integers and missing
+        ones set to None. Fields the table has no column for are dropped.
+    """
+
+    model = STATEMENTS[statement][0]
+    columns = {column.name for column in model.__table__.columns} - _KEY_COLUMNS
+    rows = {}
+    for key, period in PERIODS.items():
+        for report in data.get(key) or []:
+            try:
+                fiscal_date_ending = date.fromisoformat(report["fiscalDateEnding"])
+            except (KeyError, TypeError, ValueError):
+                continue
+            row = {"ticker": stock_ticker, "period": period, "fiscal_date_ending": fiscal_date_ending,
+                   "reported_currency": (report.get("reportedCurrency") or None)}
+            row.update({name: None for name in columns})
+            for field, value in report.items():
+                name = column_name(field)
+                if name in columns:
+                    row[name] = _amount(value)
+            rows[period, fiscal_date_ending] = row
+    return list(rows.values())
+
+
+def ingest(statement: str, stock_ticker: str, data: dict, now: Optional[datetime] = None) -> int:
+    """
+    Stores the reports of an upstream answer that are newer than the latest stored one of their period type and records
+    the check. Reported periods are never rewritten, so an answer that brings nothing new costs a single query.
+
+    Returns:
+        int: The number of reports inserted.
+    """
+
+    model = STATEMENTS[statement][0]
+    stock_ticker = stock_ticker.upper()
+    latest = dict(db.session.execute(select(model.period, func.max(model.fiscal_date_ending))
+                                     .where(model.ticker == stock_ticker).group_by(model.period)).all())
+
+    rows = [row for row in parse_reports(statement, stock_ticker, data)
+            if latest.get(row["period"]) is None or row["fiscal_date_ending"] > latest[row["period"]]]
+    if rows:
+        db.session.execute(insert(model), rows)
+
+    periods = [period for period in latest.values() if period is not None] + [row["fiscal_date_ending"] for row in rows]
+    _record_check(stock_ticker, statement, max(periods, default=None), now)
+    db.session.commit()
+    return len(rows)
+
+
+def _record_check(stock_ticker: str, statement: str, latest_period: Optional[date], now: Optional[datetime] = None):
+    check = db.session.get(FundamentalsCheck, (stock_ticker, statement))
+    if check is None:
+        check = FundamentalsCheck(ticker=stock_ticker, statement=statement)
+        db.session.add(check)
+    check.latest_period = latest_period
+    check.checked_at = now or _utcnow()
+
+
+def is_due(check: Optional[FundamentalsCheck], now: datetime, filing_lag: timedelta, recheck: timedelta) -> bool:
+    """
+    Returns whether the upstream can have reports the store does not: never before the quarter after the latest stored
+    period ended and had filing_lag to be reported, and at most once per recheck while the next report is late.
+    """
+
+    if check is None:
+        return True
+    if now - check.checked_at < recheck:
+        return False
+    return check.latest_period is None or now.date() >= check.latest_period + QUARTER + filing_lag
+
+
+def due_tickers(tickers: Iterable[str], statement: str, now: datetime, filing_lag: timedelta, recheck: timedelta) -> List[str]:
+    """ returns the tickers whose reports of the statement are due for a refresh, in one query """
+
+    tickers = list(dict.fromkeys(ticker.upper() for ticker in tickers))
+    checks = {check.ticker: check for check in db.session.execute(
+        select(FundamentalsCheck).where(FundamentalsCheck.statement == statement, FundamentalsCheck.ticker.in_(tickers))).scalars()}
+    return [ticker for ticker in tickers if is_due(checks.get(ticker), now, filing_lag, recheck)]
+
+
+def refresh(tickers: Iterable[str], force: bool = False, statements: Iterable[str] = tuple(STATEMENTS)) -> Dict[str, int]:
+    """
+    Fetches the reports of every ticker whose store can be behind the upstream and ingests the new periods.
+
+    The calls run as background work. A spent quota stops the refresh, the tickers not reached stay due for the next one.
+
+    Parameters:
+        tickers (Iterable[str]): The ticker symbols to refresh.
+        force (bool): Fetch every ticker, whether or not a newer period can have been reported.
+        statements (Iterable[str]): The statements to refresh, both by default.
+
+    Returns:
+        Dict[str, int]: How many (ticker, statement) pairs were fetched, skipped as not due and failed, and how many reports were inserted.
+    """
+
+    from flask import current_app
+    from website.stock.providers import get_provider
+
+    config = current_app.config
+    filing_lag = timedelta(days=config["FUNDAMENTALS_FILING_LAG_DAYS"])
+    recheck = timedelta(days=config["FUNDAMENTALS_RECHECK_DAYS"])
+    tickers = list(dict.fromkeys(ticker.upper() for ticker in tickers))
+    counts = {"fetched": 0, "skipped": 0, "failed": 0, "inserted": 0}
+
+    for statement in statements:
+        now = _utcnow()
+        due = tickers if force else due_tickers(tickers, statement, now, filing_lag, recheck)
+        counts["skipped"] += len(tickers) - len(due)
+        fetch = getattr(get_provider(), STATEMENTS[statement][1])
+        for stock_ticker in due:
+            try:
+                with upstream.priority(upstream.BACKGROUND):
+                    data = fetch(stock_ticker)
+            except UpstreamThrottledError as error:
+                logger.warning("Fundamentals refresh stopped at %s %s: %s", stock_ticker, statement, error)
+                return counts
+            except UpstreamUnavailableError as error:
+                logger.warning("Could not fetch the %s of %s: %s", statement, stock_ticker, error)
+                counts["failed"] += 1
+                continue
+            except MarketDataError as error:
+                # the upstream answered without reports, asked again after the recheck interval like a late report
+                logger.info("No %s for %s: %s", statement, stock_ticker, error)
+                data = {}
+                counts["failed"] += 1
+            else:
+                counts["fetched"] += 1
+            counts["inserted"] += ingest(statement, stock_ticker, data, now)
+    return counts
+
+
+def compare(metrics: Iterable[str], tickers: Iterable[str], period: str = "annual"):
+    """
+    Compares metrics of the latest stored report across many tickers.
+
+    Every statement involved is read with a single query, whatever the number of tickers, which picks the latest fiscal
+    period of every ticker in the database.
+
+    Parameters:
+        metrics (Iterable[str]): The metrics, as upstream field (currentDebt) or column name (current_debt).
+        tickers (Iterable[str]): The ticker symbols to compare.
+        period (str): Compare the latest "annual" or "quarterly" reports.
+
+    Returns:
+        DataFrame: A row for every ticker, in the given order, and a float column for every metric named as it was given.
+        Tickers or metrics without a stored report are NaN.
+    """
+
+    import pandas as pd
+
+    if period not in PERIODS.values():
+        raise ValueError(f"Unknown period {period!r}, expected one of {', '.join(PERIODS.values())}")
+    metrics = list(dict.fromkeys(metrics))
+    tickers = list(dict.fromkeys(ticker.upper() for ticker in tickers))
+    columns = _resolve(metrics)
+
+    frames = []
+    for statement in dict.fromkeys(columns.values()):
+        model = STATEMENTS[statement][0]
+        names = [metric for metric in metrics if columns[metric] == statement]
+        latest = (select(model.ticker, func.max(model.fiscal_date_ending).label("fiscal_date_ending"))
+                  .where(model.ticker.in_(tickers), model.period == period).group_by(model.ticker).subquery())
+        query = (select(model.ticker, *(getattr(model, column_name(metric)) for metric in names))
+                 .join(latest, and_(model.ticker == latest.c.ticker, model.fiscal_date_ending == latest.c.fiscal_date_ending))
+                 .where(model.period == period))
+        frames.append(pd.DataFrame(db.session.execute(query).all(), columns=["ticker"] + names).set_index("ticker"))
+
+    frame = pd.concat(frames, axis=1) if frames else pd.DataFrame()
+    return frame.reindex(index=pd.Index(tickers, name="ticker"), columns=metrics).astype(float)
+
+
+def history(metric: str, tickers: Iterable[str], period: str = "annual"):
+    """
+    Returns every stored value of a metric across many tickers in one query.
+
+    Returns:
+        DataFrame: The fiscal periods, oldest first, as rows and a float column for every ticker, in the given order. Periods
+        a ticker has no report for are NaN.
+    """
+
+    import pandas as pd
+
+    if period not in PERIODS.values():
+        raise ValueError(f"Unknown period {period!r}, expected one of {', '.join(PERIODS.values())}")
+    tickers = list(dict.fromkeys(ticker.upper() for ticker in tickers))
+    model = STATEMENTS[_resolve([metric])[metric]][0]
+    rows = db.session.execute(select(model.fiscal_date_ending, model.ticker, getattr(model, column_name(metric)))
+                              .where(model.ticker.in_(tickers), model.period == period)).all()
+    frame = pd.DataFrame(rows, columns=["fiscal_date_ending", "ticker", metric])
+    table = frame.pivot(index="fiscal_date_ending", columns="ticker", values=metric).sort_index()
+    return table.reindex(columns=pd.Index(tickers, name="ticker")).astype(float)
+
+
+def _resolve(metrics: List[str]) -> Dict[str, str]:
+    """ returns the statement every metric is stored in, raising ValueError for an unknown one """
+
+    known = _metric_columns()
+    unknown = [metric for metric in metrics if column_name(metric) not in known]
+    if unknown:
+        raise ValueError(f"Unknown fundamentals metric(s): {', '.join(unknown)}")
+    return {metric: known[column_name(metric)] for metric in metrics}
+
+
+@click.command("refresh-fundamentals")
+@click.argument("tickers", nargs=-1)
+@click.option("--held", is_flag=True, help="Also refresh every ticker any user holds.")
+@click.option("--force", is_flag=True, help="Fetch every ticker, even when no newer period can have been reported yet.")
+def refresh_fundamentals_command(tickers, held, force):
+    """ Fetch the balance sheet and cash flow reports of TICKERS into the fundamentals store. """
+
+    tickers = [ticker.upper() for ticker in tickers]
+    if held:
+        tickers += db.session.execute(select(Stock.ticker).distinct()).scalars().all()
+    if not tickers:
+        raise click.UsageError("Give at least one ticker or --held")
+
+    counts = refresh(tickers, force=force)
+    click.echo(f"Fetched {counts['fetched']}, skipped {counts['skipped']} not due and {counts['failed']} failed, "
+               f"inserted {counts['inserted']} report(s)")
+
+
+def init_app(app):
+    app.cli.add_command(refresh_fundamentals_command)
@@ -0,0 +1,353 @@
+import logging
+import os
+import threading
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple
+
+import click
+from sqlalchemy import insert, update
+from sqlalchemy.exc import IntegrityError
+
+from website import db
+from website.models import Stock, Quote
+from website.stock import upstream
+from website.stock.providers import get_provider, MarketDataError, UpstreamThrottledError
+from website.stock.quote_cache import QuoteCache
+from website.stock.stock_models import convert_timestamps_to_datetime, price_cache
+
+if TYPE_CHECKING:
+    from website.stock import bar_store
+
+logger = logging.getLogger(__name__)
+
+CALLS_PER_TICKER = 2  # one for the latest price and one for the intraday bars
+
+# nothing is kept (ttl=0), the cache only coalesces concurrent bar updates of the same ticker into one upstream call
+_bar_updates = QuoteCache("bar_update", ttl=0)
+# tickers whose last bar update failed (unknown, throttled or unreachable), they are not fetched again by the requests of
+# this process until the entry expires, so a failing ticker costs the shared quota once per worker and INTRADAY_FAILURE_TTL
+_bar_failures = QuoteCache("bar_failure", ttl=float(os.getenv("INTRADAY_FAILURE_TTL", 5 * 60)),
+                           max_entries=int(os.getenv("QUOTE_CACHE_SIZE", 2048)))
+
+
+def utcnow() -> datetime:
+    """ naive utc now, sqlite does not keep the timezone of a datetime column """
+
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def get_held_tickers() -> List[str]:
+    """ returns every ticker that at least one user currently holds """
+
+    return [ticker.upper() for (ticker,) in db.session.query(Stock.ticker).distinct()]
+
+
+def get_staleness(stock_ticker: str) -> Optional[float]:
+    """ returns how many seconds ago the stored price of the ticker was refreshed, or None if it has never been """
+
+    quote = db.session.get(Quote, stock_ticker.upper())
+    if quote is None or quote.price_updated_at is None:
+        return None
+    return (utcnow() - quote.price_updated_at).total_seconds()
+
+
+def get_stored_prices(tickers: Iterable[str], max_age: float) -> Dict[str, float]:
+    """
+    Parameters:
+        tickers (Iterable[str]): The ticker symbols to look up.
+        max_age (float): The oldest a stored price may be, in seconds, to still be returned.
+
+    Returns:
+        Dict[str, float]: The fresh stored price of every ticker that has one, stale or missing tickers are left out.
+    """
+
+    tickers = {ticker.upper() for ticker in tickers}
+    if not tickers:
+        return {}
+
+    now = utcnow()
+    quotes = Quote.query.filter(Quote.ticker.in_(tickers), Quote.price.isnot(None)).all()
+    return {quote.ticker: quote.price for quote in quotes if (now - quote.price_updated_at).total_seconds() <= max_age}
+
+
+def _bars_are_fresh(stock_ticker: str, max_age: float) -> bool:
+    quote = db.session.get(Quote, stock_ticker)
+    return quote is not None and quote.bars_updated_at is not None and (utcnow() - quote.bars_updated_at).total_seconds() <= max_age
+
+
+def _bars_are_due(stock_ticker: str, max_age: float) -> bool:
+    """ returns whether a request should fetch the new bars, not when they are fresh or their last update failed recently """
+
+    return not _bar_failures.get(stock_ticker) and not _bars_are_fresh(stock_ticker, max_age)
+
+
+def _store_quote(stock_ticker: str, **values):
+    """
+    Updates the stored quote of the ticker, creating it if there is none, and commits.
+
+    The scheduler, the requests and other workers can store the first quote of a ticker at the same time, the writer
+    whose insert loses on the primary key updates the row the winner inserted instead.
+    """
+
+    for attempt in range(2):
+        try:
+            if db.session.execute(update(Quote).where(Quote.ticker == stock_ticker).values(**values)).rowcount == 0:
+                db.session.execute(insert(Quote).values(ticker=stock_ticker, **values))
+            db.session.commit()
+            return
+        except IntegrityError:
+            db.session.rollback()
+            if attempt:
+                raise
+
+
+def _mark_bars_updated(stock_ticker: str):
+    _store_quote(stock_ticker, bars_updated_at=utcnow())
+
+
+def update_bars(stock_ticker: str) -> int:
+    """ appends the bars newer than the last stored one and marks the bars of the ticker as refreshed """
+
+    from website.stock import bar_store
+
+    appended = bar_store.update_ticker(stock_ticker)
+    _mark_bars_updated(stock_ticker)
+    return appended
+
+
+async def aupdate_bars(stock_ticker: str) -> int:
+    """ the async variant of update_bars """
+
+    from website.stock import bar_store
+
+    appended = await bar_store.aupdate_ticker(stock_ticker)
+    _mark_bars_updated(stock_ticker)
+    return appended
+
+
+def read_stock_series(stock_ticker: str, max_age: float) -> "bar_store.BarSeries":
+    """
+    Returns the stored intraday bars of the ticker as numpy arrays, oldest first.
+
+    If the bars were refreshed more than max_age seconds ago, only the newer bars are fetched and appended first,
+    concurrent requests for the same ticker share that fetch. A failed fetch is not retried by the requests of this process
+    for INTRADAY_FAILURE_TTL seconds. The series is empty if no bars can be found.
+    """
+
+    from website.stock import bar_store
+
+    stock_ticker = stock_ticker.upper()
+    if _bars_are_due(stock_ticker, max_age):
+        try:
+            _bar_updates.get_or_fetch(stock_ticker, lambda: update_bars(stock_ticker) >= 0)
+        except MarketDataError:
+            db.session.rollback()
+            _bar_failures.set(stock_ticker, True)
+            logger.warning("Intraday update failed for %s, serving the stored bars", stock_ticker, exc_info=True)
+
+    return bar_store.read_bars(stock_ticker)
+
+
+async def aread_stock_series(stock_ticker: str, max_age: float) -> "bar_store.BarSeries":
+    """ the async variant of read_stock_series, the upstream fetch of stale bars is awaited and shared the same way """
+
+    from website.stock import bar_store
+
+    stock_ticker = stock_ticker.upper()
+    if _bars_are_due(stock_ticker, max_age):
+        try:
+            await _bar_updates.aget_or_fetch(stock_ticker, lambda: _aupdated(stock_ticker))
+        except MarketDataError:
+            db.session.rollback()
+            _bar_failures.set(stock_ticker, True)
+            logger.warning("Intraday update failed for %s, serving the stored bars", stock_ticker, exc_info=True)
+
+    return bar_store.read_bars(stock_ticker)
+
+
+async def _aupdated(stock_ticker: str) -> bool:
+    return await aupdate_bars(stock_ticker) >= 0
+
+
+def read_stock_prices_and_dates(stock_ticker: str, max_age: float) -> Tuple[List[float], List[str]]:
+    """ returns the intraday close prices and formatted dates of the ticker, or ("None", "None") if no bars can be found """
+
+    series = read_stock_series(stock_ticker, max_age)
+    if not len(series.timestamps):
+        return "None", "None"
+    return series.close.tolist(), convert_timestamps_to_datetime(series.timestamps.astype(object))
+
+
+def refresh_ticker(stock_ticker: str):
+    """ fetches the latest price and the new intraday bars of the ticker and stores them, raises MarketDataError on failure """
+
+    price = get_provider().get_latest_price(stock_ticker)
+    _store_quote(stock_ticker, price=price, price_updated_at=utcnow())
+    price_cache.set(stock_ticker, price)
+
+    update_bars(stock_ticker)
+
+
+class IngestionLock:
+    """
+    An exclusive lock on a file, so only one process of the host runs the ingestion cycles.
+
+    The lock is held until release or until the process exits, the operating system then frees it for the next process.
+    Without fcntl (Windows) every process is allowed to run the cycles.
+
+    Attributes:
+        path (str): The lock file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    @property
+    def held(self) -> bool:
+        return self._file is not None
+
+    def acquire(self) -> bool:
+        """ takes the lock without waiting, returns whether this process holds it """
+
+        if self._file is not None:
+            return True
+        try:
+            import fcntl
+        except ImportError:
+            return True
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        file = open(self.path, "a")
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            file.close()
+            return False
+        self._file = file
+        return True
+
+    def release(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class PriceIngestionScheduler:
+    """
+    Refreshes the price and intraday bars of every held ticker into the Quote and IntradayBar tables on a fixed cadence.
+
+    Every cycle refreshes the stalest tickers first and stops once the upstream call budget of the cycle is spent, or
+    the shared upstream quota runs out, the remaining tickers are picked up by the next cycles.
+
+    With a lock, a cycle only runs in the process that holds it, so several workers of the host spend the call budget
+    once per cycle and not once per worker. The others keep trying and take over when the holder exits.
+
+    Attributes:
+        app (Flask): The application whose database is refreshed.
+        interval (float): Seconds between two cycles.
+        call_budget (int): The maximum number of upstream calls per cycle.
+        lock (IngestionLock): Held by the one process that runs the cycles, None to always run them.
+    """
+
+    def __init__(self, app, interval: float = 60.0, call_budget: int = 5, lock: Optional[IngestionLock] = None):
+        self.app = app
+        self.interval = interval
+        self.call_budget = call_budget
+        self.lock = lock
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="price-ingestion", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def run_once(self) -> int:
+        """ runs a single cycle and returns the number of tickers that were refreshed """
+
+        # background priority, so the refreshes leave part of the upstream quota to the users
+        with self.app.app_context(), upstream.priority(upstream.BACKGROUND):
+            tickers = get_held_tickers()
+            last_refresh = {quote.ticker: quote.price_updated_at for quote in Quote.query.filter(Quote.ticker.in_(tickers))}
+            tickers.sort(key=lambda ticker: last_refresh.get(ticker) or datetime.min)
+
+            refreshed = 0
+            for stock_ticker in tickers[:self.call_budget // CALLS_PER_TICKER]:
+                try:
+                    refresh_ticker(stock_ticker)
+                    refreshed += 1
+                except UpstreamThrottledError:
+                    db.session.rollback()
+                    logger.info("Upstream quota used up after %d tickers, the rest is left for the next cycle", refreshed)
+                    break
+                except MarketDataError:
+                    db.session.rollback()
+                    logger.warning("Price ingestion failed for %s", stock_ticker, exc_info=True)
+            return refreshed
+
+    def run(self):
+        """ runs a cycle every interval until stop is called, skipping the cycles while another process holds the lock """
+
+        while not self._stop.is_set():
+            try:
+                if self.lock is None or self.lock.acquire():
+                    self.run_once()
+            except Exception:
+                logger.exception("Price ingestion cycle failed")
+            self._stop.wait(self.interval)
+
+
+def lock_path(app) -> str:
+    return app.config["PRICE_INGESTION_LOCK_PATH"] or os.path.join(app.instance_path, "price_ingestion.lock")
+
+
+def create_scheduler(app) -> PriceIngestionScheduler:
+    return PriceIngestionScheduler(app, interval=app.config["PRICE_INGESTION_INTERVAL"], call_budget=app.config["PRICE_INGESTION_CALL_BUDGET"],
+                                   lock=IngestionLock(lock_path(app)))
+
+
+@click.command("ingest-prices")
+@click.option("--once", is_flag=True, help="Run a single cycle and exit.")
+def ingest_prices_command(once):
+    """ Refresh the prices and intraday bars of every held ticker, in this process instead of the web workers. """
+
+    from flask import current_app
+
+    scheduler = create_scheduler(current_app._get_current_object())
+    if once:
+        if not scheduler.lock.acquire():
+            raise click.ClickException(f"Another process holds {scheduler.lock.path} and is already ingesting prices")
+        click.echo(f"Refreshed {scheduler.run_once()} ticker(s)")
+        return
+
+    click.echo(f"Ingesting prices every {scheduler.interval:g}s, press Ctrl+C to stop")
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        scheduler.stop()
+
+
+def init_app(app) -> Optional[PriceIngestionScheduler]:
+    """
+    Starts the scheduler in this worker if PRICE_INGESTION_ENABLED is set. Every worker of the host starts one, but only
+    the one holding the lock file runs the cycles. With several hosts leave it off and run `flask ingest-prices` once instead.
+    """
+
+    app.cli.add_command(ingest_prices_command)
+    if not app.config.get("PRICE_INGESTION_ENABLED"):
+        return None
+
+    scheduler = create_scheduler(app)
+    app.extensions["price_ingestion"] = scheduler
+    scheduler.start()
+    return scheduler
@@ -0,0 +1,89 @@
+import threading
+from contextvars import copy_context
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from website.stock.stock_models import get_latest_stock_price
+from website.stock.ingestion import get_stored_prices
+
+_executors: Dict[int, ThreadPoolExecutor] = {}
+_executor_lock = threading.Lock()
+
+
+def _get_executor(max_workers: int) -> ThreadPoolExecutor:
+    """ the quote pool of that size, shared by every request so the number of upstream connections stays bounded """
+
+    with _executor_lock:
+        executor = _executors.get(max_workers)
+        if executor is None:
+            executor = _executors[max_workers] = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"quote-fetch-{max_workers}")
+        return executor
+
+
+def fetch_latest_prices(tickers: Iterable[str], max_workers: int = 8, timeout: float = 5.0, max_age: Optional[float] = None) -> Dict[str, Optional[float]]:
+    """
+    Parameters:
+        tickers (Iterable[str]): The ticker symbols to price, duplicates are only fetched once.
+        max_workers (int): The size of the shared quote pool.
+        timeout (float): The deadline in seconds for the whole batch.
+        max_age (float): If given, stored quotes refreshed within max_age seconds are used and only the rest is fetched live.
+
+    Returns:
+        Dict[str, Optional[float]]: The latest price of every ticker, or None if it failed or missed the deadline. Fetches
+        that had not started by the deadline are cancelled, so they do not hold the shared pool for later requests.
+    """
+
+    unique_tickers = list(dict.fromkeys(ticker.upper() for ticker in tickers))
+    if not unique_tickers:
+        return {}
+
+    prices = get_stored_prices(unique_tickers, max_age) if max_age is not None else {}
+
+    executor = _get_executor(max_workers)
+    # every fetch runs in a copy of the caller's context, so its upstream time is recorded to the request
+    futures = {ticker: executor.submit(copy_context().run, get_latest_stock_price, ticker) for ticker in unique_tickers if ticker not in prices}
+    wait(futures.values(), timeout=timeout)
+
+    for ticker, future in futures.items():
+        if not future.done():
+            future.cancel()
+            prices[ticker] = None
+            continue
+        if future.exception() is not None:
+            prices[ticker] = None
+            continue
+        price = future.result()
+        prices[ticker] = float(price) if price is not None else None
+    return prices
+
+
+def compute_unrealized_pnl(stocks: List, prices: Dict[str, Optional[float]]) -> Dict[str, Optional[float]]:
+    """
+    Parameters:
+        stocks (List[Stock]): The positions to value.
+        prices (Dict[str, Optional[float]]): The latest price by ticker, as returned by fetch_latest_prices.
+
+    Returns:
+        Dict[str, Optional[float]]: The unrealized profit/loss of every position, None where the quote is missing.
+    """
+
+    if not stocks:
+        return {}
+
+    tickers = [stock.ticker for stock in stocks]
+    shares = np.array([float(stock.shares) for stock in stocks])
+    cost_basis = np.array([float(stock.cost_basis) for stock in stocks])
+    latest = np.array([prices.get(ticker.upper()) for ticker in tickers], dtype=float)  # missing quotes become nan
+
+    pnl = np.round(latest * shares - cost_basis, 2)
+
+    return {ticker: (None if np.isnan(value) else float(value)) for ticker, value in zip(tickers, pnl)}
+
+
+def value_portfolio(stocks: List, max_workers: int = 8, timeout: float = 5.0, max_age: Optional[float] = None) -> Dict[str, Optional[float]]:
+    """ fetches the quotes of every position in parallel and returns the unrealized profit/loss by ticker """
+
+    prices = fetch_latest_prices((stock.ticker for stock in stocks), max_workers=max_workers, timeout=timeout, max_age=max_age)
+    return compute_unrealized_pnl(stocks, prices)
@@ -0,0 +1,238 @@
+import json
+import logging
+import threading
+import time
+from collections import namedtuple
+from typing import Dict, Iterable, Iterator, List
+
+from website.stock import upstream
+
+logger = logging.getLogger(__name__)
+
+PriceUpdate = namedtuple("PriceUpdate", ["ticker", "price", "at"])
+
+
+class TooManySubscribers(Exception):
+    """ raised when the hub of this process already serves its maximum number of streams """
+
+
+class Subscription:
+    """
+    The updates waiting for a single stream.
+
+    Only the newest update of every ticker is kept, so a client that reads slower than the prices move gets fewer, more
+    recent updates instead of a growing backlog, and the memory a subscription holds is bounded by its tickers.
+
+    Attributes:
+        tickers (frozenset): The ticker symbols the stream subscribed to.
+        conflated (int): How many updates were replaced by a newer one before the client read them.
+    """
+
+    def __init__(self, tickers: Iterable[str]):
+        self.tickers = frozenset(tickers)
+        self.conflated = 0
+        self.closed = False
+
+        self._pending: Dict[str, PriceUpdate] = {}
+        self._condition = threading.Condition()
+
+    def offer(self, update: PriceUpdate):
+        with self._condition:
+            if update.ticker in self._pending:
+                self.conflated += 1
+            self._pending[update.ticker] = update
+            self._condition.notify()
+
+    def take(self, timeout: float) -> List[PriceUpdate]:
+        """ waits up to timeout seconds for updates and returns every pending one, an empty list if none came """
+
+        with self._condition:
+            if not self._pending and not self.closed:
+                self._condition.wait(timeout)
+            updates = list(self._pending.values())
+            self._pending.clear()
+            return updates
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify()
+
+
+class PriceHub:
+    """
+    Polls the price of every ticker that at least one stream subscribed to, once per interval, and fans the changes out.
+
+    The upstream load depends on the number of distinct subscribed tickers, not on the number of connected clients. The
+    polls go through fetch_latest_prices, so they use the prices stored by the ingestion and the price cache first.
+
+    Attributes:
+        app (Flask): The application whose database and market data provider are used.
+        interval (float): Seconds between two polls.
+        max_subscribers (int): The maximum number of streams of this process.
+    """
+
+    def __init__(self, app, interval: float = 15.0, max_subscribers: int = 200):
+        self.app = app
+        self.interval = interval
+        self.max_subscribers = max_subscribers
+
+        self._subscribers: Dict[str, List[Subscription]] = {}
+        self._subscriptions = 0
+        self._last: Dict[str, PriceUpdate] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._polls = 0
+
+    def subscribe(self, tickers: Iterable[str]) -> Subscription:
+        """ registers a stream, the last known price of every ticker is offered right away, new tickers are polled right away """
+
+        subscription = Subscription(ticker.upper() for ticker in tickers)
+        with self._lock:
+            if self._subscriptions >= self.max_subscribers:
+                raise TooManySubscribers(f"{self._subscriptions} price streams are open, the limit is {self.max_subscribers}")
+            self._subscriptions += 1
+
+            new_ticker = False
+            for ticker in subscription.tickers:
+                new_ticker |= ticker not in self._subscribers
+                self._subscribers.setdefault(ticker, []).append(subscription)
+                if ticker in self._last:
+                    subscription.offer(self._last[ticker])
+            self._start()
+        if new_ticker:
+            self._wake.set()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """ removes a stream, unsubscribing one that is already gone does nothing """
+
+        with self._lock:
+            if subscription.closed:
+                return
+            subscription.close()
+            self._subscriptions -= 1
+            for ticker in subscription.tickers:
+                subscribers = self._subscribers.get(ticker, [])
+                if subscription in subscribers:
+                    subscribers.remove(subscription)
+                if not subscribers:
+                    self._subscribers.pop(ticker, None)
+                    self._last.pop(ticker, None)
+
+    def poll_once(self) -> int:
+        """ fetches the price of every subscribed ticker once, offers the changed ones and returns their number """
+
+        from website.stock.portfolio import fetch_latest_prices
+
+        with self._lock:
+            tickers = list(self._subscribers)
+        if not tickers:
+            return 0
+
+        # a poll serves every stream at once, so it runs as background work and leaves the users' share of the quota alone
+        with self.app.app_context(), upstream.priority(upstream.BACKGROUND):
+            prices = fetch_latest_prices(tickers, max_workers=self.app.config["QUOTE_FETCH_WORKERS"],
+                                         timeout=self.app.config["QUOTE_FETCH_TIMEOUT"], max_age=self.interval)
+
+        now = time.time()
+        changed = 0
+        with self._lock:
+            self._polls += 1
+            for ticker, price in prices.items():
+                last = self._last.get(ticker)
+                if price is None or ticker not in self._subscribers or (last is not None and last.price == price):
+                    continue
+                update = self._last[ticker] = PriceUpdate(ticker, price, now)
+                for subscription in self._subscribers[ticker]:
+                    subscription.offer(update)
+                changed += 1
+        return changed
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"subscribers": self._subscriptions, "tickers": len(self._subscribers), "polls": self._polls}
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="price-stream", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.clear()
+            started = time.monotonic()
+            try:
+                self.poll_once()
+            except Exception:
+                logger.exception("Price stream poll failed")
+
+            with self._lock:
+                idle = not self._subscribers
+            # an idle hub sleeps until the next subscription, a busy one polls every interval or as soon as a new ticker is added
+            self._wake.wait(None if idle else max(0.0, self.interval - (time.monotonic() - started)))
+
+
+def format_event(update: PriceUpdate) -> str:
+    return f"event: price\ndata: {json.dumps({'ticker': update.ticker, 'price': update.price, 'at': round(update.at, 3)})}\n\n"
+
+
+def stream(hub: PriceHub, subscription: Subscription, heartbeat: float = 15.0) -> Iterator[str]:
+    """
+    Yields the server-sent events of a subscription until the client disconnects.
+
+    A comment line is sent when nothing happened for heartbeat seconds, so proxies keep the connection open and a closed
+    connection is noticed. The subscription is removed once the response is closed.
+    """
+
+    try:
+        yield f"retry: {int(hub.interval * 1000)}\n\n"
+        while not subscription.closed:
+            updates = subscription.take(heartbeat)
+            if not updates:
+                yield ": keep-alive\n\n"
+            for update in updates:
+                yield format_event(update)
+    finally:
+        hub.unsubscribe(subscription)
+
+
+def get_hub(app) -> PriceHub:
+    """ returns the hub of the app, created on first use """
+
+    hub = app.extensions.get("price_hub")
+    if hub is None:
+        hub = app.extensions.setdefault("price_hub", PriceHub(app, interval=app.config["PRICE_STREAM_INTERVAL"],
+                                                             max_subscribers=app.config["PRICE_STREAM_MAX_SUBSCRIBERS"]))
+    return hub
+
+
+def stream_capacity(config) -> int:
+    """ returns how many streams a worker process may hold, PRICE_STREAM_MAX_SUBSCRIBERS capped below its request threads """
+
+    limit = config["PRICE_STREAM_MAX_SUBSCRIBERS"]
+    threads = config["WEB_THREADS"]
+    if threads <= 0:
+        return limit
+    return max(min(limit, threads - config["PRICE_STREAM_RESERVED_THREADS"]), 0)
+
+
+def init_app(app):
+    """
+    Checks the stream limit against the request threads of a worker. Every open stream holds a request thread, so a limit
+    at or above WEB_THREADS would let the streams take every thread and the page requests would hang. A too high
+    PRICE_STREAM_MAX_SUBSCRIBERS is lowered with a warning, a thread count that leaves no thread to the pages is refused.
+    """
+
+    threads = app.config["WEB_THREADS"]
+    if threads > 0 and app.config["PRICE_STREAM_RESERVED_THREADS"] < 1:
+        raise ValueError(f"PRICE_STREAM_RESERVED_THREADS must be at least 1 when WEB_THREADS is set ({threads}), "
+                         "otherwise the price streams can hold every request thread")
+
+    capacity = stream_capacity(app.config)
+    if capacity < app.config["PRICE_STREAM_MAX_SUBSCRIBERS"]:
+        logger.warning("PRICE_STREAM_MAX_SUBSCRIBERS lowered from %d to %d, a worker has %d request threads and keeps %d for "
+                       "the pages", app.config["PRICE_STREAM_MAX_SUBSCRIBERS"], capacity, threads,
+                       app.config["PRICE_STREAM_RESERVED_THREADS"])
+        app.config["PRICE_STREAM_MAX_SUBSCRIBERS"] = capacity
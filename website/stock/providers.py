@@ -0,0 +1,438 @@
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+import zlib
+from collections import namedtuple
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from flask import current_app, has_app_context
+
+from website.stock import upstream
+from website.stock.errors import MarketDataError, UnknownTickerError, UpstreamThrottledError, UpstreamUnavailableError  # noqa: F401 (re-exported)
+
+Bar = namedtuple("Bar", ["timestamp", "open", "high", "low", "close", "volume"])
+
+
+class MarketDataProvider:
+    """
+    The interface every market data source implements. Series are always returned oldest first.
+
+    Methods:
+        get_latest_price: Returns the latest close price of a ticker.
+        get_intraday: Returns the intraday bars of a ticker, only the ones after since if it is given.
+        search_symbols: Returns the symbols matching the keywords, each as a dict with a symbol and a name.
+        get_balance_sheet: Returns the raw balance sheet reports of a ticker.
+        get_cash_flow: Returns the raw cash flow reports of a ticker.
+        get_listing: Returns every listed symbol as CSV text with at least a symbol and a name column.
+
+    The price, intraday and symbol search calls also have async variants (aget_latest_price, aget_intraday and
+    asearch_symbols), which run the blocking call in a thread unless the provider has a native async implementation.
+    """
+
+    name = None
+
+    def get_latest_price(self, stock_ticker: str) -> float:
+        raise NotImplementedError
+
+    def get_intraday(self, stock_ticker: str, interval: str = "60min", since: Optional[datetime] = None) -> List[Bar]:
+        raise NotImplementedError
+
+    def search_symbols(self, keywords: str) -> List[Dict[str, str]]:
+        raise NotImplementedError
+
+    def get_balance_sheet(self, stock_ticker: str) -> dict:
+        raise NotImplementedError
+
+    def get_cash_flow(self, stock_ticker: str) -> dict:
+        raise NotImplementedError
+
+    def get_listing(self) -> str:
+        raise NotImplementedError
+
+    async def aget_latest_price(self, stock_ticker: str) -> float:
+        return await asyncio.to_thread(self.get_latest_price, stock_ticker)
+
+    async def aget_intraday(self, stock_ticker: str, interval: str = "60min", since: Optional[datetime] = None) -> List[Bar]:
+        return await asyncio.to_thread(self.get_intraday, stock_ticker, interval, since)
+
+    async def asearch_symbols(self, keywords: str) -> List[Dict[str, str]]:
+        return await asyncio.to_thread(self.search_symbols, keywords)
+
+
+class AlphaVantageProvider(MarketDataProvider):
+    """
+    fetches live data from Alpha Vantage, the TimeSeries client is only created on first use
+
+    Every call goes through the shared upstream client, which enforces the quota, retries and the circuit breaker, and
+    failures are raised as UnknownTickerError, UpstreamThrottledError or UpstreamUnavailableError. The async variants
+    call the query endpoint at base_url directly through the shared async_http session.
+    """
+
+    name = "alpha_vantage"
+    base_url = "https://www.alphavantage.co/query"
+    compact_days = 5  # 100 hourly bars of regular and extended trading hours always cover the last 5 days
+    _bar_columns = ("1. open", "2. high", "3. low", "4. close", "5. volume")
+
+    def __init__(self, api_key: Optional[str] = None, timeout: float = 10.0, base_url: Optional[str] = None):
+        self.api_key = api_key
+        self.timeout = timeout
+        if base_url:
+            self.base_url = base_url
+        self._ts = None
+
+    @property
+    def ts(self):
+        if self._ts is None:
+            from alpha_vantage.timeseries import TimeSeries
+            self._ts = TimeSeries(key=self.api_key, output_format="pandas")
+        return self._ts
+
+    def get_latest_price(self, stock_ticker):
+        return upstream.client.call(self._get_latest_price, stock_ticker)
+
+    def get_intraday(self, stock_ticker, interval="60min", since=None):
+        return upstream.client.call(self._get_intraday, stock_ticker, interval, since)
+
+    def search_symbols(self, keywords):
+        return upstream.client.call(self._search_symbols, keywords)
+
+    def get_balance_sheet(self, stock_ticker):
+        return upstream.client.call(self._query_fundamentals, "BALANCE_SHEET", stock_ticker)
+
+    def get_cash_flow(self, stock_ticker):
+        return upstream.client.call(self._query_fundamentals, "CASH_FLOW", stock_ticker)
+
+    def get_listing(self):
+        return upstream.client.call(self._get_listing)
+
+    async def aget_latest_price(self, stock_ticker):
+        data = await upstream.client.acall(self._aquery, "TIME_SERIES_DAILY_ADJUSTED", stock_ticker, symbol=stock_ticker)
+        try:
+            days = data["Time Series (Daily)"]
+            return float(days[max(days)]["4. close"])
+        except (KeyError, ValueError) as error:
+            raise MarketDataError(f"No price for {stock_ticker}") from error
+
+    async def aget_intraday(self, stock_ticker, interval="60min", since=None):
+        data = await upstream.client.acall(self._aquery, "TIME_SERIES_INTRADAY", stock_ticker, symbol=stock_ticker.upper(),
+                                           interval=interval, outputsize=self._outputsize(since))
+        try:
+            bars = [Bar(datetime.fromisoformat(timestamp), *(float(row[key]) for key in self._bar_columns))
+                    for timestamp, row in data[f"Time Series ({interval})"].items()]
+        except (KeyError, ValueError) as error:
+            raise MarketDataError(f"No intraday data for {stock_ticker}") from error
+
+        bars.sort(key=lambda bar: bar.timestamp)
+        return [bar for bar in bars if since is None or bar.timestamp > since]
+
+    async def asearch_symbols(self, keywords):
+        data = await upstream.client.acall(self._aquery, "SYMBOL_SEARCH", keywords, keywords=keywords)
+        try:
+            return [{"symbol": match["1. symbol"], "name": match["2. name"]} for match in data["bestMatches"]]
+        except (KeyError, TypeError) as error:
+            raise MarketDataError(f"Symbol search failed for {keywords}") from error
+
+    def _outputsize(self, since):
+        # the compact output only holds the latest 100 bars, so the full history is only downloaded when since is older than that
+        return "compact" if since is not None and since >= datetime.now() - timedelta(days=self.compact_days) else "full"
+
+    def _get_latest_price(self, stock_ticker):
+        try:
+            data, _ = self.ts.get_daily_adjusted(symbol=stock_ticker)
+            return float(data["4. close"].iloc[0])
+        except Exception as error:
+            raise self._classify(error, f"No price for {stock_ticker}") from error
+
+    def _get_intraday(self, stock_ticker, interval, since):
+        try:
+            data, _ = self.ts.get_intraday(symbol=stock_ticker.upper(), interval=interval, outputsize=self._outputsize(since))
+        except Exception as error:
+            raise self._classify(error, f"No intraday data for {stock_ticker}") from error
+
+        data = data.sort_index()
+        if since is not None:
+            data = data[data.index > since]
+        return [Bar(timestamp.to_pydatetime(), *row) for timestamp, row in zip(data.index, data[list(self._bar_columns)].itertuples(index=False))]
+
+    def _search_symbols(self, keywords):
+        try:
+            data, _ = self.ts.get_symbol_search(keywords=keywords)
+        except Exception as error:
+            raise self._classify(error, f"Symbol search failed for {keywords}") from error
+
+        return [{"symbol": symbol, "name": name} for symbol, name in zip(data["1. symbol"], data["2. name"])]
+
+    def _query_fundamentals(self, function, stock_ticker):
+        import requests
+
+        try:
+            response = requests.get(self.base_url, params={"function": function, "symbol": stock_ticker, "apikey": self.api_key}, timeout=self.timeout)
+            response.raise_for_status()
+            return self._check_answer(response.json(), f"{function} failed for {stock_ticker}")
+        except (requests.RequestException, ValueError) as error:
+            raise self._classify(error, f"{function} failed for {stock_ticker}") from error
+
+    def _get_listing(self):
+        import requests
+
+        try:
+            response = requests.get(self.base_url, params={"function": "LISTING_STATUS", "apikey": self.api_key}, timeout=self.timeout)
+            response.raise_for_status()
+        except requests.RequestException as error:
+            raise self._classify(error, "LISTING_STATUS failed") from error
+
+        # the listing is answered as CSV, errors and rate limiting still come as JSON
+        if not response.text.startswith("symbol,"):
+            try:
+                self._check_answer(response.json(), "LISTING_STATUS failed")
+            except ValueError:
+                pass
+            raise UpstreamUnavailableError("LISTING_STATUS failed: unexpected answer")
+        return response.text
+
+    async def _aquery(self, function, subject, **params):
+        import aiohttp
+        from website.stock.async_http import http_client
+
+        try:
+            data = await http_client.get_json(self.base_url, params={"function": function, "apikey": self.api_key or "", **params})
+        except aiohttp.ClientResponseError as error:
+            raise self._classify(error, f"{function} failed for {subject}") from error
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as error:
+            raise UpstreamUnavailableError(f"{function} failed for {subject}: {error!r}") from error
+        return self._check_answer(data, f"{function} failed for {subject}")
+
+    @classmethod
+    def _check_answer(cls, data, message):
+        """ errors and rate limiting are answered with 200 and a message instead of the data """
+
+        if not isinstance(data, dict):
+            raise UpstreamUnavailableError(f"{message}: unexpected answer")
+        for key in ("Error Message", "Note", "Information"):
+            if key in data:
+                raise cls._classify(ValueError(data[key]), message)
+        return data
+
+    @staticmethod
+    def _classify(error: Exception, message: str) -> MarketDataError:
+        """ turns whatever the http client or the alpha_vantage library raised into a typed market data error """
+
+        if isinstance(error, MarketDataError):
+            return error
+
+        status = getattr(error, "status", None) or getattr(getattr(error, "response", None), "status_code", None)
+        if status == 429:
+            return UpstreamThrottledError(f"{message}: rate limited")
+        if status is not None and status < 500:
+            return MarketDataError(f"{message}: {error}")
+        if status is not None or isinstance(error, (OSError, asyncio.TimeoutError, json.JSONDecodeError)):
+            # server errors, network errors (requests' errors are OSErrors too), timeouts and garbled answers
+            return UpstreamUnavailableError(f"{message}: {error}")
+
+        # the alpha_vantage library raises a ValueError with the message of the answer
+        text = str(error).lower()
+        if any(phrase in text for phrase in ("rate limit", "call frequency", "premium", "requests per")):
+            return UpstreamThrottledError(f"{message}: {error}")
+        if "invalid api call" in text:
+            return UnknownTickerError(message)
+        return MarketDataError(f"{message}: {error}")
+
+
+class ReplayProvider(MarketDataProvider):
+    """
+    A deterministic offline provider for load tests and benchmarks.
+
+    Tickers recorded in data_dir (one <TICKER>.json file each, see record_provider) are replayed as they were recorded,
+    every other ticker gets a synthetic random walk seeded by its symbol, so the same ticker always returns the same data.
+
+    Attributes:
+        data_dir (str): Directory with recorded tickers, or None to only serve synthetic data.
+        latency (float): Seconds every call sleeps before answering, to mimic the upstream round trip.
+        jitter (float): Extra random latency in seconds added on top of latency.
+        error_rate (float): The share of calls, between 0 and 1, that raise a MarketDataError.
+        bars (int): The number of synthetic intraday bars per ticker.
+        unknown_tickers (bool): If False only recorded tickers are valid, the rest raise a MarketDataError.
+    """
+
+    name = "replay"
+    anchor = datetime(2023, 1, 3, 20, 0)
+
+    def __init__(self, data_dir: Optional[str] = None, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 bars: int = 100, unknown_tickers: bool = True, seed: int = 0):
+        self.data_dir = data_dir
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.bars = bars
+        self.unknown_tickers = unknown_tickers
+
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._recorded = {}
+
+    def get_latest_price(self, stock_ticker):
+        return self.get_intraday(stock_ticker)[-1].close
+
+    def get_intraday(self, stock_ticker, interval="60min", since=None):
+        bars = self._load(stock_ticker)["bars"]
+        if since is not None:
+            bars = [bar for bar in bars if bar.timestamp > since]
+        return bars
+
+    def search_symbols(self, keywords):
+        keywords = keywords.upper()
+        return [{"symbol": keywords, "name": self._load(keywords)["name"]}]
+
+    async def aget_latest_price(self, stock_ticker):
+        await self._asimulate_upstream(stock_ticker)
+        return self._lookup(stock_ticker)["bars"][-1].close
+
+    async def aget_intraday(self, stock_ticker, interval="60min", since=None):
+        await self._asimulate_upstream(stock_ticker)
+        return [bar for bar in self._lookup(stock_ticker)["bars"] if since is None or bar.timestamp > since]
+
+    async def asearch_symbols(self, keywords):
+        await self._asimulate_upstream(keywords)
+        keywords = keywords.upper()
+        return [{"symbol": keywords, "name": self._lookup(keywords)["name"]}]
+
+    def get_balance_sheet(self, stock_ticker):
+        return self._load(stock_ticker)["balance_sheet"]
+
+    def get_cash_flow(self, stock_ticker):
+        return self._load(stock_ticker)["cash_flow"]
+
+    def _load(self, stock_ticker):
+        self._simulate_upstream(stock_ticker)
+        return self._lookup(stock_ticker)
+
+    def _lookup(self, stock_ticker):
+        stock_ticker = stock_ticker.upper()
+        if stock_ticker not in self._recorded:
+            recorded = self._read_recording(stock_ticker)
+            if recorded is None:
+                if not self.unknown_tickers or not stock_ticker.isalpha() or len(stock_ticker) > 5:
+                    raise UnknownTickerError(f"Unknown ticker {stock_ticker}")
+                recorded = self._synthesize(stock_ticker)
+            self._recorded[stock_ticker] = recorded
+        return self._recorded[stock_ticker]
+
+    def _draw_upstream(self):
+        with self._random_lock:
+            return self.latency + self._random.uniform(0, self.jitter), self._random.random() < self.error_rate
+
+    def _simulate_upstream(self, stock_ticker):
+        delay, failed = self._draw_upstream()
+        if delay:
+            time.sleep(delay)
+        if failed:
+            raise UpstreamUnavailableError(f"Injected upstream error for {stock_ticker.upper()}")
+
+    async def _asimulate_upstream(self, stock_ticker):
+        delay, failed = self._draw_upstream()
+        if delay:
+            await asyncio.sleep(delay)
+        if failed:
+            raise UpstreamUnavailableError(f"Injected upstream error for {stock_ticker.upper()}")
+
+    def _read_recording(self, stock_ticker):
+        if self.data_dir is None:
+            return None
+
+        path = os.path.join(self.data_dir, f"{stock_ticker}.json")
+        if not os.path.exists(path):
+            return None
+
+        with open(path) as file:
+            data = json.load(file)
+        data["bars"] = [Bar(datetime.fromisoformat(bar[0]), *bar[1:]) for bar in data["bars"]]
+        return data
+
+    def _synthesize(self, stock_ticker):
+        walk = random.Random(zlib.crc32(stock_ticker.encode()))
+        price = walk.uniform(10, 500)
+
+        bars = []
+        for index in range(self.bars):
+            open_price = price
+            price = max(1.0, price * (1 + walk.gauss(0, 0.01)))
+            high = max(open_price, price) * (1 + walk.uniform(0, 0.005))
+            low = min(open_price, price) * (1 - walk.uniform(0, 0.005))
+            timestamp = self.anchor - timedelta(hours=self.bars - 1 - index)
+            bars.append(Bar(timestamp, round(open_price, 2), round(high, 2), round(low, 2), round(price, 2), float(walk.randint(1_000, 1_000_000))))
+
+        total_assets = walk.randint(10**9, 10**12)
+        return {
+            "name": f"{stock_ticker} Synthetic Inc",
+            "bars": bars,
+            "balance_sheet": {"symbol": stock_ticker, "annualReports": [{"fiscalDateEnding": "2022-12-31", "reportedCurrency": "USD",
+                                                                         "totalAssets": str(total_assets), "currentDebt": str(total_assets // walk.randint(5, 50))}]},
+            "cash_flow": {"symbol": stock_ticker, "annualReports": [{"fiscalDateEnding": "2022-12-31", "reportedCurrency": "USD",
+                                                                     "operatingCashflow": str(total_assets // walk.randint(5, 50))}]},
+        }
+
+
+def record_provider(source: MarketDataProvider, tickers: List[str], data_dir: str):
+    """ snapshots the data of every ticker from source into data_dir so a ReplayProvider can replay it offline """
+
+    os.makedirs(data_dir, exist_ok=True)
+    for stock_ticker in tickers:
+        stock_ticker = stock_ticker.upper()
+        matches = [match for match in source.search_symbols(stock_ticker) if match["symbol"] == stock_ticker]
+        data = {
+            "name": matches[0]["name"] if matches else stock_ticker,
+            "bars": [[bar.timestamp.isoformat(), *map(float, bar[1:])] for bar in source.get_intraday(stock_ticker)],
+            "balance_sheet": source.get_balance_sheet(stock_ticker),
+            "cash_flow": source.get_cash_flow(stock_ticker),
+        }
+        with open(os.path.join(data_dir, f"{stock_ticker}.json"), "w") as file:
+            json.dump(data, file)
+
+
+PROVIDERS = {AlphaVantageProvider.name: AlphaVantageProvider, ReplayProvider.name: ReplayProvider}
+
+_provider = None
+
+
+def create_provider(config) -> MarketDataProvider:
+    """ builds the provider selected by the MARKET_DATA_PROVIDER config value """
+
+    name = config.get("MARKET_DATA_PROVIDER", AlphaVantageProvider.name)
+    if name not in PROVIDERS:
+        raise ValueError(f"Unknown market data provider {name}, expected one of {', '.join(PROVIDERS)}")
+
+    if name == ReplayProvider.name:
+        return ReplayProvider(data_dir=config.get("MARKET_DATA_REPLAY_DIR"), latency=config.get("MARKET_DATA_LATENCY", 0.0),
+                              jitter=config.get("MARKET_DATA_JITTER", 0.0), error_rate=config.get("MARKET_DATA_ERROR_RATE", 0.0))
+    return AlphaVantageProvider(api_key=config.get("ALPHA_VANTAGE_API_KEY"), base_url=config.get("ALPHA_VANTAGE_URL"))
+
+
+def init_app(app):
+    from website.stock import async_http
+    async_http.init_app(app)
+    upstream.init_app(app)
+
+    provider = create_provider(app.config)
+    app.extensions["market_data_provider"] = provider
+    set_provider(provider)
+
+
+def set_provider(provider: MarketDataProvider):
+    """ sets the provider used outside of an app context, e.g. by the quote pool threads """
+
+    global _provider
+    _provider = provider
+
+
+def get_provider() -> MarketDataProvider:
+    """ returns the provider of the current app, or the last configured one when there is no app context """
+
+    if has_app_context() and "market_data_provider" in current_app.extensions:
+        return current_app.extensions["market_data_provider"]
+    if _provider is None:
+        raise RuntimeError("No market data provider configured, call init_app first")
+    return _provider
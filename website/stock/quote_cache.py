@@ -0,0 +1,203 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+
+class _Flight:
+    """ a single in-progress upstream fetch that other callers can wait on """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class QuoteCache:
+    """
+    A thread-safe TTL cache with bounded LRU eviction and single-flight fetching.
+
+    Concurrent misses for the same key are coalesced, only the first caller runs the fetch function
+    and every other caller waits for its result.
+
+    Attributes:
+        name (str): The name of the cache, used when reporting stats.
+        ttl (float): How many seconds an entry stays fresh.
+        max_entries (int): The maximum number of entries kept before the least recently used one is evicted.
+        hits (int): Number of lookups served from the cache.
+        misses (int): Number of lookups that had to call the fetch function.
+        coalesced (int): Number of misses that waited on another caller's fetch instead of fetching themselves.
+        evictions (int): Number of entries dropped because the cache was full.
+    """
+
+    def __init__(self, name: str, ttl: float, max_entries: int = 1024, clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+        self._clock = clock
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._in_flight: Dict[Hashable, _Flight] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """ returns the fresh value stored under key, or None """
+
+        with self._lock:
+            return self._lookup(key)
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            self._store(key, value)
+
+    def invalidate(self, key: Optional[Hashable] = None):
+        """ drops a single key, or every entry if no key is given """
+
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def get_or_fetch(self, key: Hashable, fetch: Callable[[], Any], cache_if: Callable[[Any], bool] = lambda value: value is not None) -> Any:
+        """
+        Parameters:
+            key (Hashable): The cache key.
+            fetch (Callable): Called without arguments to produce the value on a miss.
+            cache_if (Callable): Decides if a fetched value should be stored, failed lookups are not cached by default.
+
+        Returns:
+            Any: The cached value, or the value returned by fetch.
+        """
+
+        with self._lock:
+            value = self._lookup(key)
+            if value is not None:
+                self.hits += 1
+                return value
+
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                self.misses += 1
+                flight = self._in_flight[key] = _Flight()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = fetch()
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                if flight.error is None and cache_if(flight.value):
+                    self._store(key, flight.value)
+                del self._in_flight[key]
+            flight.done.set()
+
+        return flight.value
+
+    async def aget_or_fetch(self, key: Hashable, fetch: Callable[[], Awaitable[Any]],
+                            cache_if: Callable[[Any], bool] = lambda value: value is not None) -> Any:
+        """ the async variant of get_or_fetch, fetch is a coroutine function and a caller waiting on another fetch does not block its loop """
+
+        with self._lock:
+            value = self._lookup(key)
+            if value is not None:
+                self.hits += 1
+                return value
+
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                self.misses += 1
+                flight = self._in_flight[key] = _Flight()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            await asyncio.to_thread(flight.done.wait)
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = await fetch()
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                if flight.error is None and cache_if(flight.value):
+                    self._store(key, flight.value)
+                del self._in_flight[key]
+            flight.done.set()
+
+        return flight.value
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"name": self.name, "ttl": self.ttl, "size": len(self._entries), "max_entries": self.max_entries,
+                    "hits": self.hits, "misses": self.misses, "coalesced": self.coalesced, "evictions": self.evictions}
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        value, expires_at = entry
+        if expires_at <= self._clock():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def _store(self, key, value):
+        self._entries[key] = (value, self._clock() + self.ttl)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+def cached(cache: QuoteCache, cache_if: Callable[[Any], bool] = lambda value: value is not None):
+    """ decorator that caches a single ticker argument function in the given cache, keyed by the upper case ticker """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(stock_ticker: str):
+            return cache.get_or_fetch(stock_ticker.upper(), lambda: func(stock_ticker), cache_if=cache_if)
+
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator
+
+
+def acached(cache: QuoteCache, cache_if: Callable[[Any], bool] = lambda value: value is not None):
+    """ the async variant of cached, for coroutine functions, sharing the entries of the sync functions using the same cache """
+
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(stock_ticker: str):
+            return await cache.aget_or_fetch(stock_ticker.upper(), lambda: func(stock_ticker), cache_if=cache_if)
+
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator
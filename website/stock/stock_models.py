@@ -1,24 +1,38 @@
-import pandas as pd
-from alpha_vantage.timeseries import TimeSeries
 import os
 from dotenv import load_dotenv
 from typing import List, Union, Tuple
-import requests
+from website.metrics import timed
+from website.stock import symbols
+from website.stock.quote_cache import QuoteCache, acached, cached
+from website.stock.providers import get_provider, MarketDataError, UpstreamThrottledError, UpstreamUnavailableError
 
 load_dotenv()
-api_key = key=os.getenv("API_KEY")
 
-ts = TimeSeries(key=api_key, output_format="pandas")
+# raised through by the functions below, so callers can tell a busy or failing upstream from an unknown ticker
+UPSTREAM_ERRORS = (UpstreamThrottledError, UpstreamUnavailableError)
+
+# every kind of market data goes stale at a different rate, so each one gets its own ttl (in seconds)
+price_cache = QuoteCache("price", ttl=float(os.getenv("PRICE_CACHE_TTL", 15)), max_entries=int(os.getenv("QUOTE_CACHE_SIZE", 2048)))
+intraday_cache = QuoteCache("intraday", ttl=float(os.getenv("INTRADAY_CACHE_TTL", 5 * 60)), max_entries=int(os.getenv("INTRADAY_CACHE_SIZE", 256)))
+company_name_cache = QuoteCache("company_name", ttl=float(os.getenv("COMPANY_NAME_CACHE_TTL", 7 * 24 * 60 * 60)), max_entries=int(os.getenv("QUOTE_CACHE_SIZE", 2048)))
+
+
+def get_cache_stats() -> List[dict]:
+    """ returns the hit, miss and eviction counters of every market data cache """
+
+    return [cache.stats() for cache in (price_cache, intraday_cache, company_name_cache)]
 
 
 def convert_timestamps_to_datetime(time_list: List):
     """ helper function for converting timestamps into datetime """
     
-    formatted_datetimes = [timestamp.to_pydatetime().strftime('%a, %d %b %Y %H:%M') for timestamp in time_list]
+    formatted_datetimes = [timestamp.strftime('%a, %d %b %Y %H:%M') for timestamp in time_list]
 
     return formatted_datetimes
 
 
+@cached(intraday_cache, cache_if=lambda value: value != ("None", "None"))
+@timed("upstream")
 def get_stock_prices_and_dates_by_ticker(stock_ticker: str) -> Union[str, Tuple[List[float], List[str]]]:
     """
     Parameters:
@@ -30,36 +44,96 @@ def get_stock_prices_and_dates_by_ticker(stock_ticker: str) -> Union[str, Tuple[
     """    
 
     try:
-        data, _ = ts.get_intraday(symbol=stock_ticker.upper(), interval="60min")
-        return data["4. close"].tolist(), convert_timestamps_to_datetime(data.index.tolist()[::-1])
-    except Exception:
+        bars = get_provider().get_intraday(stock_ticker.upper(), interval="60min")
+        return [bar.close for bar in bars], convert_timestamps_to_datetime([bar.timestamp for bar in bars])
+    except UPSTREAM_ERRORS:
+        raise
+    except MarketDataError:
         return "None", "None"
     
 
+@acached(intraday_cache, cache_if=lambda value: value != ("None", "None"))
+@timed("upstream")
+async def aget_stock_prices_and_dates_by_ticker(stock_ticker: str) -> Union[str, Tuple[List[float], List[str]]]:
+    """ the async variant of get_stock_prices_and_dates_by_ticker, sharing its cache """
+
+    try:
+        bars = await get_provider().aget_intraday(stock_ticker.upper(), interval="60min")
+        return [bar.close for bar in bars], convert_timestamps_to_datetime([bar.timestamp for bar in bars])
+    except UPSTREAM_ERRORS:
+        raise
+    except MarketDataError:
+        return "None", "None"
+
+
+@cached(price_cache)
+@timed("upstream")
 def get_latest_stock_price(stock_ticker):
+    """ returns the latest price, or None for an unknown ticker, raises UPSTREAM_ERRORS when the upstream is busy or failing """
+
+    try:
+        return get_provider().get_latest_price(stock_ticker)
+    except UPSTREAM_ERRORS:
+        raise
+    except MarketDataError:
+        return None
+
+
+@acached(price_cache)
+@timed("upstream")
+async def aget_latest_stock_price(stock_ticker):
     try:
-        data, _ = ts.get_daily_adjusted(symbol=stock_ticker)
-        return data["4. close"][0]
-    except Exception:
+        return await get_provider().aget_latest_price(stock_ticker)
+    except UPSTREAM_ERRORS:
+        raise
+    except MarketDataError:
         return None
     
 
+def _pick_company_name(stock_ticker, matches):
+    for match in matches:
+        if match["symbol"].upper() == stock_ticker.upper():
+            return match["name"]
+    return matches[0]["name"] if matches else None
+
+
 def get_company_name(stock_ticker):
-    ticker_data = ts.get_symbol_search(keywords=stock_ticker)
+    """ returns the company name from the symbol index, only tickers it does not know are searched upstream """
+
+    return symbols.company_name(stock_ticker) or _search_company_name(stock_ticker)
+
+
+async def aget_company_name(stock_ticker):
+    return symbols.company_name(stock_ticker) or await _asearch_company_name(stock_ticker)
+
 
+@cached(company_name_cache)
+@timed("upstream")
+def _search_company_name(stock_ticker):
     try:
-        return ticker_data[0]["2. name"][0]
-    except Exception:
+        return _pick_company_name(stock_ticker, get_provider().search_symbols(stock_ticker))
+    except UPSTREAM_ERRORS:
+        raise
+    except MarketDataError:
+        return None
+
+
+@acached(company_name_cache)
+@timed("upstream")
+async def _asearch_company_name(stock_ticker):
+    try:
+        return _pick_company_name(stock_ticker, await get_provider().asearch_symbols(stock_ticker))
+    except UPSTREAM_ERRORS:
+        raise
+    except MarketDataError:
         return None
 
 
 def get_balance_sheet(stock_ticker):
-    url = f"https://www.alphavantage.co/query?function=BALANCE_SHEET&symbol={stock_ticker}&apikey={api_key}"
-    response = requests.get(url)
-    if response.status_code == 200:
-        balance_sheet = response.json()
-        return balance_sheet
-    return "Balance sheet failed"
+    try:
+        return get_provider().get_balance_sheet(stock_ticker)
+    except MarketDataError:
+        return "Balance sheet failed"
 
 # print(get_balance_sheet("tsla")["annualReports"][0]["currentDebt"])
 
@@ -67,4 +141,7 @@ def get_balance_sheet(stock_ticker):
 # totalAssets
 
 def get_cashflow(stock_ticker):
-    url = f"https://www.alphavantage.co/query?function=CASH_FLOW&symbol={stock_ticker}&apikey={api_key}"
+    try:
+        return get_provider().get_cash_flow(stock_ticker)
+    except MarketDataError:
+        return "Cash flow failed"
@@ -0,0 +1,208 @@
+import csv
+import logging
+import os
+import threading
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import click
+
+logger = logging.getLogger(__name__)
+
+
+class SymbolIndex:
+    """
+    An immutable in-memory index of the listed symbols and their company names, searched with bisect on sorted arrays.
+
+    Attributes:
+        source (str): Where the listings were loaded from, if anywhere.
+        mtime (float): The modification time of the source when it was loaded.
+    """
+
+    def __init__(self, listings: Iterable[Tuple[str, str]] = (), source: Optional[str] = None, mtime: Optional[float] = None):
+        self.source = source
+        self.mtime = mtime
+
+        by_symbol = sorted({symbol.strip().upper(): name.strip() for symbol, name in listings if symbol and symbol.strip()}.items())
+        self._symbols = [symbol for symbol, _ in by_symbol]
+        self._names = [name for _, name in by_symbol]
+
+        # the lowercased names, sorted, each pointing back to its symbol's position
+        by_name = sorted((name.lower(), position) for position, name in enumerate(self._names) if name)
+        self._name_keys = [key for key, _ in by_name]
+        self._name_positions = [position for _, position in by_name]
+
+    @classmethod
+    def from_csv(cls, path: str) -> "SymbolIndex":
+        """ loads a listing file in the format of Alpha Vantage's LISTING_STATUS (symbol and name columns, delisted rows are skipped) """
+
+        mtime = os.path.getmtime(path)
+        with open(path, newline="", encoding="utf-8") as file:
+            rows = csv.DictReader(file)
+            listings = [(row["symbol"], row.get("name") or "") for row in rows if (row.get("status") or "Active").lower() == "active"]
+        return cls(listings, source=path, mtime=mtime)
+
+    def __len__(self) -> int:
+        return len(self._symbols)
+
+    def __contains__(self, symbol: str) -> bool:
+        return self._position(symbol) is not None
+
+    def company_name(self, symbol: str) -> Optional[str]:
+        position = self._position(symbol)
+        return self._names[position] or None if position is not None else None
+
+    def complete(self, prefix: str, limit: int = 10) -> List[Dict[str, str]]:
+        """ returns up to limit listings whose symbol, or else whose company name, starts with prefix, the exact symbol first """
+
+        prefix = prefix.strip()
+        if not prefix or limit <= 0:
+            return []
+
+        positions = list(self._prefix_range(self._symbols, prefix.upper(), limit))
+        if len(positions) < limit:
+            seen = set(positions)
+            positions += [position for position in (self._name_positions[key] for key in self._prefix_range(self._name_keys, prefix.lower(), limit * 2))
+                          if position not in seen][:limit - len(positions)]
+        return [{"symbol": self._symbols[position], "name": self._names[position]} for position in positions]
+
+    def _position(self, symbol: str) -> Optional[int]:
+        symbol = symbol.strip().upper()
+        position = bisect_left(self._symbols, symbol)
+        return position if position < len(self._symbols) and self._symbols[position] == symbol else None
+
+    @staticmethod
+    def _prefix_range(keys: List[str], prefix: str, limit: int) -> range:
+        start = bisect_left(keys, prefix)
+        end = start
+        while end < len(keys) and end - start < limit and keys[end].startswith(prefix):
+            end += 1
+        return range(start, end)
+
+
+# swapped for a new index by reload, readers take the reference once and are never blocked by a reload
+index = SymbolIndex()
+_reload_lock = threading.Lock()
+
+
+def is_listed(symbol: str) -> Optional[bool]:
+    """ returns whether the symbol is listed, or None when no listing is loaded and the caller has to ask the upstream """
+
+    current = index
+    return symbol in current if len(current) else None
+
+
+def company_name(symbol: str) -> Optional[str]:
+    return index.company_name(symbol)
+
+
+def complete(prefix: str, limit: int = 10) -> List[Dict[str, str]]:
+    return index.complete(prefix, limit)
+
+
+def reload(path: str, force: bool = False) -> bool:
+    """ loads the listing file into a new index and swaps it in, if the file changed since the last load, returns whether it did """
+
+    global index
+    with _reload_lock:
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return False
+        if not force and index.source == path and index.mtime == mtime:
+            return False
+
+        try:
+            new_index = SymbolIndex.from_csv(path)
+        except (OSError, KeyError, csv.Error, UnicodeDecodeError):
+            logger.exception("Could not load the symbol listing %s, keeping the current index", path)
+            return False
+
+        index = new_index
+        logger.info("Loaded %d symbols from %s", len(new_index), path)
+        return True
+
+
+class SymbolIndexReloader:
+    """
+    Loads the listing file in the background and reloads it whenever it changes, checked every interval seconds.
+
+    Attributes:
+        path (str): The listing file.
+        interval (float): Seconds between two checks, 0 to only load it once.
+    """
+
+    def __init__(self, path: str, interval: float = 300.0):
+        self.path = path
+        self.interval = interval
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="symbol-index", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                reload(self.path)
+            except Exception:
+                logger.exception("Symbol index reload failed")
+            if not self.interval:
+                return
+            self._stop.wait(self.interval)
+
+
+_reloader: Optional[SymbolIndexReloader] = None
+
+
+def listing_path(app) -> str:
+    return app.config["SYMBOL_LISTING_PATH"] or os.path.join(app.instance_path, "listing_status.csv")
+
+
+@click.command("update-symbols")
+def update_symbols_command():
+    """ Download the current symbol listing from the market data provider. """
+
+    from flask import current_app
+    from website.stock.providers import MarketDataError, get_provider
+
+    path = listing_path(current_app)
+    try:
+        listing = get_provider().get_listing()
+    except NotImplementedError:
+        raise click.ClickException(f"The {get_provider().name} provider has no symbol listing")
+    except MarketDataError as error:
+        raise click.ClickException(str(error))
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # written next to the old file and renamed over it, so a reload never reads a half written listing
+    with open(path + ".tmp", "w", encoding="utf-8", newline="") as file:
+        file.write(listing)
+    os.replace(path + ".tmp", path)
+
+    reload(path, force=True)
+    click.echo(f"Saved {len(index)} symbols to {path}")
+
+
+def init_app(app):
+    """ loads the symbol listing in the background and keeps it reloaded, if SYMBOL_INDEX_ENABLED is set """
+
+    global _reloader
+    app.cli.add_command(update_symbols_command)
+    if not app.config["SYMBOL_INDEX_ENABLED"]:
+        return
+
+    if _reloader is not None:
+        _reloader.stop()
+    _reloader = SymbolIndexReloader(listing_path(app), interval=app.config["SYMBOL_RELOAD_INTERVAL"])
+    _reloader.start()
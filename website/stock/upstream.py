@@ -0,0 +1,303 @@
+import asyncio
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from website.stock.errors import MarketDataError, UpstreamThrottledError, UpstreamUnavailableError
+
+logger = logging.getLogger(__name__)
+
+# priority classes, user facing calls may spend the whole quota while background calls leave a reserve for them
+USER = "user"
+BACKGROUND = "background"
+
+_priority: ContextVar[str] = ContextVar("upstream_priority", default=USER)
+
+
+@contextmanager
+def priority(value: str):
+    """ makes the upstream calls inside the with block use the given priority class, e.g. BACKGROUND for the ingestion """
+
+    token = _priority.set(value)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class QuotaStore:
+    """
+    Token buckets kept in a small sqlite file, so every worker process on the host draws from the same upstream quota.
+
+    Each bucket holds up to capacity tokens and refills continuously at capacity per period, a call takes one token
+    from every bucket or from none of them.
+
+    Attributes:
+        path (str): The sqlite file the buckets are kept in.
+        buckets (Dict[str, Tuple[float, float]]): The capacity and the refill period in seconds of every bucket by name.
+    """
+
+    def __init__(self, path: str, buckets: Dict[str, Tuple[float, float]], clock: Callable[[], float] = time.time):
+        self.path = path
+        self.buckets = buckets
+
+        self._clock = clock
+        self._local = threading.local()
+
+    def try_acquire(self, cost: float = 1.0, reserve: float = 0.0) -> float:
+        """
+        Parameters:
+            cost (float): The number of tokens the call takes from every bucket.
+            reserve (float): The share of every bucket, between 0 and 1, that has to be left over after the call.
+
+        Returns:
+            float: 0 if the tokens were taken, otherwise the number of seconds until they are expected to be available.
+        """
+
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            now = self._clock()
+            stored = {name: (tokens, updated_at) for name, tokens, updated_at in connection.execute("SELECT name, tokens, updated_at FROM bucket")}
+
+            levels, wait = {}, 0.0
+            for name, (capacity, period) in self.buckets.items():
+                tokens, updated_at = stored.get(name, (capacity, now))
+                rate = capacity / period
+                tokens = min(capacity, tokens + max(0.0, now - updated_at) * rate)
+                levels[name] = tokens
+
+                missing = cost + reserve * capacity - tokens
+                if missing > 0:
+                    wait = max(wait, missing / rate)
+
+            if wait == 0:
+                levels = {name: tokens - cost for name, tokens in levels.items()}
+            connection.executemany("INSERT OR REPLACE INTO bucket (name, tokens, updated_at) VALUES (?, ?, ?)",
+                                   [(name, tokens, now) for name, tokens in levels.items()])
+            connection.execute("COMMIT")
+            return wait
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def levels(self) -> Dict[str, float]:
+        """ returns the tokens left in every bucket as of the last call """
+
+        return {name: tokens for name, tokens in self._connect().execute("SELECT name, tokens FROM bucket")}
+
+    def _connect(self) -> sqlite3.Connection:
+        # sqlite connections can not be shared between threads, every thread gets its own
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.path != self.path:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute("CREATE TABLE IF NOT EXISTS bucket (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)")
+            self._local.connection, self._local.path = connection, self.path
+        return connection
+
+
+class CircuitBreaker:
+    """
+    Stops calling an upstream that keeps failing.
+
+    After failure_threshold failures in a row the circuit opens and every call fails right away for reset_timeout seconds,
+    then a single trial call is let through, which closes the circuit again if it succeeds.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0, clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+        self._clock = clock
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            return "half_open" if self._clock() - self.opened_at >= self.reset_timeout else "open"
+
+    def before_call(self):
+        """ raises UpstreamUnavailableError if the circuit is open """
+
+        with self._lock:
+            if self.opened_at is None:
+                return
+            remaining = self.reset_timeout - (self._clock() - self.opened_at)
+            if remaining > 0 or self._trial_running:
+                raise UpstreamUnavailableError(f"The market data provider is failing, calls are paused for {max(remaining, 0):.0f}s")
+            self._trial_running = True
+
+    def cancel(self):
+        """ called when a call let through by before_call was not made after all, so the next one can be the trial """
+
+        with self._lock:
+            self._trial_running = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_running or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self._trial_running:
+                    logger.warning("Opening the market data circuit after %d failures", self.failures)
+                self.opened_at = self._clock()
+            self._trial_running = False
+
+
+class UpstreamClient:
+    """
+    Runs every upstream call through the shared quota, a circuit breaker and jittered retries.
+
+    User facing calls wait up to max_wait seconds for quota, background calls never wait and leave background_reserve of
+    every bucket to the users. Only UpstreamUnavailableError is retried, a throttled or unknown ticker answer is raised
+    right away, retrying would only spend more of the quota.
+
+    Attributes:
+        store (QuotaStore): The shared token buckets, or None to call without a quota.
+        breaker (CircuitBreaker): The circuit breaker of this process.
+        max_attempts (int): How many times an unavailable upstream is tried.
+        backoff (float): The base delay in seconds between attempts, doubled after every attempt and fully jittered.
+        max_wait (float): How many seconds a user facing call waits for quota before it is throttled.
+        background_reserve (float): The share of every bucket background calls can not spend.
+    """
+
+    def __init__(self, store: Optional[QuotaStore] = None, breaker: Optional[CircuitBreaker] = None, max_attempts: int = 3,
+                 backoff: float = 0.5, max_wait: float = 2.0, background_reserve: float = 0.2):
+        self.store = store
+        self.breaker = breaker or CircuitBreaker()
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_wait = max_wait
+        self.background_reserve = background_reserve
+
+        self._stats_lock = threading.Lock()
+        self._counters = {"calls": 0, "retries": 0, "throttled": 0, "unavailable": 0}
+
+    def call(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        for attempt in range(1, self.max_attempts + 1):
+            self.breaker.before_call()
+            try:
+                deadline = time.monotonic() + self.max_wait
+                while True:
+                    wait = self._acquire(deadline)
+                    if not wait:
+                        break
+                    time.sleep(wait)
+
+                try:
+                    return self._succeeded(func(*args, **kwargs))
+                except MarketDataError as error:
+                    delay = self._failed(error, attempt)
+            except BaseException:
+                # an attempt that ends in anything but a provider error must not keep the trial of a half-open circuit
+                self.breaker.cancel()
+                raise
+            time.sleep(delay)
+
+    async def acall(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """ the async variant of call, func is a coroutine function, the quota is taken in a thread to keep the event loop free """
+
+        for attempt in range(1, self.max_attempts + 1):
+            self.breaker.before_call()
+            try:
+                deadline = time.monotonic() + self.max_wait
+                while True:
+                    # the shared quota is a sqlite transaction that can wait for other processes' locks
+                    wait = await asyncio.to_thread(self._acquire, deadline) if self.store is not None else 0.0
+                    if not wait:
+                        break
+                    await asyncio.sleep(wait)
+
+                try:
+                    return self._succeeded(await func(*args, **kwargs))
+                except MarketDataError as error:
+                    delay = self._failed(error, attempt)
+            except BaseException:
+                # also a cancelled gather, which raises CancelledError into the awaiting call
+                self.breaker.cancel()
+                raise
+            await asyncio.sleep(delay)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = dict(self._counters)
+        stats["circuit"] = self.breaker.state
+        if self.store is not None:
+            stats["quota"] = self.store.levels()
+        return stats
+
+    def _acquire(self, deadline: float) -> float:
+        """ takes a token and returns 0, or returns how long to wait before trying again, raises if that is past the deadline """
+
+        if self.store is None:
+            return 0.0
+
+        background = _priority.get() == BACKGROUND
+        wait = self.store.try_acquire(reserve=self.background_reserve if background else 0.0)
+        if wait and (background or time.monotonic() + wait > deadline):
+            self.breaker.cancel()
+            self._count("throttled")
+            raise UpstreamThrottledError("The market data quota is used up, please try again in a moment!", retry_after=wait)
+        return wait
+
+    def _succeeded(self, value):
+        self.breaker.record_success()
+        self._count("calls")
+        return value
+
+    def _failed(self, error: MarketDataError, attempt: int) -> float:
+        """ re-raises the error unless the call should be retried, in which case it returns the delay before the retry """
+
+        self._count("calls")
+        if not isinstance(error, UpstreamUnavailableError):
+            # the upstream answered, so it is up, even if the answer is an error
+            self.breaker.record_success()
+            if isinstance(error, UpstreamThrottledError):
+                self._count("throttled")
+            raise error
+
+        self.breaker.record_failure()
+        self._count("unavailable")
+        if attempt >= self.max_attempts:
+            raise error
+
+        self._count("retries")
+        return random.uniform(0, self.backoff * 2 ** (attempt - 1))
+
+    def _count(self, counter: str):
+        with self._stats_lock:
+            self._counters[counter] += 1
+
+
+client = UpstreamClient()
+
+
+def init_app(app):
+    """ configures the shared client from the UPSTREAM_* config values """
+
+    path = app.config["UPSTREAM_QUOTA_PATH"] or os.path.join(app.instance_path, "upstream_quota.sqlite")
+    buckets = {"minute": (app.config["UPSTREAM_CALLS_PER_MINUTE"], 60.0), "day": (app.config["UPSTREAM_CALLS_PER_DAY"], 24 * 60 * 60.0)}
+
+    client.store = QuotaStore(path, buckets) if app.config["UPSTREAM_QUOTA_ENABLED"] else None
+    client.breaker = CircuitBreaker(failure_threshold=app.config["UPSTREAM_BREAKER_THRESHOLD"], reset_timeout=app.config["UPSTREAM_BREAKER_RESET"])
+    client.max_attempts = app.config["UPSTREAM_MAX_ATTEMPTS"]
+    client.backoff = app.config["UPSTREAM_BACKOFF"]
+    client.max_wait = app.config["UPSTREAM_MAX_WAIT"]
+    client.background_reserve = app.config["UPSTREAM_BACKGROUND_RESERVE"]
@@ -0,0 +1,71 @@
+from typing import Optional
+
+from flask import current_app, has_request_context, request
+from sqlalchemy import inspect, select
+from sqlalchemy.orm import joinedload, make_transient_to_detached
+
+from website import db
+from website.models import User
+from website.stock.quote_cache import QuoteCache
+
+# the cache is per process, so another worker's change is only seen once the entry expires, keep the ttl short
+_cache = QuoteCache("user", ttl=30, max_entries=4096)
+
+
+def eager_positions(view):
+    """ declares that a view uses current_user.stocks, so the user loader fetches the positions in the same query """
+
+    view.eager_positions = True
+    return view
+
+
+def _view_wants_positions() -> bool:
+    if not has_request_context() or request.endpoint is None:
+        return False
+    view = current_app.view_functions.get(request.endpoint)
+    return getattr(view, "eager_positions", False)
+
+
+def _snapshot(user: User) -> dict:
+    return {attribute.key: getattr(user, attribute.key) for attribute in inspect(User).column_attrs}
+
+
+def load_user(user_id: int) -> Optional[User]:
+    """
+    Returns the user for flask-login's user_loader.
+
+    Views marked with eager_positions get the user and its positions from a single joined query. Every other view gets
+    the user rebuilt from a short lived cache and merged into the session without any query.
+    """
+
+    if _view_wants_positions():
+        user = db.session.execute(select(User).options(joinedload(User.stocks)).where(User.id == user_id)).unique().scalar_one_or_none()
+        if user is not None:
+            _cache.set(user_id, _snapshot(user))
+        return user
+
+    snapshot = _cache.get(user_id)
+    if snapshot is None:
+        user = db.session.get(User, user_id)
+        if user is not None:
+            _cache.set(user_id, _snapshot(user))
+        return user
+
+    user = User(**snapshot)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def invalidate(user_id: Optional[int] = None):
+    """ drops the cached user after its balance, positions or credentials changed, or every user if no id is given """
+
+    _cache.invalidate(user_id)
+
+
+def stats() -> dict:
+    return _cache.stats()
+
+
+def init_app(app):
+    _cache.ttl = app.config["USER_CACHE_TTL"]
+    _cache.max_entries = app.config["USER_CACHE_SIZE"]
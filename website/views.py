@@ -1,29 +1,59 @@
-from flask import render_template, redirect, url_for, Blueprint, flash, request
+import asyncio
+import gzip
+from flask import render_template, redirect, url_for, Blueprint, flash, request, current_app, jsonify, Response
 from flask_login import login_required, current_user
-from website import db
-from website.models import Stock
+from website import db, orders
 from website.forms import PurchaseStockForm, SellStockForm
-from website.stock.stock_models import get_stock_prices_and_dates_by_ticker, get_company_name, get_latest_stock_price
+from website.stock.providers import UpstreamThrottledError
+from website.stock.stock_models import UPSTREAM_ERRORS, aget_company_name, aget_latest_stock_price, get_latest_stock_price
+from website.query_budget import query_budget
+from website.user_cache import eager_positions
 
 
 views = Blueprint("views", __name__)
 
 
+def flash_upstream_error(error):
+    """ tells the user why no live market data could be fetched """
+
+    if isinstance(error, UpstreamThrottledError):
+        flash(message="The market data quota is used up for the moment, prices may be out of date. Please try again shortly!", category="warning")
+    else:
+        flash(message="The market data provider is not answering right now, prices may be out of date.", category="warning")
+
+
+def stored_price(stock_ticker):
+    """ returns the cached or stored price of a ticker without calling the upstream, or None if there is none """
+
+    from website.models import Quote
+    from website.stock.stock_models import price_cache
+
+    price = price_cache.get(stock_ticker)
+    if price is None:
+        quote = db.session.get(Quote, stock_ticker)
+        price = quote.price if quote is not None else None
+    return price
+
+
 @views.route("/")
+@query_budget(1)
 def home_page():
     return render_template("home.html")
 
 
 @views.route("/stock_page/<stock_ticker>/<current_stock_price>", methods=["POST", "GET"])
 @login_required
-def stock_page(stock_ticker, current_stock_price):
+@query_budget(9)
+async def stock_page(stock_ticker, current_stock_price):
     """
-    This view function allows the user to buy stocks. It retrieves the stock ticker and price passed through the URL.
-    It then instantiates a form to enter the number of shares to purchase. If the form is submitted, it first checks
-    if the user already owns the stock, and if so, it adds the new shares to the existing shares and updates the average price.
-    If not, it adds the new stock to the database. It then flashes a success message and redirects the user to the stock ticker page.
-    If the form is not submitted, it renders the "buy_stock.html" template with the form, stock ticker, stock price and the filename
-    of the plot generated for that stock ticker. 
+    This view function allows the user to buy and sell stocks. It retrieves the stock ticker and price passed through the URL.
+    It then instantiates the forms to enter the number of shares to buy or sell. A submitted order is executed atomically by the
+    orders module, which updates the balance and the position in one transaction and only executes a resubmitted form once.
+    It then flashes a success message and redirects the user to the profile page.
+    If the form is not submitted, it fetches the latest quote, the company name and any new intraday bars concurrently, so the
+    page waits for the slowest of them instead of all of them in turn, and renders the "display_stock.html" template. When no
+    quote can be fetched the stored price is used, and without one an order is rejected. The price in the URL is only ever
+    displayed, never traded at. The chart data itself is loaded by the page from chart_data.
 
     :param stock_ticker: A string representing the stock ticker to buy.
     :param stock_price: A string representing the current price of the stock.
@@ -31,105 +61,94 @@ def stock_page(stock_ticker, current_stock_price):
     of the plot generated for that stock ticker.
     """
 
-    prices, dates = get_stock_prices_and_dates_by_ticker(stock_ticker)
-    current_stock_price = round(float(current_stock_price), 2)
-    
     buy_form = PurchaseStockForm()
     sell_form = SellStockForm()
-            
 
-    if buy_form.validate_on_submit() and buy_form.submit_buy.data:
-        
-        if not current_user.can_buy(total_cost=current_stock_price*float(buy_form.shares.data)):
-            flash(message=f"You don't have enough money to buy this amount of shares!", category="danger")
-            return redirect(url_for("views.profile_page"))
-        
-        buy_stock = Stock(
-            ticker=stock_ticker,
-            average_price=str(current_stock_price),
-            shares=buy_form.shares.data,
-            cost_basis=float(buy_form.shares.data) * current_stock_price,
-            user_id=current_user.id)
-        
-        owned_stock = Stock.query.filter_by(user_id=current_user.id, ticker=stock_ticker).first() # check if the user already owns this stock if so than add up his shares
-        if owned_stock:
-
-            # update the stock
-            old_total_shares = owned_stock.shares
-            new_total_shares = old_total_shares + buy_form.shares.data
-
-            old_cost_basis = owned_stock.cost_basis
-            new_cost_basis = old_cost_basis + (buy_form.shares.data * current_stock_price)
-
-            new_average_price = new_cost_basis / new_total_shares
+    if request.method == "GET":
+        from website.stock.ingestion import aread_stock_series
+
+        # the bars are only refreshed here, so the chart request that follows is answered from the database
+        latest_price, company_name, series = await asyncio.gather(
+            aget_latest_stock_price(stock_ticker), aget_company_name(stock_ticker),
+            aread_stock_series(stock_ticker, max_age=current_app.config["INTRADAY_MAX_AGE"]), return_exceptions=True)
+        for result in (latest_price, company_name, series):
+            if isinstance(result, BaseException) and not isinstance(result, UPSTREAM_ERRORS):
+                raise result
+
+        if isinstance(company_name, UPSTREAM_ERRORS):
+            company_name = None
+    else:
+        try:
+            latest_price = await aget_latest_stock_price(stock_ticker)
+        except UPSTREAM_ERRORS as error:
+            latest_price = error
+        company_name = None
+
+    upstream_error = latest_price if isinstance(latest_price, UPSTREAM_ERRORS) else None
+    if latest_price is None or upstream_error is not None:
+        # orders are only ever priced by the server, the price in the URL comes from the client
+        latest_price = stored_price(stock_ticker.upper())
+
+    ordered = (buy_form.submit_buy.data or sell_form.submit_sell.data) and request.method == "POST"
+    if ordered and latest_price is None:
+        if upstream_error is not None:
+            flash_upstream_error(upstream_error)
+        flash(message=f"There is no current price for {stock_ticker}, your order was not executed.", category="danger")
+        return redirect(url_for("views.profile_page"))
+    if upstream_error is not None and request.method == "GET":
+        flash_upstream_error(upstream_error)
 
-            owned_stock.shares = new_total_shares
-            owned_stock.average_price = new_average_price
-            owned_stock.cost_basis = new_cost_basis
+    # without any price the one from the URL is shown, it is never used for an order
+    current_stock_price = round(float(latest_price if latest_price is not None else current_stock_price), 2)
+            
 
-        else:
-            db.session.add(buy_stock)
+    if buy_form.validate_on_submit() and buy_form.submit_buy.data:
 
-        
-        current_user.balance -= float(buy_form.shares.data) * current_stock_price
-        db.session.commit()
+        try:
+            orders.buy(user_id=current_user.id, stock_ticker=stock_ticker, shares=buy_form.shares.data,
+                       price=current_stock_price, idempotency_key=buy_form.idempotency_key.data)
+        except orders.OrderError as error:
+            flash(message=str(error), category="danger")
+            return redirect(url_for("views.profile_page"))
 
         flash(message=f"You have bought the stock successfully!", category="success")
         return redirect(url_for("views.profile_page"))
 
 
     elif sell_form.validate_on_submit() and sell_form.submit_sell.data:
-    
-    
-        stock_shares_to_sell = sell_form.shares.data
-        owned_stock = Stock.query.filter_by(user_id=current_user.id, ticker=stock_ticker).first()
 
-        if not owned_stock:
-            flash(message=f"You dont own this stock! {stock_ticker}", category="danger")
-            
-            return redirect(url_for("views.stock_page", stock_ticker=stock_ticker, stock_price=str(current_stock_price)))
-        
-
-        if current_user.can_sell(stock_ticker=stock_ticker, shares=stock_shares_to_sell):
-
-            # update the stock
-            old_total_shares = owned_stock.shares
-            new_total_shares = old_total_shares - stock_shares_to_sell
-
-            if new_total_shares == 0: # if he sold all of his stocks
-                db.session.delete(owned_stock)
-
-            else:
-                new_average_price = (owned_stock.cost_basis - (stock_shares_to_sell * owned_stock.average_price)) / new_total_shares
-
-                owned_stock.shares = new_total_shares
-                owned_stock.average_price = round(new_average_price, 2)
-                owned_stock.cost_basis = new_average_price * new_total_shares
+        try:
+            trade = orders.sell(user_id=current_user.id, stock_ticker=stock_ticker, shares=sell_form.shares.data,
+                                price=current_stock_price, idempotency_key=sell_form.idempotency_key.data)
+        except orders.OrderError as error:
+            flash(message=str(error), category="danger")
+            return redirect(url_for("views.stock_page", stock_ticker=stock_ticker, current_stock_price=str(current_stock_price)))
 
-        # update the balance
-        current_user.balance += stock_shares_to_sell * current_stock_price
-
-        db.session.commit()
-        flash(message=f"You successfully sold {stock_shares_to_sell} amount of shares at {owned_stock.average_price}$", category="success")
+        flash(message=f"You successfully sold {trade.shares.normalize():f} amount of shares at {trade.price}$", category="success")
 
         return redirect(url_for("views.profile_page"))
 
-    users_owns_this_stock = False
-    user_stock = None
+    if request.method == "POST":
+        # a form that did not validate is shown again
+        try:
+            company_name = await aget_company_name(stock_ticker)
+        except UPSTREAM_ERRORS:
+            company_name = None
 
-    if current_user.check_if_user_own_this_stock(stock_ticker):
-        user_stock = Stock.query.filter_by(user_id=current_user.id, ticker=stock_ticker).first()
-        users_owns_this_stock = True
+    user_stock = current_user.get_position(stock_ticker)
+    users_owns_this_stock = user_stock is not None
 
     
     return render_template("display_stock.html", buy_form=buy_form, sell_form=sell_form, stock_ticker=stock_ticker
-                           ,stock_price=str(current_stock_price), prices=prices, dates=dates
-                           ,owns_stock=users_owns_this_stock, stock_obj=user_stock, company_name=get_company_name(stock_ticker))
+                           ,stock_price=str(current_stock_price)
+                           ,owns_stock=users_owns_this_stock, stock_obj=user_stock, company_name=company_name)
 
 
 
 @views.route("/profile", methods=["POST", "GET"])
 @login_required
+@query_budget(2)
+@eager_positions
 def profile_page():
     """
     Displays the profile page for the logged-in user. If the user submits the account creation form on this page, a new bank account is created for them and added to the database. 
@@ -138,11 +157,19 @@ def profile_page():
         render_template: Flask function that renders the profile.html template with the owned_stocks and account information.
     """
     
-    owned_stocks = Stock.query.filter_by(user_id=current_user.id)
-
     if request.method == "POST":
+        from website.stock import symbols
+
         ticker_symbol = request.form["search bar"].strip().upper()
-        stock_price = get_latest_stock_price(ticker_symbol)
+        # the symbol index answers without a network call, the upstream is only asked when no listing is loaded
+        listed = symbols.is_listed(ticker_symbol)
+        stock_price = stored_price(ticker_symbol) if listed else None
+        if listed is not False and stock_price is None:
+            try:
+                stock_price = get_latest_stock_price(ticker_symbol)
+            except UPSTREAM_ERRORS as error:
+                flash_upstream_error(error)
+                return redirect(url_for("views.profile_page"))
 
         
         if stock_price is None:
@@ -152,9 +179,192 @@ def profile_page():
         
         return redirect(url_for("views.stock_page", stock_ticker=ticker_symbol, current_stock_price=stock_price))
     
+    # the market data stack pulls in numpy, it is imported on first use so workers boot fast
+    from website.stock.portfolio import value_portfolio
+    from website.stock.analytics import get_portfolio_analytics
+
+    owned_stocks = current_user.stocks
+    current_prices_of_owned_stock = value_portfolio(owned_stocks, max_workers=current_app.config["QUOTE_FETCH_WORKERS"],
+                                                    timeout=current_app.config["QUOTE_FETCH_TIMEOUT"], max_age=current_app.config["QUOTE_MAX_AGE"])
+    analytics = get_portfolio_analytics(current_user.id, owned_stocks)
+
+    return render_template("profile.html", stocks=owned_stocks, balance=current_user.balance, stocks_state=current_prices_of_owned_stock,
+                           analytics=analytics)
+
+
+@views.route("/trades")
+@login_required
+@query_budget(1)
+def trades_page():
+    """
+    Displays the logged-in user's trades, newest first, one page at a time.
+
+    The "before" query argument is the cursor of the page, the "ticker" argument filters the trades by ticker.
+
+    Returns:
+        render_template: Flask function that renders the trades.html template with the trades and the cursor of the next page.
+    """
+
+    from website.ledger import trade_history
+
+    stock_ticker = request.args.get("ticker") or None
+    limit = min(request.args.get("limit", current_app.config["TRADE_HISTORY_PAGE_SIZE"], type=int), current_app.config["TRADE_HISTORY_MAX_PAGE_SIZE"])
+    page = trade_history(current_user.id, before=request.args.get("before", type=int), limit=max(limit, 1), stock_ticker=stock_ticker)
+
+    return render_template("trades.html", trades=page.trades, next_before=page.next_before, stock_ticker=stock_ticker)
+
+
+@views.route("/api/symbols")
+@login_required
+@query_budget(0)
+def symbol_search():
+    """
+    Autocompletes the ticker search from the local symbol index, without any network call.
+
+    :return: JSON with up to SYMBOL_SEARCH_LIMIT matches for the "q" query argument, each with a symbol and a name, the
+    symbols starting with the query first, then the company names.
+    """
+
+    from website.stock import symbols
+
+    limit = min(request.args.get("limit", current_app.config["SYMBOL_SEARCH_LIMIT"], type=int), current_app.config["SYMBOL_SEARCH_LIMIT"])
+    response = jsonify(matches=symbols.complete(request.args.get("q", ""), limit))
+    response.cache_control.private = True
+    response.cache_control.max_age = 60 * 60
+    return response
+
+
+@views.route("/api/stream/prices")
+@login_required
+@query_budget(1)
+def price_stream():
+    """
+    Streams price updates as server-sent events, for the tickers in the comma separated "tickers" query argument or, if
+    there is none, for every position of the logged-in user.
+
+    Every worker process polls each subscribed ticker once per PRICE_STREAM_INTERVAL and fans the changes out to all of its
+    streams, so the upstream load grows with the distinct tickers, not with the connected clients.
+
+    :return: A text/event-stream response with a "price" event per change, or 503 when the process serves too many streams.
+    """
+
+    from website.stock.price_stream import TooManySubscribers, get_hub, stream
+
+    tickers = [ticker.strip().upper() for ticker in request.args.get("tickers", "").split(",") if ticker.strip()]
+    if not tickers:
+        tickers = [stock.ticker.upper() for stock in current_user.stocks]
+    tickers = list(dict.fromkeys(tickers))[:current_app.config["PRICE_STREAM_MAX_TICKERS"]]
+    if not tickers:
+        return jsonify(error="No tickers to stream"), 400
+
+    hub = get_hub(current_app._get_current_object())
     try:
-        current_prices_of_owned_stock = {stock.ticker: (get_latest_stock_price(stock.ticker) * stock.shares) - stock.cost_basis for stock in owned_stocks}
-    except TypeError:
-        current_prices_of_owned_stock = {stock.ticker: 0 for stock in owned_stocks}
+        subscription = hub.subscribe(tickers)
+    except TooManySubscribers:
+        return jsonify(error="Too many price streams are open, please try again later"), 503, {"Retry-After": str(int(hub.interval))}
+
+    # the generator runs after the request context is gone, so it holds no database connection while it streams
+    response = Response(stream(hub, subscription, heartbeat=current_app.config["PRICE_STREAM_HEARTBEAT"]), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    # a client that disconnects before the first event never starts the generator, so its cleanup would not run
+    response.call_on_close(lambda: hub.unsubscribe(subscription))
+    return response
+
+
+@views.route("/api/portfolio/analytics")
+@login_required
+@query_budget(1)
+@eager_positions
+def portfolio_analytics():
+    """
+    Returns the analytics of the logged-in user's portfolio as JSON, for charting its value history.
+
+    :return: JSON with the days as epoch seconds, the daily portfolio value, daily returns and drawdown, the annualized
+    volatility, the largest drawdown, and the contribution and weight of every position.
+    """
+
+    from website.stock.analytics import get_portfolio_analytics
+
+    analytics = get_portfolio_analytics(current_user.id, current_user.stocks)
+    response = jsonify(days=analytics.days.astype("datetime64[s]").astype("int64").tolist(), values=analytics.values.round(2).tolist(),
+                       returns=analytics.returns.tolist(), drawdown=analytics.drawdown.tolist(), volatility=analytics.volatility,
+                       max_drawdown=analytics.max_drawdown, contributions=analytics.contributions, weights=analytics.weights,
+                       missing=analytics.missing)
+    response.cache_control.private = True
+    return response
+
+
+@views.route("/api/fundamentals")
+@login_required
+@query_budget(2)
+def fundamentals_comparison():
+    """
+    Compares fundamentals metrics across tickers from the local fundamentals store, without any upstream call.
+
+    :return: JSON with the latest "annual" or "quarterly" (the "period" query argument) value of every metric in the comma
+    separated "metrics" query argument, for every ticker in the comma separated "tickers" one, null where none is stored.
+    """
+
+    from website.stock import fundamentals
+
+    tickers = [ticker.strip().upper() for ticker in request.args.get("tickers", "").split(",") if ticker.strip()]
+    metrics = [metric.strip() for metric in request.args.get("metrics", "").split(",") if metric.strip()]
+    if not tickers or not metrics:
+        return jsonify(error="Tickers and metrics are required"), 400
+    if len(tickers) > current_app.config["FUNDAMENTALS_MAX_TICKERS"]:
+        return jsonify(error=f"At most {current_app.config['FUNDAMENTALS_MAX_TICKERS']} tickers can be compared"), 400
+
+    try:
+        table = fundamentals.compare(metrics, tickers, period=request.args.get("period", "annual"))
+    except ValueError as error:
+        return jsonify(error=str(error)), 400
+
+    table = table.astype(object).where(table.notna(), None)
+    response = jsonify(period=request.args.get("period", "annual"), metrics=metrics,
+                       values={ticker: row for ticker, row in table.to_dict(orient="index").items()})
+    response.cache_control.private = True
+    response.cache_control.max_age = 60 * 60
+    return response
+
+
+@views.route("/api/chart/<stock_ticker>")
+@login_required
+@query_budget(6)
+def chart_data(stock_ticker):
+    """
+    Returns the intraday close prices of a stock as compact JSON arrays, for the chart on the stock page.
+
+    The series is downsampled with LTTB to at most the number of points asked for in the "points" query argument, which is
+    clamped to between 3 and CHART_MAX_POINTS.
+    Responses carry an ETag so unchanged data is answered with 304 Not Modified, and are gzipped when the client accepts it.
+
+    :param stock_ticker: A string representing the stock ticker.
+    :return: JSON with the ticker, the timestamps as epoch seconds and the close prices, or 404 if there is no data.
+    """
+
+    from website.stock.ingestion import read_stock_series
+    from website.stock.downsample import lttb
+
+    # LTTB keeps at least the first, the last and one point between them
+    points = min(max(request.args.get("points", current_app.config["CHART_DEFAULT_POINTS"], type=int), 3),
+                 current_app.config["CHART_MAX_POINTS"])
+    series = read_stock_series(stock_ticker, max_age=current_app.config["INTRADAY_MAX_AGE"])
+    if not len(series.timestamps):
+        return jsonify(error=f"No chart data for {stock_ticker}"), 404
+
+    timestamps, prices = lttb(series.timestamps.astype("int64"), series.close, points)
+    response = jsonify(ticker=stock_ticker.upper(), timestamps=timestamps.tolist(), prices=prices.tolist())
+
+    response.cache_control.private = True
+    response.cache_control.max_age = current_app.config["CHART_MAX_AGE"]
+    response.vary.add("Accept-Encoding")
+    # a weak etag, so the plain and gzipped representations validate against each other
+    response.add_etag(weak=True)
+    response.make_conditional(request)
+
+    if response.status_code == 200 and "gzip" in request.accept_encodings:
+        response.set_data(gzip.compress(response.get_data(), compresslevel=6))
+        response.headers["Content-Encoding"] = "gzip"
 
-    return render_template("profile.html", stocks=owned_stocks, balance=current_user.balance, stocks_state=current_prices_of_owned_stock)
+    return response